@@ -0,0 +1,336 @@
+import bisect
+import json
+import mmap
+import pathlib
+import shutil
+import struct
+
+from lamden import db_config
+from lamden.logger.base import get_logger
+
+log = get_logger('BLOCKLOG')
+
+'''
+BlockLog stores blocks in append-only segment files instead of MongoDB.
+
+Each record in a segment is a fixed size header followed by a JSON payload:
+    [kind: 1 byte][number: 8 bytes][length: 4 bytes][payload: length bytes]
+
+Every record written is also appended as one line to an index file:
+    <kind> <number> <hash> <segment> <offset> <length> <subblock> <tx>
+
+The index file is replayed on startup to rebuild a hash -> location map for blocks and transactions and a sparse
+number -> location map for blocks. Blocks are read back through mmap.
+'''
+
+HEADER = struct.Struct('>BQI')
+
+BLOCK_RECORD = 0
+TX_RECORD = 1
+
+INDEX_BLOCK = 'b'
+INDEX_TX = 't'
+INDEX_TX_IN_BLOCK = 'i'
+
+INDEX_FILENAME = 'index.log'
+SEGMENT_SIZE = 64 * 1024 * 1024
+INDEX_INTERVAL = 64
+
+
+def segment_filename(segment: int):
+    return f'segment-{segment:08d}.log'
+
+
+class BlockLog:
+    BLOCK = 0
+    TX = 1
+
+    def __init__(self, root=db_config.BLOCKS_DIR, segment_size=SEGMENT_SIZE, index_interval=INDEX_INTERVAL):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        self.segment_size = segment_size
+        self.index_interval = index_interval
+
+        self.setup()
+
+    def setup(self):
+        # hash -> (segment, offset, length, subblock, tx)
+        self.block_locations = {}
+        self.tx_locations = {}
+
+        # Sorted list of block numbers that have an entry in the sparse index and their (segment, offset)
+        self.sparse_numbers = []
+        self.sparse_locations = []
+
+        # End of the last indexed record in each segment
+        self.segment_ends = {}
+
+        self.height = None
+        self.maps = {}
+
+        self.load_index()
+
+        self.segment = max(self.segment_ends.keys()) if len(self.segment_ends) > 0 else 0
+        self.segment_ends.setdefault(self.segment, 0)
+
+        self.truncate_unindexed()
+
+        self.segment_file = open(self.segment_path(self.segment), 'ab')
+        self.index_file = open(self.root / INDEX_FILENAME, 'a')
+
+    def segment_path(self, segment):
+        return self.root / segment_filename(segment)
+
+    def load_index(self):
+        path = self.root / INDEX_FILENAME
+        if not path.exists():
+            return
+
+        with open(path, 'r+') as f:
+            end = 0
+            for line in iter(f.readline, ''):
+                # A partial line means we crashed while writing it. The record it points to is discarded.
+                if not line.endswith('\n'):
+                    break
+
+                self.add_index_entry(*line.split())
+                end = f.tell()
+
+            f.truncate(end)
+
+    def truncate_unindexed(self):
+        # Drop any bytes written to a segment after the last record that made it in to the index
+        for segment, end in self.segment_ends.items():
+            path = self.segment_path(segment)
+            if path.exists() and path.stat().st_size > end:
+                log.error(f'Discarding {path.stat().st_size - end} unindexed bytes from {path.name}.')
+                with open(path, 'r+b') as f:
+                    f.truncate(end)
+
+    def add_index_entry(self, kind, number, h, segment, offset, length, subblock, tx):
+        number, segment, offset, length = int(number), int(segment), int(offset), int(length)
+        location = (segment, offset, length, int(subblock), int(tx))
+
+        if kind == INDEX_BLOCK:
+            self.block_locations[h] = location
+
+            if len(self.sparse_numbers) == 0 or number - self.sparse_numbers[-1] >= self.index_interval:
+                self.sparse_numbers.append(number)
+                self.sparse_locations.append((segment, offset))
+
+            self.height = number
+        else:
+            self.tx_locations[h] = location
+
+        end = offset + HEADER.size + length
+        if end > self.segment_ends.get(segment, 0):
+            self.segment_ends[segment] = end
+
+    def write_index_entry(self, kind, number, h, segment, offset, length, subblock=-1, tx=-1):
+        entry = (kind, number, h, segment, offset, length, subblock, tx)
+        self.index_file.write(' '.join(str(e) for e in entry) + '\n')
+        self.add_index_entry(*entry)
+
+    def append(self, kind, number, payload: bytes):
+        if self.segment_ends[self.segment] >= self.segment_size:
+            self.roll_segment()
+
+        offset = self.segment_ends[self.segment]
+
+        self.segment_file.write(HEADER.pack(kind, number, len(payload)))
+        self.segment_file.write(payload)
+        self.segment_file.flush()
+
+        return self.segment, offset, len(payload)
+
+    def roll_segment(self):
+        self.segment_file.close()
+        self.segment += 1
+        self.segment_ends[self.segment] = 0
+        self.segment_file = open(self.segment_path(self.segment), 'ab')
+
+    def map(self, segment, end):
+        m = self.maps.get(segment)
+
+        # The active segment grows after it is mapped, so remap it if the record is past the end of the map
+        if m is None or len(m) < end:
+            if m is not None:
+                m.close()
+
+            with open(self.segment_path(segment), 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            self.maps[segment] = m
+
+        return m
+
+    def read_header(self, segment, offset):
+        m = self.map(segment, offset + HEADER.size)
+        return HEADER.unpack_from(m, offset)
+
+    def read_record(self, segment, offset, length):
+        start = offset + HEADER.size
+        m = self.map(segment, start + length)
+        return json.loads(m[start:start + length])
+
+    def iter_block_locations(self, start):
+        if len(self.sparse_locations) == 0:
+            return
+
+        # Start from the closest sparse index entry at or before the block number requested
+        i = bisect.bisect_right(self.sparse_numbers, start) - 1
+        if i < 0:
+            i = 0
+
+        segment, offset = self.sparse_locations[i]
+
+        while segment <= self.segment:
+            if offset >= self.segment_ends.get(segment, 0):
+                segment += 1
+                offset = 0
+                continue
+
+            kind, number, length = self.read_header(segment, offset)
+
+            if kind == BLOCK_RECORD and number >= start:
+                yield number, segment, offset, length
+
+            offset += HEADER.size + length
+
+    def get_block_by_number(self, num):
+        for number, segment, offset, length in self.iter_block_locations(num):
+            if number == num:
+                return self.read_record(segment, offset, length)
+            return None
+
+        return None
+
+    def create_indexes(self):
+        # Indexes are kept up to date as records are appended
+        pass
+
+    def get_block(self, v=None):
+        if v is None:
+            return None
+
+        if isinstance(v, int):
+            return self.get_block_by_number(v)
+
+        location = self.block_locations.get(v)
+        if location is None:
+            return None
+
+        segment, offset, length, _, _ = location
+
+        return self.read_record(segment, offset, length)
+
+    def put(self, data, collection=BLOCK):
+        if collection == BlockLog.BLOCK:
+            number = data.get('number')
+            if number is None or (self.height is not None and number <= self.height):
+                return False
+
+            if data.get('hash') in self.block_locations:
+                return False
+
+            segment, offset, length = self.append(BLOCK_RECORD, number, json.dumps(data).encode())
+            self.write_index_entry(INDEX_BLOCK, number, data['hash'], segment, offset, length)
+
+        elif collection == BlockLog.TX:
+            if data.get('hash') in self.tx_locations:
+                return False
+
+            segment, offset, length = self.append(TX_RECORD, 0, json.dumps(data).encode())
+            self.write_index_entry(INDEX_TX, 0, data['hash'], segment, offset, length)
+
+        else:
+            return False
+
+        self.index_file.flush()
+
+        return True
+
+    def get_last_n(self, n, collection=BLOCK):
+        if collection != BlockLog.BLOCK:
+            return None
+
+        if self.height is None:
+            return []
+
+        start = max(self.height - n + 1, 0)
+
+        blocks = [self.read_record(segment, offset, length)
+                  for _, segment, offset, length in self.iter_block_locations(start)]
+
+        blocks.reverse()
+
+        return blocks[:n]
+
+    def get_blocks(self, start, end):
+        for number, segment, offset, length in self.iter_block_locations(start):
+            if number > end:
+                return
+
+            yield self.read_record(segment, offset, length)
+
+    def get_tx(self, h):
+        location = self.tx_locations.get(h)
+        if location is None:
+            return None
+
+        segment, offset, length, subblock, tx = location
+
+        record = self.read_record(segment, offset, length)
+
+        # Transactions stored as part of a block are read out of the block they were stored in
+        if subblock >= 0:
+            return record['subblocks'][subblock]['transactions'][tx]
+
+        return record
+
+    def close(self):
+        for m in self.maps.values():
+            m.close()
+        self.maps.clear()
+
+        self.segment_file.close()
+        self.index_file.close()
+
+    def drop_collections(self):
+        self.close()
+
+        shutil.rmtree(str(self.root))
+        self.root.mkdir(parents=True, exist_ok=True)
+
+        self.setup()
+
+    def flush(self):
+        self.drop_collections()
+
+    def store_block(self, block):
+        # Storing a block that is already stored is a no-op
+        if block['hash'] in self.block_locations:
+            return
+
+        if not self.put(block, BlockLog.BLOCK):
+            log.error(f'Block #{block.get("number")} is not after the latest stored block. Not storing.')
+            return
+
+        segment, offset, length, _, _ = self.block_locations[block['hash']]
+
+        # Transactions are not written twice. They are indexed to their position inside the block record.
+        for i, subblock in enumerate(block['subblocks']):
+            for j, tx in enumerate(subblock['transactions']):
+                self.write_index_entry(INDEX_TX_IN_BLOCK, block['number'], tx['hash'], segment, offset, length, i, j)
+
+        self.index_file.flush()
+
+    def store_blocks(self, blocks):
+        for block in blocks:
+            self.store_block(block)
+
+    def store_txs(self, block):
+        for subblock in block['subblocks']:
+            for tx in subblock['transactions']:
+                self.put(tx, BlockLog.TX)
@@ -1,5 +1,5 @@
 import argparse
-from lamden.cli.start import start_node, join_network
+from lamden.cli.start import start_node, join_network, get_block_storage
 # from lamden.cli.update import verify_access, verify_pkg, trigger, vote, check_ready_quorum
 from lamden.storage import BlockStorage
 from contracting.client import ContractDriver
@@ -7,7 +7,7 @@ from contracting.client import ContractDriver
 
 def flush(args):
     if args.storage_type == 'blocks':
-        BlockStorage().drop_collections()
+        get_block_storage(args.block_storage).drop_collections()
         print('All blocks deleted.')
     elif args.storage_type == 'state':
         ContractDriver().flush()
@@ -21,6 +21,10 @@ def flush(args):
             b.client.drop_database(db)
 
         ContractDriver().flush()
+
+        if args.block_storage == 'log':
+            get_block_storage(args.block_storage).drop_collections()
+
         print('All blocks deleted.')
         print('State deleted.')
     else:
@@ -40,9 +44,11 @@ def setup_cilparser(parser):
     start_parser.add_argument('-wp', '--webserver_port', type=int, default=18080)
     start_parser.add_argument('-p', '--pid', type=int, default=-1)
     start_parser.add_argument('-b', '--bypass_catchup', type=bool, default=False)
+    start_parser.add_argument('-bs', '--block_storage', type=str, default='mongo')
 
     flush_parser = subparser.add_parser('flush')
     flush_parser.add_argument('storage_type', type=str)
+    flush_parser.add_argument('-bs', '--block_storage', type=str, default='mongo')
 
     join_parser = subparser.add_parser('join')
     join_parser.add_argument('node_type', type=str)
@@ -50,6 +56,7 @@ def setup_cilparser(parser):
     join_parser.add_argument('-m', '--mn_seed', type=str)
     join_parser.add_argument('-mp', '--mn_seed_port', type=int, default=18080)
     join_parser.add_argument('-wp', '--webserver_port', type=int, default=18080)
+    join_parser.add_argument('-bs', '--block_storage', type=str, default='mongo')
 
     return True
 
@@ -12,6 +12,8 @@ from pymongo import MongoClient
 from pymongo.errors import ServerSelectionTimeoutError
 
 from lamden.crypto.wallet import Wallet
+from lamden.storage import BlockStorage
+from lamden.blocklog import BlockLog
 from lamden.nodes.masternode.masternode import Masternode
 from lamden.nodes.delegate.delegate import Delegate
 
@@ -30,6 +32,16 @@ def start_mongo():
         time.sleep(3)
 
 
+def get_block_storage(storage_type):
+    assert storage_type == 'mongo' or storage_type == 'log', 'Provide block storage as "mongo" or "log"'
+
+    # The block log is embedded and does not need a running mongod
+    if storage_type == 'log':
+        return BlockLog()
+
+    return BlockStorage()
+
+
 def print_ascii_art():
     print('''
                 ##
@@ -136,6 +148,7 @@ def start_node(args):
             ctx=zmq.asyncio.Context(),
             socket_base=socket_base,
             bootnodes=bootnodes,
+            blocks=get_block_storage(args.block_storage),
             constitution=const,
             webserver_port=args.webserver_port,
             bypass_catchup=args.bypass_catchup,
@@ -192,6 +205,7 @@ def join_network(args):
             ctx=zmq.asyncio.Context(),
             socket_base=socket_base,
             constitution=const,
+            blocks=get_block_storage(args.block_storage),
             webserver_port=args.webserver_port,
             bootnodes=bootnodes,
             seed=mn_seed,
@@ -34,14 +34,15 @@ def tx_hash_from_tx(tx):
 
 
 def merklize(leaves):
+    # Hash all leaves so that all data is same length
+    return merklize_hashes([hashlib.sha3_256(l).digest() for l in leaves])
+
+
+def merklize_hashes(leaves):
+    # Same as merklize for leaves that are already hashed
     # Make space for the parent hashes
     nodes = [None for _ in range(len(leaves) - 1)]
-
-    # Hash all leaves so that all data is same length
-    for l in leaves:
-        h = hashlib.sha3_256()
-        h.update(l)
-        nodes.append(h.digest())
+    nodes.extend(leaves)
 
     # Hash each pair of leaves together and set the hash to their parent in the list
     for i in range((len(leaves) * 2) - 1 - len(leaves), 0, -1):
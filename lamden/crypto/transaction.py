@@ -105,6 +105,22 @@ def fixed_is_valid(f: dict):
     return True
 
 
+def signed_payloads(transactions: list):
+    # (sender, payload, signature) for every transaction that has them, to be checked together with
+    # Verifier.verify_batch. Badly formatted transactions are left out and rejected when checked one by one.
+    signed = []
+    for tx in transactions:
+        try:
+            item = (tx['payload']['sender'], encode(tx['payload']), tx['metadata']['signature'])
+        except (KeyError, TypeError):
+            continue
+
+        if all(type(v) == str for v in item):
+            signed.append(item)
+
+    return signed
+
+
 def check_tx_formatting(tx: dict, expected_processor: str):
     if not check_format(tx, rules.TRANSACTION_RULES):
         raise TransactionFormattingError
@@ -213,32 +229,9 @@ def build_transaction(wallet, contract: str, function: str, kwargs: dict, nonce:
     return encode(format_dictionary(tx))
 
 
-# Run through all tests
-def transaction_is_valid(transaction, expected_processor, client: ContractingClient, nonces: storage.NonceStorage, strict=True,
-                         tx_per_block=15, timeout=5):
-    # Check basic formatting so we can access via __getitem__ notation without errors
-    if not check_format(transaction, rules.TRANSACTION_RULES):
-        return TransactionFormattingError
-
-    transaction_is_not_expired(transaction, timeout)
-
-    # Put in to variables for visual ease
-    processor = transaction['payload']['processor']
+def check_funds(transaction, client: ContractingClient):
     sender = transaction['payload']['sender']
 
-    # Checks if correct processor and if signature is valid
-    check_tx_formatting(transaction, expected_processor)
-
-    # Gets the expected nonces
-    nonce, pending_nonce = get_nonces(sender, processor, nonces)
-
-    # Get the provided nonce
-    tx_nonce = transaction['payload']['nonce']
-
-    # Check to see if the provided nonce is valid to what we expect and
-    # if there are less than the max pending txs in the block
-    get_new_pending_nonce(tx_nonce, nonce, pending_nonce, strict=strict, tx_per_block=tx_per_block)
-
     # Get the senders balance and the current stamp rate
     balance = client.get_var(contract='currency', variable='balances', arguments=[sender], mark=False)
     stamp_rate = client.get_var(contract='stamp_cost', variable='S', arguments=['value'], mark=False)
@@ -267,3 +260,32 @@ def transaction_is_valid(transaction, expected_processor, client: ContractingCli
     name = transaction['payload']['kwargs'].get('name')
     contract_name_is_valid(contract, func, name)
 
+
+# Run through all tests
+def transaction_is_valid(transaction, expected_processor, client: ContractingClient, nonces: storage.NonceStorage, strict=True,
+                         tx_per_block=15, timeout=5):
+    # Check basic formatting so we can access via __getitem__ notation without errors
+    if not check_format(transaction, rules.TRANSACTION_RULES):
+        return TransactionFormattingError
+
+    transaction_is_not_expired(transaction, timeout)
+
+    # Put in to variables for visual ease
+    processor = transaction['payload']['processor']
+    sender = transaction['payload']['sender']
+
+    # Checks if correct processor and if signature is valid
+    check_tx_formatting(transaction, expected_processor)
+
+    # Gets the expected nonces
+    nonce, pending_nonce = get_nonces(sender, processor, nonces)
+
+    # Get the provided nonce
+    tx_nonce = transaction['payload']['nonce']
+
+    # Check to see if the provided nonce is valid to what we expect and
+    # if there are less than the max pending txs in the block
+    get_new_pending_nonce(tx_nonce, nonce, pending_nonce, strict=strict, tx_per_block=tx_per_block)
+
+    check_funds(transaction, client)
+
@@ -0,0 +1,167 @@
+import hashlib
+import multiprocessing as mp
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import nacl.exceptions
+import nacl.signing
+
+'''
+Signature verification with caching and a batch API.
+
+Parsed VerifyKeys are kept in an LRU, because the same masternode and delegate keys sign almost everything a node
+sees. Signatures that verified are remembered by (vk, sha3 of the message, signature), so the same signature checked
+again by another part of the node costs one hash. Large batches are split in to chunks and verified on a process
+pool.
+
+The node shares one Verifier, service, whose pool is started when the node starts. Pool workers are started by a fork
+server, or spawned where there is none, because forking a process that is already running threads can copy locks
+those threads hold.
+'''
+
+VERIFY_KEY_CACHE_SIZE = 4096
+VERIFIED_CACHE_SIZE = 65536
+
+# Batches smaller than this are verified in process, since sending them to the pool costs more than checking them
+MIN_POOL_BATCH = 64
+CHUNK_SIZE = 256
+
+
+@lru_cache(maxsize=VERIFY_KEY_CACHE_SIZE)
+def verify_key(vk: str):
+    return nacl.signing.VerifyKey(bytes.fromhex(vk))
+
+
+def check(vk: str, msg: bytes, signature: str):
+    try:
+        verify_key(vk).verify(msg, bytes.fromhex(signature))
+    except nacl.exceptions.BadSignatureError:
+        return False
+    return True
+
+
+def check_chunk(items: list):
+    # Runs on the pool. Malformed keys or signatures are invalid rather than errors.
+    results = []
+    for vk, msg, signature in items:
+        try:
+            results.append(check(vk, msg, signature))
+        except Exception:
+            results.append(False)
+    return results
+
+
+class VerifiedCache:
+    def __init__(self, size=VERIFIED_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(vk: str, msg: bytes, signature: str):
+        return vk, hashlib.sha3_256(msg).digest(), signature
+
+    def __contains__(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True
+
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        with self.lock:
+            self.entries[key] = True
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+verified = VerifiedCache()
+
+
+def pool_context():
+    methods = mp.get_all_start_methods()
+    return mp.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+class Verifier:
+    def __init__(self, workers=None, min_pool_batch=MIN_POOL_BATCH, chunk_size=CHUNK_SIZE, cache=verified):
+        self.workers = workers
+        self.min_pool_batch = min_pool_batch
+        self.chunk_size = chunk_size
+        self.cache = cache
+
+        self.pool = None
+
+    def get_pool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=pool_context())
+        return self.pool
+
+    def start(self):
+        # Starts the fork server and the workers now rather than on the first large batch
+        self.get_pool().submit(check_chunk, []).result()
+
+    def verify(self, vk: str, msg: str, signature: str):
+        msg = msg.encode()
+
+        key = VerifiedCache.key(vk, msg, signature)
+        if key in self.cache:
+            return True
+
+        if not check(vk, msg, signature):
+            return False
+
+        self.cache.add(key)
+        return True
+
+    def verify_batch(self, items: list):
+        # items: list of (vk, msg, signature). Returns a list of bools in the same order.
+        results = [False] * len(items)
+
+        todo = []
+        for i, (vk, msg, signature) in enumerate(items):
+            msg = msg.encode()
+            key = VerifiedCache.key(vk, msg, signature)
+
+            if key in self.cache:
+                results[i] = True
+            else:
+                todo.append((i, key, (vk, msg, signature)))
+
+        if len(todo) < self.min_pool_batch:
+            checked = check_chunk([item for _, _, item in todo])
+        else:
+            chunks = [
+                [item for _, _, item in todo[i:i + self.chunk_size]]
+                for i in range(0, len(todo), self.chunk_size)
+            ]
+            checked = [r for chunk in self.get_pool().map(check_chunk, chunks) for r in chunk]
+
+        for (i, key, _), ok in zip(todo, checked):
+            if ok:
+                self.cache.add(key)
+            results[i] = ok
+
+        return results
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
+
+
+service = Verifier()
+
+
+def verify(vk: str, msg: str, signature: str):
+    return service.verify(vk, msg, signature)
@@ -4,19 +4,12 @@ import nacl.signing
 from zmq.utils import z85
 import secrets
 from . import zbase
+from . import verifier
 
 
 def verify(vk: str, msg: str, signature: str):
-    vk = bytes.fromhex(vk)
-    msg = msg.encode()
-    signature = bytes.fromhex(signature)
-
-    vk = nacl.signing.VerifyKey(vk)
-    try:
-        vk.verify(msg, signature)
-    except nacl.exceptions.BadSignatureError:
-        return False
-    return True
+    # Parsed keys and signatures that already verified are cached
+    return verifier.verify(vk, msg, signature)
 
 
 class Wallet:
@@ -12,6 +12,8 @@ if DATA_DIR is None:
 MONGO_DIR = DATA_DIR + '/mongo'
 MONGO_LOG_PATH = MONGO_DIR + '/logs/mongo.log'
 
+BLOCKS_DIR = DATA_DIR + '/blocks'
+
 
 def config_mongo_dir():
     try:
@@ -77,10 +77,11 @@ class PeerProcessor(router.Processor):
 
 
 class JoinProcessor(router.Processor):
-    def __init__(self, ctx, peers, wallet):
+    def __init__(self, ctx, peers, wallet, pool: router.PeerPool=None):
         self.ctx = ctx
         self.peers = peers
         self.wallet = wallet
+        self.pool = pool
 
     async def process_message(self, msg):
         # Send ping to peer server to verify
@@ -100,10 +101,14 @@ class JoinProcessor(router.Processor):
         #     return
 
         if msg.get('vk') not in self.peers or self.peers[msg.get('vk')] != msg.get('ip'):
-            await router.secure_multicast(msg=msg, service=JOIN_SERVICE, peer_map=self.peers, ctx=self.ctx, wallet=self.wallet)
+            await router.secure_multicast(msg=msg, service=JOIN_SERVICE, peer_map=self.peers, ctx=self.ctx, wallet=self.wallet,
+                                          pool=self.pool)
 
         self.peers[msg.get('vk')] = msg.get('ip')
 
+        if self.pool is not None:
+            self.pool.sync(self.peers)
+
         return {
             'peers': [{'vk': v, 'ip': i} for v, i in self.peers.items()]
         }
@@ -114,10 +119,14 @@ class JoinProcessor(router.Processor):
 # }
 
 class Network:
-    def __init__(self, wallet: Wallet, ip_string: str, ctx: zmq.asyncio.Context, router: router.Router, pepper: str=PEPPER):
+    def __init__(self, wallet: Wallet, ip_string: str, ctx: zmq.asyncio.Context, router: router.Router, pepper: str=PEPPER,
+                 pool: router.PeerPool=None):
         self.wallet = wallet
         self.ctx = ctx
 
+        # Connections are kept open between messages and replaced when a peer's IP changes
+        self.pool = pool
+
         self.peers = {
             self.wallet.verifying_key: ip_string
         }
@@ -125,12 +134,13 @@ class Network:
         # Add processors to router to accept and process networking messages
         self.ip = ip_string
         self.vk = self.wallet.verifying_key
-        self.join_processor = JoinProcessor(ctx=self.ctx, peers=self.peers, wallet=self.wallet)
+        self.join_processor = JoinProcessor(ctx=self.ctx, peers=self.peers, wallet=self.wallet, pool=self.pool)
         self.identity_processor = IdentityProcessor(wallet=self.wallet, ip_string=ip_string, pepper=pepper)
         self.peer_processor = PeerProcessor(peers=self.peers)
         self.log = get_logger('Peers')
 
-        router.add_service(JOIN_SERVICE, self.join_processor)
+        # Every join is multicast on to our peers, so only a few are handled at once
+        router.add_service(JOIN_SERVICE, self.join_processor, max_concurrent=4, max_queue=64)
         router.add_service(IDENTITY_SERVICE, self.identity_processor)
         router.add_service(PEER_SERVICE, self.peer_processor)
 
@@ -143,12 +153,18 @@ class Network:
         for peer in peers['peers']:
             self.peers[peer['vk']] = peer['ip']
 
+        self.sync_pool()
+
+    def sync_pool(self):
+        if self.pool is not None:
+            self.pool.sync(self.peers)
+
     async def start(self, bootnodes: dict, vks: list):
         # Join all bootnodes
         while not self.all_vks_found(vks):
 
             coroutines = [router.secure_request(msg=self.join_msg, service=JOIN_SERVICE, wallet=self.wallet,
-                                                ctx=self.ctx, ip=ip, vk=vk) for vk, ip, in bootnodes.items()]
+                                                ctx=self.ctx, ip=ip, vk=vk, pool=self.pool) for vk, ip, in bootnodes.items()]
 
             results = await asyncio.gather(*coroutines)
 
@@ -162,7 +178,7 @@ class Network:
 
                     response = await router.secure_request(msg={}, service=IDENTITY_SERVICE, wallet=self.wallet,
                                                            vk=peer.get('vk'),
-                                                           ip=peer.get('ip'), ctx=self.ctx)
+                                                           ip=peer.get('ip'), ctx=self.ctx, pool=self.pool)
 
                     if response is None:
                         LOGGER.error(f'No response for identity proof for {peer.get("ip")}')
@@ -172,6 +188,8 @@ class Network:
                         self.peers[peer['vk']] = peer['ip']
                         self.log.info(f'{peer["vk"]} -> {peer["ip"]}')
 
+            self.sync_pool()
+
             self.log.info(f'{len(self.peers)}/{len(vks)} peers found.')
         self.log.info(f'All peers found. Continuing startup process.')
 
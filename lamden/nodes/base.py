@@ -1,5 +1,6 @@
 from lamden import storage, network, router, authentication, rewards, upgrade
-from lamden.crypto import canonical
+from lamden.nodes import catchup
+from lamden.crypto import canonical, verifier
 from lamden.crypto.wallet import Wallet
 from lamden.contracts import sync
 from contracting.db.driver import ContractDriver, encode
@@ -20,10 +21,21 @@ WORK_SERVICE = 'work'
 CONTENDER_SERVICE = 'contenders'
 
 GET_BLOCK = 'get_block'
+GET_BLOCKS = 'get_blocks'
 GET_HEIGHT = 'get_height'
 
+# Most blocks a masternode will return for a single GET_BLOCKS request
+MAX_BLOCKS_PER_REQUEST = 50
 
-async def get_latest_block_height(wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context):
+# Blocks applied between state commits while in batch mode
+BATCH_COMMIT_INTERVAL = 100
+
+# Garbage collection thresholds while in batch mode. Raising generation 0 keeps the collector from running
+# constantly while large numbers of short lived block dictionaries are created.
+BATCH_GC_THRESHOLD = (50_000, 20, 20)
+
+
+async def get_latest_block_height(wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context, pool: router.PeerPool=None):
     msg = {
         'name': GET_HEIGHT,
         'arg': ''
@@ -36,12 +48,13 @@ async def get_latest_block_height(wallet: Wallet, vk: str, ip: str, ctx: zmq.asy
         service=BLOCK_SERVICE,
         msg=msg,
         ctx=ctx,
+        pool=pool
     )
 
     return response
 
 
-async def get_block(block_num: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context):
+async def get_block(block_num: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context, pool: router.PeerPool=None):
     msg = {
         'name': GET_BLOCK,
         'arg': block_num
@@ -54,6 +67,27 @@ async def get_block(block_num: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.a
         service=BLOCK_SERVICE,
         msg=msg,
         ctx=ctx,
+        pool=pool
+    )
+
+    return response
+
+
+async def get_blocks(start: int, end: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context, timeout=5000, pool: router.PeerPool=None):
+    msg = {
+        'name': GET_BLOCKS,
+        'arg': [start, end]
+    }
+
+    response = await router.secure_request(
+        ip=ip,
+        vk=vk,
+        wallet=wallet,
+        service=BLOCK_SERVICE,
+        msg=msg,
+        ctx=ctx,
+        timeout=timeout,
+        pool=pool
     )
 
     return response
@@ -62,15 +96,17 @@ async def get_block(block_num: int, wallet: Wallet, vk: str, ip: str, ctx: zmq.a
 class NewBlock(router.Processor):
     def __init__(self, driver: ContractDriver):
         self.q = []
+        self.signal = router.Signal()
         self.driver = driver
         self.log = get_logger('NBN')
 
     async def process_message(self, msg):
         self.q.append(msg)
+        self.signal.set()
 
     async def wait_for_next_nbn(self):
         while len(self.q) <= 0:
-            await asyncio.sleep(0)
+            await self.signal.wait()
 
         nbn = self.q.pop(0)
 
@@ -136,11 +172,18 @@ class Node:
             secure=True
         )
 
+        self.pool = router.PeerPool(
+            ctx=self.ctx,
+            wallet=wallet,
+            cert_dir=self.socket_authenticator.cert_dir
+        )
+
         self.network = network.Network(
             wallet=wallet,
             ip_string=socket_base,
             ctx=self.ctx,
-            router=self.router
+            router=self.router,
+            pool=self.pool
         )
 
         self.new_block_processor = NewBlock(driver=self.driver)
@@ -156,6 +199,15 @@ class Node:
 
         self.bypass_catchup = bypass_catchup
 
+        # Batch mode defers commits and housekeeping across several blocks. Used while catching up.
+        self.batch_mode = False
+        self.batch_commit_interval = BATCH_COMMIT_INTERVAL
+        self.batched_blocks = 0
+        self.pending_blocks = []
+        self.gc_threshold = None
+
+        self.governance_members = None
+
     def seed_genesis_contracts(self):
         self.log.info('Setting up genesis contracts.')
         sync.setup_genesis_contracts(
@@ -174,7 +226,8 @@ class Node:
             ip=mn_seed,
             vk=mn_vk,
             wallet=self.wallet,
-            ctx=self.ctx
+            ctx=self.ctx,
+            pool=self.pool
         )
 
         self.log.info(f'Current block: {current}, Latest available block: {latest}')
@@ -183,26 +236,63 @@ class Node:
             self.log.info('No need to catchup. Proceeding.')
             return
 
-        # Increment current by one. Don't count the genesis block.
-        if current == 0:
-            current = 1
+        # Split the missing blocks across every masternode we know about, including the seed
+        peers = self.get_masternode_peers()
+        peers.pop(self.wallet.verifying_key, None)
+        peers[mn_vk] = mn_seed
 
-        # Find the missing blocks process them
-        for i in range(current, latest + 1):
-            block = await get_block(
-                block_num=i,
-                ip=mn_seed,
-                vk=mn_vk,
-                wallet=self.wallet,
-                ctx=self.ctx
-            )
-            self.process_new_block(block)
+        engine = catchup.CatchupEngine(
+            peers=peers,
+            fetch=self.fetch_blocks,
+            process_block=self.process_catchup_block,
+            chunk_size=MAX_BLOCKS_PER_REQUEST
+        )
+
+        # Start after the latest block we have. Block 0 is the genesis block and is never fetched.
+        self.start_batch()
+        try:
+            await engine.run(start=self.current_height + 1, latest=latest)
+        finally:
+            self.end_batch()
 
         # Process any blocks that were made while we were catching up
         while len(self.new_block_processor.q) > 0:
             block = self.new_block_processor.q.pop(0)
             self.process_new_block(block)
 
+    async def fetch_blocks(self, start, end, vk, ip):
+        blocks = await get_blocks(
+            start=start,
+            end=end,
+            ip=ip,
+            vk=vk,
+            wallet=self.wallet,
+            ctx=self.ctx,
+            pool=self.pool
+        )
+
+        # Masternodes that do not support range requests reply with an OK message
+        if type(blocks) != list:
+            block = await get_block(
+                block_num=start,
+                ip=ip,
+                vk=vk,
+                wallet=self.wallet,
+                ctx=self.ctx,
+                pool=self.pool
+            )
+
+            if type(block) != dict or block.get('number') is None:
+                return None
+
+            blocks = [block]
+
+        return blocks
+
+    def process_catchup_block(self, block):
+        self.process_new_block(block)
+        return self.current_height == block['number']
+
     def should_process(self, block):
         self.log.info(f'Processing block #{block["number"]}')
         # Test if block failed immediately
@@ -239,16 +329,20 @@ class Node:
         return good
 
     def update_state(self, block):
-        self.driver.clear_pending_state()
+        # Uncommitted state from earlier blocks in the batch must stay in the cache
+        if not self.batch_mode:
+            self.driver.clear_pending_state()
 
         # Check if the block is valid
-        if self.should_process(block):
+        processed = self.should_process(block)
+        if processed:
             self.log.info('Storing new block.')
             # Commit the state changes and nonces to the database
             storage.update_state_with_block(
                 block=block,
                 driver=self.driver,
-                nonces=self.nonces
+                nonces=self.nonces,
+                cached=self.batch_mode
             )
 
             self.log.info('Issuing rewards.')
@@ -264,28 +358,85 @@ class Node:
 
         self.new_block_processor.clean(self.current_height)
 
+        return processed
+
+    def refresh_governance_sockets(self):
+        # Rewriting the certificate directory is expensive, so only do it when membership changes
+        members = (
+            self.client.get_var(contract='masternodes', variable='S', arguments=['members']),
+            self.client.get_var(contract='delegates', variable='S', arguments=['members'])
+        )
+
+        if members == self.governance_members:
+            return
+
+        self.socket_authenticator.refresh_governance_sockets()
+        self.pool.forget_keys()
+        self.governance_members = members
+
     def process_new_block(self, block):
         # Update the state and refresh the sockets so new nodes can join
-        self.update_state(block)
-        self.socket_authenticator.refresh_governance_sockets()
+        processed = self.update_state(block)
+        self.refresh_governance_sockets()
 
-        # Store the block if it's a masternode
-        if self.store:
+        # Store the block if it's a masternode. Failed and already processed blocks are not stored
+        # because block numbers and hashes are unique in storage.
+        if self.store and processed:
             encoded_block = encode(block)
             encoded_block = json.loads(encoded_block)
 
-            self.blocks.store_block(encoded_block)
+            self.pending_blocks.append(encoded_block)
+
+        if self.batch_mode:
+            self.batched_blocks += 1
+            if self.batched_blocks >= self.batch_commit_interval:
+                self.commit_batch()
+            return
 
         # Prepare for the next block by flushing out driver and notification state
         # self.new_block_processor.clean()
 
         # Finally, check and initiate an upgrade if one needs to be done
+        self.commit_batch()
+        #self.nonces.flush_pending()
+
+    def commit_batch(self):
+        self.blocks.store_blocks(self.pending_blocks)
+        self.pending_blocks.clear()
+
         self.driver.commit()
+        self.nonces.commit()
         self.driver.clear_pending_state()
-        gc.collect() # Force memory cleanup every block
-        #self.nonces.flush_pending()
+
+        self.batched_blocks = 0
+
+        gc.collect() # Force memory cleanup every commit
+
+    def start_batch(self, commit_interval=BATCH_COMMIT_INTERVAL):
+        self.batch_mode = True
+        self.batch_commit_interval = commit_interval
+        self.batched_blocks = 0
+
+        self.gc_threshold = gc.get_threshold()
+        gc.set_threshold(*BATCH_GC_THRESHOLD)
+
+    def end_batch(self):
+        if not self.batch_mode:
+            return
+
+        self.commit_batch()
+        self.batch_mode = False
+
+        gc.set_threshold(*self.gc_threshold)
 
     async def start(self):
+        # The verifier's workers are started before the node is busy, so the first large batch does not wait for them
+        verifier.service.start()
+
+        # Index the block collections before anything is stored or served
+        if self.store:
+            self.blocks.create_indexes()
+
         asyncio.ensure_future(self.router.serve())
 
         # Get the set of VKs we are looking for from the constitution argument
@@ -318,8 +469,9 @@ class Node:
             # Use this IP to request any missed blocks
             await self.catchup(mn_seed=masternode_ip, mn_vk=masternode)
 
-        # Refresh the sockets to accept new nodes
-        self.socket_authenticator.refresh_governance_sockets()
+        # Refresh the sockets to accept new nodes. The members are remembered, so blocks that do not change them do
+        # not refresh the sockets again.
+        self.refresh_governance_sockets()
 
         # Start running
         self.running = True
@@ -327,8 +479,13 @@ class Node:
     def stop(self):
         # Kill the router and throw the running flag to stop the loop
         self.router.stop()
+        self.pool.close()
+        verifier.service.stop()
         self.running = False
 
+        # Wake anything waiting for blocks so it sees that the node has stopped
+        self.new_block_processor.signal.set()
+
     def _get_member_peers(self, contract_name):
         members = self.client.get_var(
             contract=contract_name,
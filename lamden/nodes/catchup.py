@@ -0,0 +1,237 @@
+import asyncio
+import time
+
+from lamden.logger.base import get_logger
+
+'''
+CatchupEngine fetches a range of missing blocks from several masternodes at once.
+
+The range is split in to chunks. Each peer runs a worker that takes the next chunk and requests it. A sliding window
+bounds how many chunks can be requested or buffered ahead of the next block to apply, and results are applied strictly
+in order as soon as the chunk at the head of the range arrives.
+
+Failed or incomplete chunks are put back in the queue for another peer. So are blocks that cannot be applied, which
+go to a different peer than the one that served them if there is one. A peer that fails too many times is dropped.
+If the chunk at the head of the range has been in flight for too long, idle peers request it as well and the first
+response wins, so one slow peer cannot stall the rest of the range.
+'''
+
+
+class CatchupEngine:
+    def __init__(self, peers: dict, fetch, process_block, chunk_size=50, window_per_peer=2, max_failures=3,
+                 hedge_after=5, debug=True):
+        # peers: vk -> ip
+        self.peers = dict(peers)
+
+        # fetch(start, end, vk, ip) -> list of blocks or None. process_block(block) -> True if the block was applied
+        self.fetch = fetch
+        self.process_block = process_block
+
+        self.chunk_size = chunk_size
+        self.window = max(window_per_peer * len(self.peers), 1)
+        self.max_failures = max_failures
+        self.hedge_after = hedge_after
+
+        self.log = get_logger('Catchup')
+        self.log.propagate = debug
+
+        self.condition = None
+
+        self.fresh = []
+        self.retry = []
+        self.in_flight = {}
+        self.results = {}
+        self.ends = {}
+
+        # start -> peers whose blocks for that range could not be applied
+        self.refused = {}
+
+        self.next_block = 0
+        self.latest = 0
+        self.assigned = 0
+        self.failures = {}
+        self.live_peers = set()
+        self.failed = False
+
+    def make_chunks(self, start, end):
+        chunks = []
+        i = start
+        while i <= end:
+            chunks.append((i, min(i + self.chunk_size - 1, end)))
+            i += self.chunk_size
+
+        return chunks
+
+    @property
+    def done(self):
+        return self.next_block > self.latest or self.failed or len(self.live_peers) == 0
+
+    def take_chunk(self, vk=None):
+        # Retried chunks are already counted against the window. Peers are not given back blocks they served that
+        # could not be applied, unless no other peer is left to try.
+        self.retry.sort()
+        for i, (start, end) in enumerate(self.retry):
+            refused = self.refused.get(start, set())
+            if vk not in refused or self.live_peers <= refused:
+                return self.retry.pop(i)
+
+        if len(self.fresh) > 0 and self.assigned < self.window:
+            self.assigned += 1
+            return self.fresh.pop(0)
+
+        # Nothing else to do, so help with the chunk everyone is waiting on if it is taking too long
+        head = self.in_flight.get(self.next_block)
+        if head is not None and time.time() - head > self.hedge_after:
+            self.in_flight[self.next_block] = time.time()
+            return self.next_block, self.ends[self.next_block]
+
+        return None
+
+    async def next_chunk(self, vk=None):
+        async with self.condition:
+            while not self.done:
+                chunk = self.take_chunk(vk)
+                if chunk is not None:
+                    self.in_flight[chunk[0]] = time.time()
+                    return chunk
+
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout=self.hedge_after)
+                except asyncio.TimeoutError:
+                    pass
+
+        return None
+
+    def requeue(self, start, end):
+        self.in_flight.pop(start, None)
+
+        # Another peer may have already delivered it
+        if start in self.results or start < self.next_block:
+            return
+
+        if (start, end) not in self.retry:
+            self.retry.append((start, end))
+
+    def strike(self, vk):
+        self.failures[vk] = self.failures.get(vk, 0) + 1
+
+        if self.failures[vk] >= self.max_failures:
+            self.log.error(f'Dropping {vk[:8]} from catchup after {self.failures[vk]} failures.')
+            self.live_peers.discard(vk)
+
+    def store_result(self, start, end, blocks, vk=None):
+        self.in_flight.pop(start, None)
+
+        if start in self.results or start < self.next_block:
+            return
+
+        # Partial responses are kept and the rest of the chunk is requested again
+        received = blocks[-1]['number']
+        if received < end:
+            self.ends[start] = received
+            self.ends[received + 1] = end
+            self.retry.append((received + 1, end))
+            self.assigned += 1
+
+        self.results[start] = (blocks, vk)
+
+    def apply(self, block):
+        try:
+            return self.process_block(block)
+        except Exception as e:
+            self.log.error(f'Error applying block #{block.get("number")}: {e}')
+            return False
+
+    def apply_ready(self):
+        while self.next_block in self.results:
+            start = self.next_block
+            blocks, vk = self.results.pop(start)
+            end = self.ends.pop(start)
+
+            for block in blocks:
+                if not self.apply(block):
+                    # Keep what was applied and give the rest of the range to another peer
+                    number = block['number']
+                    self.log.error(f'Block #{number} from {str(vk)[:8]} could not be applied. Requesting it again.')
+
+                    self.next_block = number
+                    self.ends[number] = end
+                    self.refused.setdefault(number, set()).add(vk)
+                    self.requeue(number, end)
+                    self.strike(vk)
+                    return
+
+            self.next_block = end + 1
+            self.assigned -= 1
+
+    def blocks_are_valid(self, blocks, start, end):
+        if type(blocks) != list or len(blocks) == 0:
+            return False
+
+        numbers = [b.get('number') if type(b) == dict else None for b in blocks]
+        return numbers == list(range(start, start + len(numbers))) and numbers[-1] <= end
+
+    async def worker(self, vk, ip):
+        while vk in self.live_peers:
+            chunk = await self.next_chunk(vk)
+            if chunk is None:
+                break
+
+            start, end = chunk
+
+            try:
+                blocks = await self.fetch(start, end, vk, ip)
+            except Exception as e:
+                self.log.error(f'Error fetching blocks {start}-{end} from {vk[:8]}: {e}')
+                blocks = None
+
+            async with self.condition:
+                try:
+                    if self.blocks_are_valid(blocks, start, end):
+                        self.store_result(start, end, blocks, vk)
+                        self.apply_ready()
+                    else:
+                        self.log.error(f'Could not get blocks {start}-{end} from {vk[:8]}.')
+                        self.requeue(start, end)
+                        self.strike(vk)
+                except Exception as e:
+                    # Nothing could advance past this point, so stop instead of leaving run() waiting forever
+                    self.log.error(f'Catchup failed at block #{self.next_block}: {e}')
+                    self.failed = True
+
+                self.condition.notify_all()
+
+        # Wake the others so they can pick up anything this peer left behind
+        async with self.condition:
+            self.condition.notify_all()
+
+    async def run(self, start, latest):
+        if start > latest or len(self.peers) == 0:
+            return start - 1
+
+        self.condition = asyncio.Condition()
+
+        self.fresh = self.make_chunks(start, latest)
+        self.ends = {s: e for s, e in self.fresh}
+        self.next_block = start
+        self.latest = latest
+        self.live_peers = set(self.peers.keys())
+
+        self.log.info(f'Catching up blocks {start}-{latest} from {len(self.peers)} masternode(s).')
+
+        workers = [asyncio.ensure_future(self.worker(vk, ip)) for vk, ip in self.peers.items()]
+
+        async with self.condition:
+            while not self.done:
+                await self.condition.wait()
+
+        # Requests still outstanding to slow peers are no longer needed
+        for w in workers:
+            w.cancel()
+
+        await asyncio.gather(*workers, return_exceptions=True)
+
+        if self.next_block <= self.latest:
+            self.log.error(f'Catchup stopped at block #{self.next_block - 1} of {self.latest}.')
+
+        return self.next_block - 1
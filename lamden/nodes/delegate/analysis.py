@@ -0,0 +1,239 @@
+import ast
+
+from lamden.logger.base import get_logger
+from lamden.nodes.delegate import scheduler
+
+log = get_logger('ANALYSIS')
+
+'''
+Derives access templates for a contract from its source without running it.
+
+For every exported function, each Hash subscript and Variable get / set is turned in to a template when its key is made
+only of the function arguments, ctx.caller, ctx.signer and string constants, following simple local assignments like
+sender = ctx.caller. Private functions called with those values are followed as well. Anything else, like keys computed
+at runtime, .all() scans or calls in to other contracts, is left out and is caught by read validation instead.
+
+Works on both submitted source and the compiled code stored under __code__, where the names of private functions and
+state variables start with __.
+'''
+
+ORM_CLASSES = {'Hash', 'Variable', 'ForeignHash', 'ForeignVariable'}
+EXPORT_DECORATORS = {'export', '__export'}
+CALLER_ATTRIBUTES = {'caller', 'signer'}
+
+MAX_DEPTH = 4
+
+
+def string_value(node):
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if type(node).__name__ == 'Str':
+        return node.s
+    return None
+
+
+def subscript_index(node: ast.Subscript):
+    index = node.slice
+    if type(index).__name__ == 'Index':
+        index = index.value
+
+    if isinstance(index, ast.Tuple):
+        return index.elts
+
+    return [index]
+
+
+def decorator_name(node):
+    if isinstance(node, ast.Call):
+        node = node.func
+    return node.id if isinstance(node, ast.Name) else None
+
+
+def is_exported(function: ast.FunctionDef):
+    return any(decorator_name(d) in EXPORT_DECORATORS for d in function.decorator_list)
+
+
+def state_variables(contract, tree: ast.Module):
+    # name in code -> (kind, key base, writable)
+    variables = {}
+
+    for node in tree.body:
+        if not isinstance(node, ast.Assign) or len(node.targets) != 1 or not isinstance(node.targets[0], ast.Name):
+            continue
+
+        call = node.value
+        if not isinstance(call, ast.Call) or not isinstance(call.func, ast.Name) or call.func.id not in ORM_CLASSES:
+            continue
+
+        keywords = {k.arg: string_value(k.value) for k in call.keywords}
+        name = keywords.get('name') or node.targets[0].id
+
+        if call.func.id.startswith('Foreign'):
+            if keywords.get('foreign_contract') is None or keywords.get('foreign_name') is None:
+                continue
+            base = f'{keywords["foreign_contract"]}.{keywords["foreign_name"]}'
+        else:
+            base = f'{keywords.get("contract") or contract}.{name}'
+
+        kind = 'hash' if call.func.id.endswith('Hash') else 'variable'
+        variables[node.targets[0].id] = (kind, base, not call.func.id.startswith('Foreign'))
+
+    return variables
+
+
+class FunctionAnalyzer:
+    def __init__(self, variables: dict, functions: dict, reads: set, writes: set, depth=0):
+        self.variables = variables
+        self.functions = functions
+        self.reads = reads
+        self.writes = writes
+        self.depth = depth
+
+        # Local name -> template part
+        self.parts = {}
+
+    def part(self, node):
+        s = string_value(node)
+        if s is not None:
+            return scheduler.VALUE, s
+
+        if isinstance(node, ast.Name):
+            return self.parts.get(node.id)
+
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'ctx' \
+                and node.attr in CALLER_ATTRIBUTES:
+            return scheduler.CALLER, None
+
+        return None
+
+    def add(self, base, parts, read=False, write=False, writable=True):
+        if any(p is None for p in parts):
+            return
+
+        template = (base, tuple(parts))
+
+        if read:
+            self.reads.add(template)
+        if write and writable:
+            self.writes.add(template)
+
+    def run(self, function: ast.FunctionDef, parts: dict):
+        self.parts = dict(parts)
+
+        for statement in function.body:
+            self.visit(statement)
+
+    def visit(self, node):
+        if isinstance(node, ast.Assign):
+            self.visit(node.value)
+            for target in node.targets:
+                self.assign(target, node.value)
+            return
+
+        if isinstance(node, ast.AugAssign):
+            self.visit(node.value)
+            self.access(node.target, read=True, write=True)
+            return
+
+        # Names bound any other way, like loop variables, no longer hold what they did before
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            self.parts.pop(node.id, None)
+            return
+
+        if isinstance(node, (ast.Subscript, ast.Delete)):
+            targets = node.targets if isinstance(node, ast.Delete) else [node]
+            for target in targets:
+                self.access(target, read=isinstance(target.ctx, ast.Load), write=not isinstance(target.ctx, ast.Load))
+            return
+
+        if isinstance(node, ast.Call):
+            self.call(node)
+
+        for child in ast.iter_child_nodes(node):
+            self.visit(child)
+
+    def assign(self, target, value):
+        if isinstance(target, ast.Name):
+            part = self.part(value)
+            if part is not None:
+                self.parts[target.id] = part
+            else:
+                self.parts.pop(target.id, None)
+        elif isinstance(target, ast.Subscript):
+            self.access(target, write=True)
+        else:
+            for child in ast.walk(target):
+                if isinstance(child, ast.Name):
+                    self.parts.pop(child.id, None)
+
+    def access(self, node, read=False, write=False):
+        if not isinstance(node, ast.Subscript):
+            if isinstance(node, ast.Name):
+                self.parts.pop(node.id, None)
+            else:
+                self.visit(node)
+            return
+
+        for index in subscript_index(node):
+            self.visit(index)
+
+        if not isinstance(node.value, ast.Name) or node.value.id not in self.variables:
+            self.visit(node.value)
+            return
+
+        kind, base, writable = self.variables[node.value.id]
+        if kind == 'hash':
+            self.add(base, [self.part(i) for i in subscript_index(node)], read=read, write=write, writable=writable)
+
+    def call(self, node: ast.Call):
+        func = node.func
+
+        # Variable get / set
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id in self.variables:
+            kind, base, writable = self.variables[func.value.id]
+            if kind == 'variable' and func.attr in ('get', 'set'):
+                self.add(base, [], read=func.attr == 'get', write=func.attr == 'set', writable=writable)
+            return
+
+        # Private functions in the same contract
+        if isinstance(func, ast.Name) and func.id in self.functions and self.depth < MAX_DEPTH:
+            function = self.functions[func.id]
+            names = [a.arg for a in function.args.args]
+
+            parts = {}
+            for name, arg in zip(names, node.args):
+                parts[name] = self.part(arg)
+            for keyword in node.keywords:
+                if keyword.arg is not None:
+                    parts[keyword.arg] = self.part(keyword.value)
+
+            analyzer = FunctionAnalyzer(self.variables, self.functions, self.reads, self.writes, self.depth + 1)
+            analyzer.run(function, {k: v for k, v in parts.items() if v is not None})
+
+
+def analyze(contract: str, code: str):
+    # Returns function name -> (read templates, write templates)
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        log.error(f'Could not parse {contract}: {e}')
+        return {}
+
+    variables = state_variables(contract, tree)
+
+    functions = [node for node in tree.body if isinstance(node, ast.FunctionDef)]
+    private = {f.name: f for f in functions if not is_exported(f)}
+
+    templates = {}
+    for function in functions:
+        if not is_exported(function):
+            continue
+
+        reads, writes = set(), set()
+
+        analyzer = FunctionAnalyzer(variables, private, reads, writes)
+        analyzer.run(function, {a.arg: (scheduler.ARG, a.arg) for a in function.args.args})
+
+        templates[function.name] = (reads, writes)
+
+    return templates
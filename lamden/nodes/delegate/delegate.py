@@ -3,20 +3,44 @@ from lamden import router, network
 from lamden.nodes import base
 from lamden.logger.base import get_logger
 import asyncio
+import functools
 import time
+from concurrent.futures import ThreadPoolExecutor
 from lamden.crypto.wallet import verify
+from lamden.crypto import verifier
 from contracting.execution.executor import Executor
 from lamden.crypto import transaction
+from lamden.crypto.canonical import block_from_subblocks
 from contracting.client import ContractingClient
 from lamden import storage
 from collections import defaultdict
 WORK_SERVICE = 'work'
 
+VALIDATION_WORKERS = 4
+
+
+class StateReader:
+    '''
+    Reads committed state straight from the database, so transactions can be validated on other threads while the
+    driver cache is being used to execute the current round.
+    '''
+    def __init__(self, driver):
+        self.driver = driver
+
+    def get_var(self, contract, variable, arguments=[], mark=False):
+        return self.driver.driver.get(self.driver.make_key(contract, variable, arguments))
+
 
 class WorkProcessor(router.Processor):
     def __init__(self, client: ContractingClient, nonces: storage.NonceStorage, debug=True, expired_batch=5,
-                 tx_timeout=5):
+                 tx_timeout=5, validation_workers=VALIDATION_WORKERS):
         self.new_work = defaultdict(list)
+        self.signal = router.Signal()
+
+        # Batches being validated, in the order they arrived from each master
+        self.pending_work = defaultdict(list)
+        self.validators = ThreadPoolExecutor(max_workers=validation_workers)
+        self.verifier = verifier.service
 
         self.log = get_logger('Work Inbox')
         self.log.propagate = debug
@@ -26,6 +50,7 @@ class WorkProcessor(router.Processor):
         self.tx_timeout = tx_timeout
 
         self.client = client
+        self.state = StateReader(client.raw_driver)
         self.nonces = nonces
 
     async def process_message(self, msg):
@@ -44,11 +69,29 @@ class WorkProcessor(router.Processor):
 
         if not verify(vk=msg['sender'], msg=msg['input_hash'], signature=msg['signature']):
             self.log.error(f'Invalidly signed TX Batch received from master {msg["sender"][:8]}')
-            return self.new_work[msg['sender']].append(shim)
+            self.new_work[msg['sender']].append(shim)
+            return self.signal.set()
 
         if int(time.time()) - msg['timestamp'] > self.expired_batch:
             self.log.error(f'Expired TX Batch received from master {msg["sender"][:8]}')
-            return self.new_work[msg['sender']].append(shim)
+            self.new_work[msg['sender']].append(shim)
+            return self.signal.set()
+
+        # Transactions are checked on other threads so the event loop, and execution, keep going in the meantime
+        validated = asyncio.get_event_loop().run_in_executor(self.validators, self.validate_transactions, msg)
+        self.pending_work[msg['sender']].append(validated)
+
+        await asyncio.wait([validated])
+
+        self.release_work(msg['sender'])
+
+    def verify_signatures(self, transactions):
+        # Checks every signature in the batch at once. Valid ones are cached, so checking each transaction after
+        # this does not verify them again.
+        self.verifier.verify_batch(transaction.signed_payloads(transactions))
+
+    def validate_transactions(self, msg):
+        self.verify_signatures(msg['transactions'])
 
         # Add padded!
         # Iterate and delete transactions from list that fail
@@ -58,7 +101,7 @@ class WorkProcessor(router.Processor):
                 transaction.transaction_is_valid(
                     transaction=tx,
                     expected_processor=msg['sender'],
-                    client=self.client,
+                    client=self.state,
                     nonces=self.nonces,
                     strict=False,
                     timeout=self.expired_batch + self.tx_timeout
@@ -70,28 +113,48 @@ class WorkProcessor(router.Processor):
         # Replace transactions with ones that do not pass.
         msg['transactions'] = good_transactions
 
-        self.new_work[msg['sender']].append(msg)
-        self.log.info(f'{msg["sender"][:8]} has {len(self.new_work[msg["sender"]])} batches of work to do.')
+        return msg
+
+    def release_work(self, sender):
+        # A batch is only handed over once every batch that arrived before it from the same master has been
+        pending = self.pending_work[sender]
+        while len(pending) > 0 and pending[0].done():
+            validated = pending.pop(0)
 
-    async def gather_transaction_batches(self, masters: list, timeout=10):
+            if validated.exception() is not None:
+                self.log.error(f'Could not validate TX Batch from {sender[:8]}: {validated.exception()}')
+                continue
+
+            self.new_work[sender].append(validated.result())
+            self.signal.set()
+            self.log.info(f'{sender[:8]} has {len(self.new_work[sender])} batches of work to do.')
+
+    def stop(self):
+        self.validators.shutdown(wait=False)
+
+    async def gather_transaction_batches(self, masters: list, timeout=10, on_batch=None):
         # Wait until the queue is filled before starting timeout
         self.masters = masters
 
-        ready = False
-        while not ready:
-            for master in masters:
-                if len(self.new_work[master]) > 0:
-                    ready = True
-            await asyncio.sleep(0)
+        while not any(len(self.new_work[master]) > 0 for master in masters):
+            await self.signal.wait()
 
         # Now wait until the rest come in or the timeout is triggered
         next_work = []
         start = time.time()
-        while len(next_work) < len(masters) and time.time() - start < timeout:
+        while True:
             for master in masters:
                 if len(self.new_work[master]) > 0:
                     next_work.append(self.new_work[master].pop(0))
-            await asyncio.sleep(0)
+
+                    if on_batch is not None:
+                        on_batch(next_work[-1])
+
+            remaining = timeout - (time.time() - start)
+            if len(next_work) >= len(masters) or remaining <= 0:
+                break
+
+            await self.signal.wait(timeout=remaining)
 
         return next_work
 
@@ -186,19 +249,72 @@ class WorkProcessor(router.Processor):
 #         return w
 
 
+def predict_block(results: list, previous_hash: str, block_num: int):
+    # The block the masternodes make from these subblock contenders if every delegate agrees with them
+    subblocks = [{
+        'input_hash': sbc['input_hash'],
+        'transactions': sbc['transactions'],
+        'merkle_leaves': sbc['merkle_tree']['leaves'],
+        'subblock': sbc['subblock'],
+        'signatures': []
+    } for sbc in results]
+
+    return block_from_subblocks(subblocks, previous_hash=previous_hash, block_num=block_num)
+
+
+def result_writes(results: list):
+    return {
+        delta['key']: delta['value']
+        for sbc in results
+        for tx in sbc['transactions']
+        for delta in (tx['state'] or [])
+    }
+
+
+def rebase(driver, results: list):
+    # The cache still holds every write of failed transactions, which the block only carries the stamp deductions
+    # of. Leaves just the writes the block will carry, so the next work runs on the state the block will make.
+    driver.clear_pending_state()
+    driver.cache.update(result_writes(results))
+
+
 class Delegate(base.Node):
-    def __init__(self, parallelism=4, *args, **kwargs):
+    def __init__(self, parallelism=4, workers=0, shadow=False, subblocks=False, pipelined=False, *args, **kwargs):
+        # Shadow mode checks the worker executor against serial execution, so there is nothing to check without one
+        if shadow and workers <= 0:
+            raise ValueError('Shadow mode needs at least one execution worker.')
 
         super().__init__(*args, **kwargs)
 
         # Number of core / processes we push to
         self.parallelism = parallelism
         self.executor = Executor(driver=self.driver)
-        self.transaction_executor = execution.SerialExecutor(executor=self.executor)
+
+        # Transactions are run in worker processes if there are any, either grouped by predicted conflicts or by
+        # subblock. In shadow mode they are also run serially, and only the serial results are sent.
+        if workers > 0:
+            executor_class = execution.SubblockExecutor if subblocks else execution.ConflictResolutionExecutor
+            self.transaction_executor = executor_class(executor=self.executor, workers=workers)
+
+            if shadow:
+                self.transaction_executor = execution.ShadowExecutor(
+                    serial=execution.SerialExecutor(executor=self.executor),
+                    candidate=self.transaction_executor
+                )
+        else:
+            self.transaction_executor = execution.SerialExecutor(executor=self.executor)
 
         self.work_processor = WorkProcessor(client=self.client, nonces=self.nonces)
         self.router.add_service(WORK_SERVICE, self.work_processor)
 
+        # Work is executed on its own thread so the next round can be received and validated at the same time
+        self.execution_thread = ThreadPoolExecutor(max_workers=1)
+
+        # In pipelined mode, the next round's work is executed before the block for the last one arrives, on top of
+        # the block predicted from the last round's results. Holds (predicted block, results) while that block is out.
+        self.pipelined = pipelined
+        self.unconfirmed = None
+
         self.upgrade_manager.node_type = 'delegate'
 
         self.log = get_logger(f'Delegate {self.wallet.vk_pretty[4:12]}')
@@ -210,12 +326,18 @@ class Delegate(base.Node):
         members = self.driver.get_var(contract='delegates', variable='S', arguments=['members'])
         assert self.wallet.verifying_key in members, 'You are not a delegate!'
 
+        # Workers are forked now so the first block does not wait for them
+        self.transaction_executor.start()
+
         asyncio.ensure_future(self.run())
 
     async def acquire_work(self):
         current_masternodes = self.client.get_var(contract='masternodes', variable='S', arguments=['members'])
 
-        w = await self.work_processor.gather_transaction_batches(masters=current_masternodes)
+        w = await self.work_processor.gather_transaction_batches(
+            masters=current_masternodes,
+            on_batch=self.speculate
+        )
 
         self.log.info(f'Got {len(w)} batch(es) of work')
 
@@ -224,6 +346,28 @@ class Delegate(base.Node):
 
         return work.filter_work(w)
 
+    def execution_point(self):
+        # The block hash and height the next work is executed on top of
+        if self.unconfirmed is not None:
+            predicted, _ = self.unconfirmed
+            return predicted['hash'], predicted['number']
+
+        return self.current_hash, self.current_height
+
+    def speculate(self, tx_batch):
+        # Start on each batch as soon as it arrives instead of waiting for the slowest master. Runs on the execution
+        # thread, so execute_work starts once every batch already received has been speculated.
+        previous_block_hash, current_height = self.execution_point()
+
+        asyncio.get_event_loop().run_in_executor(self.execution_thread, functools.partial(
+            self.transaction_executor.speculate_batch,
+            driver=self.driver,
+            tx_batch=tx_batch,
+            previous_block_hash=previous_block_hash,
+            current_height=current_height,
+            stamp_cost=self.client.get_var(contract='stamp_cost', variable='S', arguments=['value'])
+        ))
+
     async def update_sockets(self):
         mns = self.get_masternode_peers()
         iterator = iter(mns.items())
@@ -236,7 +380,8 @@ class Delegate(base.Node):
             wallet=self.wallet,
             ctx=self.ctx,
             vk=vk,
-            ip=ip
+            ip=ip,
+            pool=self.pool
         )
 
         if peers is not None:
@@ -249,6 +394,41 @@ class Delegate(base.Node):
 
         await self.update_sockets()
 
+    async def execute(self, work, previous_block_hash, current_height):
+        results = await asyncio.get_event_loop().run_in_executor(self.execution_thread, functools.partial(
+            self.transaction_executor.execute_work,
+            driver=self.driver,
+            work=work,
+            wallet=self.wallet,
+            previous_block_hash=previous_block_hash,
+            current_height=current_height,
+            stamp_cost=self.client.get_var(contract='stamp_cost', variable='S', arguments=['value'])
+        ))
+
+        await router.secure_multicast(
+            msg=results,
+            service=base.CONTENDER_SERVICE,
+            cert_dir=self.socket_authenticator.cert_dir,
+            wallet=self.wallet,
+            peer_map=self.get_masternode_peers(),
+            ctx=self.ctx,
+            pool=self.pool
+        )
+
+        self.log.info(f'Work execution complete. Sending to masters.')
+
+        return results
+
+    async def run_ahead_of(self, results):
+        # Keeps the results in the cache, uncommitted, and predicts the block they will be in. Runs on the execution
+        # thread so it does not change the cache under a batch being speculated.
+        await asyncio.get_event_loop().run_in_executor(self.execution_thread, rebase, self.driver, results)
+
+        self.unconfirmed = (
+            predict_block(results, previous_hash=self.current_hash, block_num=self.current_height + 1),
+            results
+        )
+
     async def process_new_work(self):
         if len(self.get_masternode_peers()) == 0:
             return
@@ -262,35 +442,71 @@ class Delegate(base.Node):
             block = self.new_block_processor.q.pop(0)
             self.process_new_block(block)
 
-        results = self.transaction_executor.execute_work(
-            driver=self.driver,
-            work=filtered_work,
-            wallet=self.wallet,
-            previous_block_hash=self.current_hash,
-            current_height=self.current_height,
-            stamp_cost=self.client.get_var(contract='stamp_cost', variable='S', arguments=['value'])
-        )
+        results = await self.execute(filtered_work, self.current_hash, self.current_height)
 
-        await router.secure_multicast(
-            msg=results,
-            service=base.CONTENDER_SERVICE,
-            cert_dir=self.socket_authenticator.cert_dir,
-            wallet=self.wallet,
-            peer_map=self.get_masternode_peers(),
-            ctx=self.ctx
-        )
+        self.new_block_processor.clean(self.current_height)
 
-        self.log.info(f'Work execution complete. Sending to masters.')
+        if self.pipelined:
+            await self.run_ahead_of(results)
+        else:
+            self.driver.clear_pending_state()
+
+    async def process_work_ahead(self):
+        # Pipelined mode. The next round's work is gathered while the block for the last round is being made. If it
+        # arrives first, it is executed on top of the last round's results and sent straight away. Once the block
+        # arrives, the results are kept if it is the predicted block, otherwise the work is executed again on top of
+        # the block that was made.
+        predicted, results = self.unconfirmed
+
+        # Workers read the database, which does not have the last round's results yet
+        self.transaction_executor.set_overlay(result_writes(results))
+
+        work_task = asyncio.ensure_future(self.acquire_work())
+        block_task = asyncio.ensure_future(self.new_block_processor.wait_for_next_nbn())
+
+        ahead = None
+        try:
+            await asyncio.wait([work_task, block_task], return_when=asyncio.FIRST_COMPLETED)
+
+            if not block_task.done():
+                work = work_task.result()
+                ahead = (work, await self.execute(work, predicted['hash'], predicted['number']))
+        finally:
+            self.transaction_executor.set_overlay({})
+
+        # Clears the cache, including anything executed ahead
+        self.process_new_block(await block_task)
+        self.unconfirmed = None
+
+        await self.update_sockets()
+
+        if ahead is None:
+            work = await work_task
+            results = await self.execute(work, self.current_hash, self.current_height)
+        else:
+            work, results = ahead
+
+            # The results are put back in the cache by run_ahead_of
+            if self.current_hash != predicted['hash']:
+                self.log.error(f'Block #{predicted["number"]} is not the predicted block. Executing the next work again.')
+                results = await self.execute(work, self.current_hash, self.current_height)
 
         self.new_block_processor.clean(self.current_height)
-        self.driver.clear_pending_state()
+        await self.run_ahead_of(results)
 
     async def loop(self):
         self.log.info('=== ENTERING PROCESS NEW WORK STATE ===')
         self.upgrade_manager.version_check(constitution=self.make_constitution())
 
+        if self.unconfirmed is not None:
+            await self.process_work_ahead()
+            return
+
         await self.process_new_work()
 
+        if self.unconfirmed is not None:
+            return
+
         self.log.info('=== ENTERING BLOCK CONFIRMATION STATE ===')
         await self.wait_for_new_block_confirmation()
 
@@ -300,4 +516,7 @@ class Delegate(base.Node):
             await self.loop()
 
     def stop(self):
-        self.router.stop()
+        super().stop()
+        self.transaction_executor.stop()
+        self.work_processor.stop()
+        self.execution_thread.shutdown(wait=False)
@@ -1,34 +1,25 @@
 from contracting.execution.executor import Executor
 from contracting.stdlib.bridge.time import Datetime
 from contracting.db.encoder import encode, safe_repr
-from lamden.crypto.canonical import tx_hash_from_tx, format_dictionary, merklize
+from contracting.db.driver import ContractDriver
+from lamden.crypto.canonical import tx_hash_from_tx, format_dictionary, merklize, merklize_hashes
+from lamden.nodes.delegate import scheduler, analysis
 from lamden.logger.base import get_logger
 from datetime import datetime
 
 import multiprocessing as mp
 import copy
-from time import time, sleep
-import queue
+import hashlib
+from multiprocessing.connection import wait
+from time import time
 
 log = get_logger('EXE')
 
 __N_WORKER_PER_DELEGATES__ = 4
-__N_DELEGATES__ = 2
-__N_WORKER__ = __N_WORKER_PER_DELEGATES__ * __N_DELEGATES__
 
-
-PoolExecutor = None
-stop_cmd = None
-pool = []
-busy_pool = []
-
-N_TEST = 8
-WORKER_SLEEP = 0.0001
-RESULT_SLEEP = 0.01
-POOL_WAIT_SLEEP = 0.01
-
-TX_RERUN_SLEEP = 1
-N_TRY_PER_TX = 3
+# Longest a worker can take on a chunk before it is considered stuck and restarted
+WORKER_TIMEOUT = 10
+WORKER_STOP_TIMEOUT = 1
 
 
 class TransactionExecutor:
@@ -44,277 +35,23 @@ class TransactionExecutor:
     def execute_work(self, executor, work, wallet, previous_block_hash, current_height=0, stamp_cost=20000, parallelism=4):
         raise NotImplementedError
 
+    def speculate_batch(self, driver, tx_batch, previous_block_hash, current_height=0, stamp_cost=20000):
+        # Called with each batch of work as it arrives, before execute_work is called with all of them
+        pass
 
-class ConflictResolutionExecutor(TransactionExecutor):
-    def __init__(self, workers=8):
-        self.workers = workers
-        self.executor = PoolExecutor
-
-    def execute_tx(self, transaction, stamp_cost, environment: dict = {}, tx_number=0):
-        #global PoolExecutor
-        #executor = PoolExecutor
-        output = self.executor.execute(
-            sender=transaction['payload']['sender'],
-            contract_name=transaction['payload']['contract'],
-            function_name=transaction['payload']['function'],
-            stamps=transaction['payload']['stamps_supplied'],
-            stamp_cost=stamp_cost,
-            kwargs=transaction['payload']['kwargs'],
-            environment=environment,
-            auto_commit=False
-        )
-        log.debug(output)
-
-        tx_hash = tx_hash_from_tx(transaction)
-
-        writes = [{'key': k, 'value': v} for k, v in output['writes'].items()]
-
-        tx_output = {
-            'hash': tx_hash,
-            'transaction': transaction,
-            'status': output['status_code'],
-            'state': writes,
-            'stamps_used': output['stamps_used'],
-            'result': safe_repr(output['result']),
-            'tx_number': tx_number
-        }
-        tx_output = format_dictionary(tx_output)
-        self.executor.driver.pending_writes.clear()  # add
-        return tx_output
-
-    def generate_environment(self, driver, timestamp, input_hash, bhash='0' * 64, num=1):
-        now = Datetime._from_datetime(
-            datetime.utcfromtimestamp(timestamp)
-        )
-
-        return {
-            'block_hash': bhash,
-            'block_num': num,
-            '__input_hash': input_hash,  # Used for deterministic entropy for random games
-            'now': now
-        }
-
-    def start_pool(self):
-        global stop_cmd
-        stop_cmd = mp.Value('i', 0)
-
-        for i in range(__N_WORKER__):
-            queue_in1 = mp.Queue()
-            queue_out1 = mp.Queue()
-            p = ProcessThread(queue_in1, queue_out1, stop_cmd, executor=self)
-            pool.append(p)
-            busy_pool.append(0)
-            p.start()
-
-        for i in range(5):
-            n_proc = 0
-            for i in range(__N_WORKER__):
-                if pool[i].is_alive():
-                    n_proc += 1
-            if n_proc == __N_WORKER__:
-                log.info(f" Workers started OK")
-                return True
-            sleep(1)
-        log.error(f" Can't start workers")
-        return False
+    def set_overlay(self, overlay: dict):
+        # Writes from a block that is not in the database yet, which the next work runs on top of
+        pass
 
-    def execute_tx_batch(self, driver, batch, timestamp, input_hash, stamp_cost, bhash='0' * 64, num=1):
-
-        environment = self.generate_environment(driver, timestamp, input_hash, bhash, num)
-        set_pool_executor(self.executor)
-
-        global pool
-        if len(pool) == 0:
-            self.start_pool()
-            log.debug(f'Initialyze pool {len(pool)}')
+    def start(self):
+        pass
 
-        work_pool, active_workers = self.get_pool(len(batch['transactions']))
-        i = 0
-        s = time()
-        global result_list2
-        result_list2 = []
-        log.debug(f"Start Pool len={active_workers}  prc={work_pool}")
-
-        for transaction in batch['transactions']:
-            log.debug(f'Transaction {i}   {type(self.executor)}')
-            it = (transaction, stamp_cost, environment, i)
-            i_prc = work_pool[i % active_workers]
-            pool[i_prc].q_in.put(it)
-            i += 1
+    def stop(self):
+        pass
 
-        N_tx = i
-        result_list2 = self.wait_tx_result(N_tx, work_pool)
-        self.free_pool(work_pool)
-
-        log.debug(f"End of pool. result_list={result_list2}")
-
-        tx_data = copy.deepcopy(result_list2)
-        result_list2 = []
-        tx_done_ok = [tx['tx_number'] for tx in tx_data]
-        tx_bad = [tx['tx_number'] for tx in tx_data if tx['status'] != 0]
-        log.debug(f"tx_data={len(tx_data)}  tx_done_ok={tx_done_ok}  tx_bad={tx_bad} duration= {time() - s}")
-
-        if len(tx_bad) > 0:
-            self.free_pool(work_pool)
-            work_pool, active_workers = self.get_pool(len(tx_bad))
-
-            log.debug(f'Bad transactions {len(tx_bad)}. Try to rerun {active_workers}  {work_pool}')
-            sleep(TX_RERUN_SLEEP)
-            i = 0
-            for transaction in batch['transactions']:
-                if i in tx_bad:
-                    log.debug(f'rerun Transaction {i}')
-                    it = (transaction, stamp_cost, environment, i)
-                    i_prc = work_pool[i % active_workers]
-                    pool[i_prc].q_in.put(it)
-
-                i += 1
-            N_tx_rerun = i
-            result_list2 = self.wait_tx_result(N_tx_rerun, work_pool)
-            log.debug(f"End of rerun. result_list={result_list2}")
-            self.free_pool(work_pool)
-
-            for r in result_list2:
-                tx_data.append(r)
 
-        return tx_data
-
-    def execute_work(self, driver, work, wallet, previous_block_hash, current_height=0, stamp_cost=20000,
-                     parallelism=4):
-        # Assume single threaded, single process for now.
-        subblocks = []
-        i = 0
-
-        for tx_batch in work:
-            results = self.execute_tx_batch(
-                driver=driver,
-                batch=tx_batch,
-                timestamp=tx_batch['timestamp'],
-                input_hash=tx_batch['input_hash'],
-                stamp_cost=stamp_cost,
-                bhash=previous_block_hash,
-                num=current_height
-            )
-
-            if len(results) > 0:
-                merkle = merklize([encode(r).encode() for r in results])
-                proof = wallet.sign(merkle[0])
-            else:
-                merkle = merklize([bytes.fromhex(tx_batch['input_hash'])])
-                proof = wallet.sign(tx_batch['input_hash'])
-
-            merkle_tree = {
-                'leaves': merkle,
-                'signature': proof
-            }
-
-            sbc = {
-                'input_hash': tx_batch['input_hash'],
-                'transactions': results,
-                'merkle_tree': merkle_tree,
-                'signer': wallet.verifying_key,
-                'subblock': i % parallelism,
-                'previous': previous_block_hash
-            }
-
-            sbc = format_dictionary(sbc)
-
-            subblocks.append(sbc)
-            i += 1
-
-        return subblocks
-
-    def get_pool(self, n_needed):
-        rez_pool = {}
-        cnt = 0
-        n_step = 0
-        if n_needed > 0:
-            if n_needed > __N_WORKER_PER_DELEGATES__:
-                n_needed = __N_WORKER_PER_DELEGATES__
-            while n_step < 3:
-                for i in range(__N_WORKER__):
-                    if busy_pool[i] == 0:
-                        busy_pool[i] = 1
-                        rez_pool[cnt] = i
-                        cnt += 1
-                    if cnt >= n_needed:
-                        break
-                if cnt > 0:
-                    break
-                else:
-                    sleep(POOL_WAIT_SLEEP)
-                    n_step += 1
-        return rez_pool, cnt
-
-    def free_pool(self, rez_pool):
-        for k, v in rez_pool.items():
-            busy_pool[v] = 0
-
-    def stop_pool(self):
-        if pool is None:
-            return
-        global stop_cmd
-        stop_cmd.value = 1
-        for i in range(__N_WORKER__):
-            pool[i].join()
-        log.info(f" Workers stopped OK")
-
-    def wait_tx_result(self, N_tx, work_pool):
-        active_workers = len(work_pool)
-        kk = 0
-        k_step = 0
-        k_wait = N_tx * N_TRY_PER_TX
-        rez = []
-        while k_step < k_wait:
-            for i_tx in range(N_tx):
-                try:
-                    k_step += 1
-                    i_prc = work_pool[i_tx % active_workers]
-                    r = pool[i_prc].q_out.get_nowait()
-                    if r is not None:
-                        rez.append(r)
-                        kk += 1
-                except queue.Empty:
-                    sleep(RESULT_SLEEP)
-            if kk >= N_tx:
-                break
-        return rez
-
-
-class ProcessThread(mp.Process):
-    def __init__(self, q_in, q_out, s_stop, executor: ConflictResolutionExecutor):
-        super(ProcessThread, self).__init__()
-        self.q_in = q_in
-        self.q_out = q_out
-        self.s_stop = s_stop
-        self.executor = executor
-
-    def run(self):
-        while 1:
-            if (int(self.s_stop.value) == 1):
-                # print("Process stopped")
-                break
-            # print("Process run")
-            try:
-                x = self.q_in.get_nowait()
-                if x is not None:
-                    # work()
-                    try:
-                        tx_input = x
-                        output = self.executor.execute_tx(tx_input[0], tx_input[1], environment= tx_input[2], tx_number=tx_input[3])
-                        self.q_out.put(output)
-                    except Exception as err:
-                        log.error(f"Worker stopped after exception={err}")
-                        break
-            except queue.Empty:
-                sleep(WORKER_SLEEP)
-        # print("Process exit")
-        return
-
-
-def set_pool_executor(executor: Executor):
-    global PoolExecutor
-    PoolExecutor = executor
+def leaf_hash(tx_output: dict):
+    return hashlib.sha3_256(encode(tx_output).encode()).digest()
 
 
 class SerialExecutor(TransactionExecutor):
@@ -322,6 +59,13 @@ class SerialExecutor(TransactionExecutor):
         self.executor = executor
 
     def execute_tx(self, transaction, stamp_cost, environment: dict = {}):
+        tx_output, _ = self.execute_tx_and_writes(transaction, stamp_cost, environment)
+        return tx_output
+
+    def execute_tx_and_writes(self, transaction, stamp_cost, environment: dict = {}):
+        # Returns the output and every write the transaction left in the driver cache. Failed transactions only
+        # report the stamp deduction in their output, but later transactions still see all of their writes.
+
         # Deserialize Kwargs. Kwargs should be serialized JSON moving into the future for DX.
 
         output = self.executor.execute(
@@ -382,7 +126,10 @@ class SerialExecutor(TransactionExecutor):
 
         self.executor.driver.pending_writes.clear()  # add
 
-        return tx_output
+        return tx_output, output['writes']
+
+    def leaves(self, results: list):
+        return [leaf_hash(r) for r in results]
 
     def generate_environment(self, driver, timestamp, input_hash, bhash='0' * 64, num=1):
         now = Datetime._from_datetime(
@@ -427,7 +174,7 @@ class SerialExecutor(TransactionExecutor):
             )
 
             if len(results) > 0:
-                merkle = merklize([encode(r).encode() for r in results])
+                merkle = merklize_hashes(self.leaves(results))
                 proof = wallet.sign(merkle[0])
             else:
                 merkle = merklize([bytes.fromhex(tx_batch['input_hash'])])
@@ -453,3 +200,612 @@ class SerialExecutor(TransactionExecutor):
             i += 1
 
         return subblocks
+
+
+class TrackingDriver(ContractDriver):
+    '''
+    Records the value of every key a transaction reads before writing it, so the transaction can later be checked
+    against the state it would have seen if it had run serially.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.observed = {}
+        self.range_read = False
+
+    def start_tracking(self, overlay: dict):
+        self.clear_pending_state()
+        self.cache.update(overlay)
+        self.observed = {}
+        self.range_read = False
+
+    def get(self, key: str, mark=True):
+        value = super().get(key, mark=mark)
+
+        # Reading back our own write does not depend on anyone else. Deletes are cached as None and fall through to
+        # the database, so those still count.
+        if key not in self.observed and self.pending_writes.get(key) is None:
+            self.observed[key] = value
+
+        return value
+
+    def items(self, prefix=''):
+        # Cannot tell which keys a prefix scan depends on, so these transactions are always rerun
+        self.range_read = True
+        return super().items(prefix)
+
+
+def speculate(executor: SerialExecutor, transaction, stamp_cost, environment, overlay: dict):
+    # Runs a transaction on top of the overlay and returns what it read as well as what it did
+    driver = executor.executor.driver
+    driver.start_tracking(overlay)
+
+    tx_output, writes = executor.execute_tx_and_writes(transaction, stamp_cost, environment)
+
+    return {
+        'output': tx_output,
+        'writes': writes,
+        'reads': driver.observed,
+        'range_read': driver.range_read
+    }
+
+
+def same_value(a, b):
+    if a is b:
+        return True
+
+    if type(a) != type(b) or a != b:
+        return False
+
+    if a is None or type(a) in (str, int, bool):
+        return True
+
+    # Containers can hold values that compare equal but encode differently, like 1 and Decimal(1)
+    return encode(a) == encode(b)
+
+
+def executor_settings(executor: Executor):
+    # Everything besides the driver that changes what a transaction does, so workers run it the same way
+    return {
+        'metering': executor.metering,
+        'currency_contract': executor.currency_contract,
+        'balances_hash': executor.balances_hash,
+        'bypass_privates': executor.bypass_privates
+    }
+
+
+def worker_loop(connection, backend, make_driver=None, settings=None):
+    # Workers inherit the database driver when they are forked unless they are told how to make their own
+    driver = make_driver() if make_driver is not None else TrackingDriver(driver=backend)
+    worker = SerialExecutor(executor=Executor(driver=driver, **(settings or {})))
+
+    while True:
+        try:
+            chunk = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+
+        if chunk is None:
+            return
+
+        groups, stamp_cost, overlay = chunk
+
+        results = []
+        for group in groups:
+            # Transactions in a group depend on each other, so each one runs on top of the ones before it
+            state = dict(overlay)
+
+            for i, transaction, environment in group:
+                try:
+                    result = speculate(worker, transaction, stamp_cost, environment, state)
+                except Exception as e:
+                    # Left out of the results so it is run again by the caller
+                    log.error(f'Worker could not run transaction {i}: {e}')
+                    continue
+
+                state.update(result['writes'])
+
+                # The caller already has the transaction, so only its leaf hash and the rest of the output are sent
+                # back. The output is sorted, and 'transaction' is its last key, so putting it back does not change
+                # the encoding.
+                result['leaf'] = leaf_hash(result['output'])
+                del result['output']['transaction']
+
+                result['index'] = i
+                results.append(result)
+
+        connection.send(results)
+
+
+class WorkerPool:
+    '''
+    Long lived worker processes that speculate transactions. Each worker blocks on its own pipe until it is sent a
+    chunk of transactions, so idle workers use no CPU, and the caller wakes as soon as any worker replies or dies.
+    A worker that dies or gets stuck is restarted. Its transactions are missing from the results and get rerun.
+    '''
+    def __init__(self, backend, workers=__N_WORKER_PER_DELEGATES__, make_driver=None, settings=None,
+                 timeout=WORKER_TIMEOUT):
+        self.backend = backend
+        self.workers = workers
+        self.make_driver = make_driver
+
+        # Executor settings from executor_settings, so workers run transactions the same way as the caller
+        self.settings = settings
+        self.timeout = timeout
+
+        self.processes = []
+        self.connections = []
+
+        self.restarts = 0
+
+    @property
+    def running(self):
+        return len(self.processes) > 0
+
+    def start_worker(self):
+        connection, child = mp.Pipe()
+
+        p = mp.Process(target=worker_loop, args=(child, self.backend, self.make_driver, self.settings),
+                       daemon=True)
+        p.start()
+
+        child.close()
+
+        return p, connection
+
+    def start(self):
+        if self.running:
+            return
+
+        for _ in range(self.workers):
+            p, connection = self.start_worker()
+            self.processes.append(p)
+            self.connections.append(connection)
+
+        log.info(f'Started {self.workers} workers.')
+
+    def restart(self, w):
+        self.kill(w)
+        self.processes[w], self.connections[w] = self.start_worker()
+        self.restarts += 1
+
+    def kill(self, w):
+        p = self.processes[w]
+        if p.is_alive():
+            p.terminate()
+        p.join()
+
+        self.connections[w].close()
+
+    def send(self, w, chunk):
+        try:
+            self.connections[w].send(chunk)
+        except (BrokenPipeError, OSError):
+            log.error(f'Worker {w} died. Restarting.')
+            self.restart(w)
+            self.connections[w].send(chunk)
+
+    def receive(self, w, results: dict):
+        try:
+            for result in self.connections[w].recv():
+                results[result['index']] = result
+            return True
+        except (EOFError, OSError):
+            return False
+
+    def speculate(self, transactions: list, stamp_cost, environments: list, overlay: dict, groups=None):
+        if not self.running:
+            self.start()
+
+        # Without groups every transaction is assumed to be independent
+        if groups is None:
+            groups = [[i] for i in range(len(transactions))]
+
+        # Transactions from the same batch share an environment object, which is only pickled once per chunk
+        chunks = [
+            [[(i, transactions[i], environments[i]) for i in group] for group in chunk]
+            for chunk in scheduler.assign(groups, self.workers)
+        ]
+
+        waiting = {}
+        for w, chunk in enumerate(chunks):
+            self.send(w, (chunk, stamp_cost, overlay))
+            waiting[w] = self.connections[w]
+
+        results = {}
+        deadline = time() + self.timeout
+
+        while len(waiting) > 0:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+
+            sentinels = {self.processes[w].sentinel: w for w in waiting}
+            ready = wait(list(waiting.values()) + list(sentinels.keys()), timeout=remaining)
+
+            for w, connection in list(waiting.items()):
+                if connection in ready or self.processes[w].sentinel in ready:
+                    # A worker that replied and then died still has its results in the pipe
+                    if not (connection.poll() and self.receive(w, results)):
+                        log.error(f'Worker {w} died. Restarting.')
+                        self.restart(w)
+
+                    waiting.pop(w)
+
+        for w in waiting:
+            log.error(f'Worker {w} did not finish in {self.timeout}s. Restarting.')
+            self.restart(w)
+
+        return results
+
+    def stop(self):
+        for connection in self.connections:
+            try:
+                connection.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+
+        for w, p in enumerate(self.processes):
+            p.join(WORKER_STOP_TIMEOUT)
+            self.kill(w)
+
+        self.processes = []
+        self.connections = []
+
+
+class ConflictResolutionExecutor(SerialExecutor):
+    '''
+    Optimistic parallel execution. All the transactions in the work are split in to groups that are predicted to touch
+    the same state. Groups are run by worker processes in parallel against the state before the work, each
+    transaction on top of the ones before it in its group, while recording what it reads and writes. Results are then
+    merged in canonical order: a transaction is kept only if everything it read still has the same value after the
+    transactions before it, otherwise it is run again here on top of them. The output is identical to SerialExecutor.
+    '''
+    def __init__(self, executor: Executor, workers=__N_WORKER_PER_DELEGATES__, make_driver=None):
+        super().__init__(executor=executor)
+        self.pool = WorkerPool(
+            backend=executor.driver.driver,
+            workers=workers,
+            make_driver=make_driver,
+            settings=executor_settings(executor)
+        )
+
+        # Writes that are not in the database yet but that the work runs on top of
+        self.overlay = {}
+
+        # Worker results for the work being executed, by position in the work
+        self.speculative = None
+        self.offset = 0
+
+        # Worker results for batches speculated as they arrived, by (input hash, previous block hash, height)
+        self.early = {}
+
+        # Leaf hashes of the last batch merged
+        self.merged_leaves = None
+
+        # Keys each contract function touches, used to predict conflicts
+        self.access = scheduler.AccessSets()
+        self.analyzed = set()
+
+        self.reruns = 0
+
+    def current_value(self, key):
+        driver = self.executor.driver
+
+        # Same lookup as the driver cache, without metering or marking reads
+        value = driver.cache.get(key)
+        if value is None:
+            value = driver.driver.get(key)
+            driver.cache[key] = value
+
+        return value
+
+    def analyze_contract(self, contract, code=None):
+        # Each contract is analyzed once, the first time it is seen or when it is submitted
+        if contract in self.analyzed and code is None:
+            return
+
+        self.analyzed.add(contract)
+
+        # Read from the database rather than through the cache, since this can run while the cache is being reset
+        if code is None:
+            code = self.executor.driver.driver.get(f'{contract}.__code__')
+
+        if code is None:
+            return
+
+        for function, (reads, writes) in analysis.analyze(contract, code).items():
+            self.access.add(contract, function, reads=reads, writes=writes)
+
+    def reads_match(self, reads: dict):
+        for key, value in reads.items():
+            if not same_value(self.current_value(key), value):
+                return False
+
+        return True
+
+    def make_groups(self, transactions: list, batches: list):
+        return scheduler.make_groups(transactions, self.access)
+
+    def run_speculation(self, batches: list, stamp_cost, overlay: dict):
+        # batches: list of (transactions, environment). Returns worker results by position across all of them.
+        transactions = []
+        environments = []
+        units = []
+
+        for batch_transactions, environment in batches:
+            units.append(list(range(len(transactions), len(transactions) + len(batch_transactions))))
+            transactions.extend(batch_transactions)
+            environments.extend([environment] * len(batch_transactions))
+
+        for contract in {transaction['payload']['contract'] for transaction in transactions}:
+            self.analyze_contract(contract)
+
+        groups = self.make_groups(transactions, units)
+
+        s = time()
+        results = self.pool.speculate(transactions, stamp_cost, environments, overlay, groups=groups)
+
+        log.debug(f'{len(transactions)} transactions in {len(groups)} groups speculated. duration={time() - s}')
+
+        return results
+
+    def speculate(self, batches: list, stamp_cost, early: list = None):
+        # Batches that were already speculated when they arrived are not sent to the workers again
+        if early is None:
+            early = [None] * len(batches)
+
+        results = self.run_speculation([b for b, e in zip(batches, early) if e is None], stamp_cost, self.overlay)
+
+        self.speculative = {}
+        self.offset = 0
+
+        position = 0
+        k = 0
+        for (transactions, _), e in zip(batches, early):
+            for j in range(len(transactions)):
+                if e is not None:
+                    r = e.get(j)
+                else:
+                    r = results.get(k)
+                    k += 1
+
+                if r is not None:
+                    self.speculative[position + j] = r
+
+            position += len(transactions)
+
+    def speculate_batch(self, driver, tx_batch, previous_block_hash, current_height=0, stamp_cost=20000):
+        environment = self.generate_environment(driver, tx_batch['timestamp'], tx_batch['input_hash'],
+                                                previous_block_hash, current_height)
+
+        # Runs on top of the batches that sort before this one and have already arrived. If one that sorts earlier
+        # arrives later, anything in this batch that conflicts with it is rerun during the merge.
+        overlay = dict(self.overlay)
+        for key, (sender, results) in sorted(self.early.items(), key=lambda item: item[1][0]):
+            if key[1:] == (previous_block_hash, current_height) and sender < tx_batch['sender']:
+                for i in sorted(results):
+                    overlay.update(results[i]['writes'])
+
+        results = self.run_speculation([(tx_batch['transactions'], environment)], stamp_cost, overlay)
+
+        self.early[(tx_batch['input_hash'], previous_block_hash, current_height)] = (tx_batch['sender'], results)
+
+    def set_overlay(self, overlay: dict):
+        self.overlay = overlay
+
+    def merge(self, transactions, stamp_cost, environment):
+        results = []
+        leaves = []
+
+        for i, transaction in enumerate(transactions):
+            s = self.speculative.get(self.offset + i)
+
+            if s is not None and not s['range_read'] and self.reads_match(s['reads']):
+                writes = s['writes']
+                self.executor.driver.cache.update(writes)
+
+                tx_output = s['output']
+                tx_output['transaction'] = format_dictionary(transaction)
+                results.append(tx_output)
+                leaves.append(s['leaf'])
+            else:
+                self.reruns += 1
+                tx_output, writes = self.execute_tx_and_writes(transaction, stamp_cost, environment)
+                results.append(tx_output)
+                leaves.append(leaf_hash(tx_output))
+
+            self.access.learn(transaction, reads=s['reads'] if s is not None else (), writes=writes)
+
+            payload = transaction['payload']
+            if payload['contract'] == 'submission' and payload['function'] == 'submit_contract' \
+                    and results[-1]['status'] == 0:
+                self.analyze_contract(payload['kwargs']['name'], code=payload['kwargs']['code'])
+
+        self.offset += len(transactions)
+        self.merged_leaves = leaves
+
+        return results
+
+    def leaves(self, results: list):
+        # Leaves were hashed by the workers, or when the transaction was rerun
+        leaves, self.merged_leaves = self.merged_leaves, None
+
+        if leaves is None or len(leaves) != len(results):
+            return super().leaves(results)
+
+        return leaves
+
+    def execute_tx_batch(self, driver, batch, timestamp, input_hash, stamp_cost, bhash='0' * 64, num=1):
+        environment = self.generate_environment(driver, timestamp, input_hash, bhash, num)
+
+        transactions = batch['transactions']
+
+        # Called on its own rather than from execute_work
+        alone = self.speculative is None
+        if alone:
+            self.speculate([(transactions, environment)], stamp_cost)
+
+        reruns = self.reruns
+        results = self.merge(transactions, stamp_cost, environment)
+
+        log.debug(f'{len(transactions)} transactions merged. {self.reruns - reruns} rerun.')
+
+        if alone:
+            self.speculative = None
+
+        return results
+
+    def execute_work(self, driver, work, wallet, previous_block_hash, current_height=0, stamp_cost=20000,
+                     parallelism=4):
+        # Every batch that was not speculated as it arrived is sent to the workers at once, so batches run in parallel
+        # as well as the transactions in them
+        self.speculate(
+            batches=[
+                (
+                    tx_batch['transactions'],
+                    self.generate_environment(driver, tx_batch['timestamp'], tx_batch['input_hash'],
+                                              previous_block_hash, current_height)
+                )
+                for tx_batch in work
+            ],
+            stamp_cost=stamp_cost,
+            early=[
+                self.early.get((tx_batch['input_hash'], previous_block_hash, current_height), (None, None))[1]
+                for tx_batch in work
+            ]
+        )
+
+        self.early = {}
+
+        try:
+            return super().execute_work(
+                driver=driver,
+                work=work,
+                wallet=wallet,
+                previous_block_hash=previous_block_hash,
+                current_height=current_height,
+                stamp_cost=stamp_cost,
+                parallelism=parallelism
+            )
+        finally:
+            self.speculative = None
+
+    def start(self):
+        self.pool.start()
+
+    def stop(self):
+        self.pool.stop()
+
+
+class SubblockExecutor(ConflictResolutionExecutor):
+    '''
+    Runs each masternode batch as a whole in its own worker against the state before the work, the way it would run
+    if it were the only subblock. Batches are merged in subblock order and transactions that conflict with an earlier
+    subblock are run again.
+    '''
+    def make_groups(self, transactions: list, batches: list):
+        return [batch for batch in batches if len(batch) > 0]
+
+
+def state_diff(expected: list, actual: list):
+    # key -> (expected value, actual value) for every key where the two state lists differ
+    expected = {w['key']: w['value'] for w in expected}
+    actual = {w['key']: w['value'] for w in actual}
+
+    return {
+        k: (expected.get(k), actual.get(k))
+        for k in set(expected) | set(actual)
+        if encode(expected.get(k)) != encode(actual.get(k))
+    }
+
+
+class ShadowExecutor(TransactionExecutor):
+    '''
+    Runs a candidate executor on the same work as a SerialExecutor and logs every place their subblocks differ. The
+    candidate runs first, then the driver is put back the way it was and the serial executor runs. Only the serial
+    results and state are ever kept.
+    '''
+    def __init__(self, serial: SerialExecutor, candidate: TransactionExecutor):
+        self.serial = serial
+        self.candidate = candidate
+
+        self.checked = 0
+        self.divergences = 0
+
+    def compare(self, expected: list, actual: list):
+        diverged = False
+
+        if len(expected) != len(actual):
+            log.error(f'Shadow executor returned {len(actual)} subblocks instead of {len(expected)}.')
+            return True
+
+        for sb, (e, a) in enumerate(zip(expected, actual)):
+            if e['merkle_tree']['leaves'] == a['merkle_tree']['leaves']:
+                continue
+
+            diverged = True
+            log.error(f'Shadow executor diverged in subblock {sb}. '
+                      f'Merkle root {a["merkle_tree"]["leaves"][:1]} != {e["merkle_tree"]["leaves"][:1]}')
+
+            if len(e['transactions']) != len(a['transactions']):
+                log.error(f'{len(a["transactions"])} transactions instead of {len(e["transactions"])}.')
+
+            for i, (e_tx, a_tx) in enumerate(zip(e['transactions'], a['transactions'])):
+                if encode(e_tx) == encode(a_tx):
+                    continue
+
+                log.error(f'Transaction {i} of subblock {sb} diverged. '
+                          f'status={a_tx["status"]}/{e_tx["status"]} '
+                          f'stamps_used={a_tx["stamps_used"]}/{e_tx["stamps_used"]} '
+                          f'writes={state_diff(e_tx["state"], a_tx["state"])}')
+
+        return diverged
+
+    def execute_work(self, driver, work, wallet, previous_block_hash, current_height=0, stamp_cost=20000,
+                     parallelism=4):
+        kwargs = dict(
+            driver=driver,
+            work=work,
+            wallet=wallet,
+            previous_block_hash=previous_block_hash,
+            current_height=current_height,
+            stamp_cost=stamp_cost,
+            parallelism=parallelism
+        )
+
+        # Contracts can change cached values in place, so the snapshot has to be a deep copy
+        cache = copy.deepcopy(driver.cache)
+        pending_writes = copy.deepcopy(driver.pending_writes)
+        reads = set(driver.reads)
+
+        try:
+            candidate = self.candidate.execute_work(**kwargs)
+        except Exception as e:
+            log.error(f'Shadow executor failed: {e}')
+            candidate = None
+
+        driver.cache = cache
+        driver.pending_writes = pending_writes
+        driver.reads = reads
+
+        results = self.serial.execute_work(**kwargs)
+
+        self.checked += 1
+        if candidate is None or self.compare(results, candidate):
+            self.divergences += 1
+        else:
+            log.info(f'Shadow executor matched on {sum(len(sb["transactions"]) for sb in results)} transactions.')
+
+        return results
+
+    def speculate_batch(self, driver, tx_batch, previous_block_hash, current_height=0, stamp_cost=20000):
+        self.candidate.speculate_batch(driver, tx_batch, previous_block_hash, current_height, stamp_cost)
+
+    def set_overlay(self, overlay: dict):
+        self.candidate.set_overlay(overlay)
+
+    def start(self):
+        self.candidate.start()
+
+    def stop(self):
+        self.candidate.stop()
@@ -0,0 +1,167 @@
+'''
+Groups the transactions of a batch by the state they are expected to touch, so transactions that depend on each other
+run one after another in the same worker and everything else runs in parallel.
+
+Keys are predicted from:
+    the sender balance, which every transaction writes to pay for stamps
+    kwargs['to'], as a balance on the contract being called
+    access templates for the contract function, learned from earlier executions
+
+An access template is a key with its arguments replaced by where they came from, e.g. currency.balances:{to} or
+currency.balances:{caller}. Predictions only decide how work is split up. Results are still checked against what each
+transaction actually read, so a wrong prediction costs a rerun, never a different result.
+'''
+
+DELIMITER = ':'
+
+CALLER = 'caller'
+ARG = 'arg'
+VALUE = 'value'
+
+# Templates stop being learned for a function after this many, so functions that touch arbitrary keys stay cheap
+MAX_TEMPLATES = 64
+
+
+def sender_balance(transaction):
+    return f'currency.balances{DELIMITER}{transaction["payload"]["sender"]}'
+
+
+def make_template(key: str, sender: str, kwargs: dict):
+    base, *parts = key.split(DELIMITER)
+
+    template = []
+    for part in parts:
+        if part == sender:
+            template.append((CALLER, None))
+            continue
+
+        name = next((k for k, v in kwargs.items() if str(v) == part), None)
+        if name is not None:
+            template.append((ARG, name))
+        else:
+            template.append((VALUE, part))
+
+    return base, tuple(template)
+
+
+def resolve_template(template, sender: str, kwargs: dict):
+    base, parts = template
+
+    key = [base]
+    for kind, v in parts:
+        if kind == CALLER:
+            key.append(sender)
+        elif kind == ARG:
+            if v not in kwargs:
+                return None
+            key.append(str(kwargs[v]))
+        else:
+            key.append(v)
+
+    return DELIMITER.join(key)
+
+
+class AccessSets:
+    def __init__(self, max_templates=MAX_TEMPLATES):
+        self.max_templates = max_templates
+
+        # (contract, function) -> set of templates
+        self.reads = {}
+        self.writes = {}
+
+    def add(self, contract, function, reads=(), writes=()):
+        for templates, new in ((self.reads, reads), (self.writes, writes)):
+            known = templates.setdefault((contract, function), set())
+            for template in new:
+                if len(known) >= self.max_templates:
+                    break
+                known.add(template)
+
+    def learn(self, transaction, reads=(), writes=()):
+        payload = transaction['payload']
+        sender, kwargs = payload['sender'], payload['kwargs']
+
+        self.add(
+            contract=payload['contract'],
+            function=payload['function'],
+            reads=[make_template(k, sender, kwargs) for k in reads],
+            writes=[make_template(k, sender, kwargs) for k in writes]
+        )
+
+    def resolve(self, templates, transaction):
+        payload = transaction['payload']
+        keys = set()
+
+        for template in templates.get((payload['contract'], payload['function']), ()):
+            key = resolve_template(template, payload['sender'], payload['kwargs'])
+            if key is not None:
+                keys.add(key)
+
+        return keys
+
+    def predict(self, transaction):
+        payload = transaction['payload']
+
+        writes = {sender_balance(transaction)}
+
+        to = payload['kwargs'].get('to')
+        if to is not None:
+            writes.add(f'{payload["contract"]}.balances{DELIMITER}{to}')
+
+        writes |= self.resolve(self.writes, transaction)
+        reads = self.resolve(self.reads, transaction) - writes
+
+        return reads, writes
+
+
+def find(parents, i):
+    while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+    return i
+
+
+def union(parents, a, b):
+    a, b = find(parents, a), find(parents, b)
+    if a != b:
+        parents[max(a, b)] = min(a, b)
+
+
+def make_groups(transactions: list, access: AccessSets):
+    # Transactions are connected if one writes a key the other reads or writes. Keys that are only ever read, like
+    # contract code, do not connect anything.
+    parents = list(range(len(transactions)))
+
+    writers = {}
+    readers = {}
+    for i, transaction in enumerate(transactions):
+        reads, writes = access.predict(transaction)
+
+        for key in writes:
+            writers.setdefault(key, []).append(i)
+        for key in reads:
+            readers.setdefault(key, []).append(i)
+
+    for key, w in writers.items():
+        for i in w[1:] + readers.get(key, []):
+            union(parents, w[0], i)
+
+    groups = {}
+    for i in range(len(transactions)):
+        groups.setdefault(find(parents, i), []).append(i)
+
+    # Each group keeps batch order, which is nonce order for every sender in it
+    return sorted(groups.values(), key=lambda g: g[0])
+
+
+def assign(groups: list, workers: int):
+    # Largest groups first, each to the worker with the least to do
+    chunks = [[] for _ in range(workers)]
+    loads = [0] * workers
+
+    for group in sorted(groups, key=len, reverse=True):
+        w = loads.index(min(loads))
+        chunks[w].append(group)
+        loads[w] += len(group)
+
+    return [chunk for chunk in chunks if len(chunk) > 0]
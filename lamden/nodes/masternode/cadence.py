@@ -0,0 +1,121 @@
+import time
+
+from lamden.nodes.masternode import mempool
+
+'''
+Decides when the masternode closes a batch and sends it to the delegates.
+
+A transaction's latency is the time it waits in the mempool plus one round: delegates executing the batch, then the
+masternode aggregating their subblocks in to a block. Both are measured every round. Whatever the latency SLO leaves
+after a round is how long a batch stays open, so batches stay open longer when rounds are quick and load is light,
+and close sooner as rounds get slower. A batch also closes as soon as the mempool holds as many transactions as the
+delegates can execute within the SLO, so bursts go out straight away instead of waiting out the interval.
+
+Execution is modelled as a fixed overhead per round plus a cost per transaction, fit by least squares over the
+recent rounds, so the overhead of small batches is not mistaken for slow transactions.
+'''
+
+# Seconds from a transaction arriving to its block being built
+SLO = 2
+
+MIN_INTERVAL = 0.05
+
+# Weight of the newest measurement in the running averages
+SMOOTHING = 0.2
+
+
+def ewma(average, sample, smoothing=SMOOTHING):
+    if average is None:
+        return sample
+    return average + smoothing * (sample - average)
+
+
+class BatchController:
+    def __init__(self, slo=SLO, min_interval=MIN_INTERVAL, max_interval=None,
+                 max_batch=mempool.MAX_BATCH_COUNT, smoothing=SMOOTHING):
+        self.slo = slo
+        self.min_interval = min_interval
+        # A batch can stay open for as much of the SLO as a round leaves, unless a lower limit is given
+        self.max_interval = max_interval if max_interval is not None else slo
+        self.max_batch = max_batch
+        self.smoothing = smoothing
+
+        # Running averages, in seconds
+        self.execution = None
+        self.aggregation = None
+
+        # Running averages of the batch size, its square and batch size * execution, for the least squares fit
+        self.size = None
+        self.size_squared = None
+        self.size_execution = None
+
+        # Execution is about overhead + transactions * tx_time
+        self.overhead = 0
+        self.tx_time = None
+
+    def record(self, transactions, execution, aggregation):
+        # execution: from sending the batch to the first subblock arriving
+        # aggregation: from the first subblock arriving to the block being built
+        self.execution = ewma(self.execution, execution, self.smoothing)
+        self.aggregation = ewma(self.aggregation, aggregation, self.smoothing)
+
+        self.size = ewma(self.size, transactions, self.smoothing)
+        self.size_squared = ewma(self.size_squared, transactions ** 2, self.smoothing)
+        self.size_execution = ewma(self.size_execution, transactions * execution, self.smoothing)
+
+        self.fit()
+
+    def fit(self):
+        variance = self.size_squared - self.size ** 2
+
+        # Needs batches of different sizes to tell the overhead apart from the cost per transaction
+        if variance >= 1:
+            tx_time = (self.size_execution - self.size * self.execution) / variance
+            overhead = self.execution - tx_time * self.size
+
+            if tx_time > 0 and overhead >= 0:
+                self.tx_time, self.overhead = tx_time, overhead
+                return
+
+        if self.size <= 0:
+            return
+
+        # Otherwise keep the last cost per transaction and put the rest down to overhead, or start with no overhead
+        if self.tx_time is None or self.tx_time * self.size > self.execution:
+            self.tx_time, self.overhead = self.execution / self.size, 0
+        else:
+            self.overhead = self.execution - self.tx_time * self.size
+
+    def round_time(self):
+        return (self.execution or 0) + (self.aggregation or 0)
+
+    def interval(self):
+        # Until a round has been measured, leave half the SLO for it
+        if self.execution is None:
+            return min(max(self.slo / 2, self.min_interval), self.max_interval)
+
+        return min(max(self.slo - self.round_time(), self.min_interval), self.max_interval)
+
+    def target_size(self):
+        # The largest batch the delegates can execute while leaving room for overhead, aggregation and the shortest
+        # wait
+        if not self.tx_time:
+            return self.max_batch
+
+        budget = self.slo - (self.aggregation or 0) - self.overhead - self.min_interval
+
+        return min(max(int(budget / self.tx_time), 1), self.max_batch)
+
+    async def wait(self, queue, signal):
+        # Returns once the batch is full or the interval is up. The signal is set whenever a transaction arrives.
+        target = self.target_size()
+        deadline = time.time() + self.interval()
+
+        while len(queue) < target:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            await signal.wait(timeout=remaining)
+
+        return target
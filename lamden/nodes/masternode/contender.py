@@ -2,10 +2,9 @@ from contracting.db.encoder import encode
 from collections import defaultdict
 from lamden import router
 from lamden.crypto.canonical import merklize, block_from_subblocks
-from lamden.crypto.wallet import verify
+from lamden.crypto import verifier
 from lamden.logger.base import get_logger
 from lamden import storage
-import asyncio
 import time
 
 log = get_logger('Contender')
@@ -13,6 +12,7 @@ log = get_logger('Contender')
 class SBCInbox(router.Processor):
     def __init__(self, expected_subblocks=4, debug=True):
         self.q = []
+        self.signal = router.Signal()
         self.expected_subblocks = expected_subblocks
         self.log = get_logger('Subblock Gatherer')
         self.log.propagate = debug
@@ -27,12 +27,18 @@ class SBCInbox(router.Processor):
             self.log.error('Contender does not have enough subblocks!')
             return
 
+        # Every signature is checked at once, so checking each contender after this hits the cache
+        verifier.service.verify_batch([
+            (sbc['signer'], self.signed_message(sbc), sbc['merkle_tree']['signature']) for sbc in msg
+        ])
+
         for i in range(len(msg)):
             if not self.sbc_is_valid(msg[i], i):
                 self.log.error('Contender is not valid!')
                 return
 
             self.q.append(msg)
+            self.signal.set()
 
     def sbc_is_valid(self, sbc, sb_idx=0):
         if sbc['subblock'] != sb_idx:
@@ -40,14 +46,9 @@ class SBCInbox(router.Processor):
             return False
 
         # Make sure signer is in the delegates
-        if len(sbc['transactions']) == 0:
-            message = sbc['input_hash']
-        else:
-            message = sbc['merkle_tree']['leaves'][0]
-
-        valid_sig = verify(
+        valid_sig = verifier.service.verify(
             vk=sbc['signer'],
-            msg=message,
+            msg=self.signed_message(sbc),
             signature=sbc['merkle_tree']['signature']
         )
 
@@ -73,15 +74,32 @@ class SBCInbox(router.Processor):
 
         return True
 
-    def has_sbc(self):
-        return len(self.q) > 0
+    @staticmethod
+    def signed_message(sbc):
+        if len(sbc['transactions']) == 0:
+            return sbc['input_hash']
+        return sbc['merkle_tree']['leaves'][0]
+
+    @staticmethod
+    def built_on(msg, previous=None):
+        # True if the contenders were executed on top of the block with this hash, or if no hash is given
+        return previous is None or msg[0].get('previous') == previous
+
+    def has_sbc(self, previous=None):
+        return any(self.built_on(msg, previous) for msg in self.q)
 
-    async def receive_sbc(self):
+    async def receive_sbc(self, previous=None):
         self.log.debug('Receiving Subblock Contender...')
-        while len(self.q) <= 0:
-            await asyncio.sleep(0)
+        while not self.has_sbc(previous):
+            await self.signal.wait()
 
-        return self.q.pop(0)
+        i = next(i for i, msg in enumerate(self.q) if self.built_on(msg, previous))
+
+        return self.q.pop(i)
+
+    def prune(self, previous):
+        # Keeps only contenders for the block after the given one, which can arrive early in pipelined mode
+        self.q = [msg for msg in self.q if self.built_on(msg, previous)]
 
 
 class PotentialSolution:
@@ -284,10 +302,14 @@ class Aggregator:
 
         self.seconds_to_timeout = seconds_to_timeout
 
+        # When the first subblock of the last round arrived, which marks the end of delegate execution
+        self.first_response = None
+
         self.log = get_logger('AGG')
         self.log.propagate = debug
 
-    async def gather_subblocks(self, total_contacts, current_height=0, current_hash='0' * 64, quorum_ratio=0.66, adequate_ratio=0.5, expected_subblocks=4):
+    async def gather_subblocks(self, total_contacts, current_height=0, current_hash='0' * 64, quorum_ratio=0.66, adequate_ratio=0.5, expected_subblocks=4, previous=None):
+        # If previous is given, only contenders executed on top of that block hash are counted
         self.sbc_inbox.expected_subblocks = expected_subblocks
 
         block = storage.get_latest_block_height(self.driver)
@@ -301,22 +323,29 @@ class Aggregator:
             acceptable_consensus=adequate_ratio
         )
 
+        self.first_response = None
+
         # Add timeout condition.
         started = time.time()
         last_log = started
         while (not contenders.block_has_consensus() and contenders.responses < contenders.total_contacts) and \
                 time.time() - started < self.seconds_to_timeout:
 
-            if self.sbc_inbox.has_sbc():
-                sbcs = await self.sbc_inbox.receive_sbc() # Can probably make this raw sync code
+            if self.sbc_inbox.has_sbc(previous):
+                sbcs = await self.sbc_inbox.receive_sbc(previous) # Can probably make this raw sync code
+                if self.first_response is None:
+                    self.first_response = time.time()
                 self.log.info('Pop it in there.')
                 contenders.add_sbcs(sbcs)
+                continue
 
             if time.time() - last_log > 5:
                 self.log.error(f'Waiting for contenders for {int(time.time() - started)}s.')
                 last_log = time.time()
 
-            await asyncio.sleep(0)
+            # Sleep until the next contender arrives, waking to log and to give up once the block times out
+            remaining = self.seconds_to_timeout - (time.time() - started)
+            await self.sbc_inbox.signal.wait(timeout=max(min(remaining, 5), 0))
 
         if time.time() - started > self.seconds_to_timeout:
             self.log.error(f'Block timeout. Too many delegates are offline! Kick out the non-responsive ones! {block}')
@@ -4,7 +4,7 @@ import time
 from lamden import router
 from lamden.crypto.wallet import Wallet
 from lamden.storage import BlockStorage, get_latest_block_height
-from lamden.nodes.masternode import contender, webserver
+from lamden.nodes.masternode import contender, webserver, mempool, cadence
 from lamden.formatting import primatives
 from lamden.nodes import base
 from contracting.db.driver import ContractDriver
@@ -27,6 +27,8 @@ class BlockService(router.Processor):
         if primatives.dict_has_keys(msg, keys={'name', 'arg'}):
             if msg['name'] == base.GET_BLOCK:
                 response = self.get_block(msg)
+            elif msg['name'] == base.GET_BLOCKS:
+                response = self.get_blocks(msg)
             elif msg['name'] == base.GET_HEIGHT:
                 response = get_latest_block_height(self.driver)
 
@@ -44,9 +46,23 @@ class BlockService(router.Processor):
 
         return block
 
+    def get_blocks(self, command):
+        arg = command.get('arg')
+        if type(arg) != list or len(arg) != 2:
+            return None
+
+        start, end = arg
+        if not primatives.number_is_formatted(start) or not primatives.number_is_formatted(end) or end < start:
+            return None
+
+        # Bound the range so a single response stays a reasonable size
+        end = min(end, start + base.MAX_BLOCKS_PER_REQUEST - 1)
+
+        return list(self.blocks.get_blocks(start, end))
+
 
 class TransactionBatcher:
-    def __init__(self, wallet: Wallet, queue):
+    def __init__(self, wallet: Wallet, queue: mempool.Mempool):
         self.wallet = wallet
         self.queue = queue
 
@@ -71,13 +87,9 @@ class TransactionBatcher:
 
         return batch
 
-    def pack_current_queue(self, tx_number=250):
-        tx_list = []
-
-        # len(tx_list) < tx_number and
-
-        while len(self.queue) > 0:
-            tx_list.append(self.queue.pop(0))
+    def pack_current_queue(self, tx_number=mempool.MAX_BATCH_COUNT, max_bytes=mempool.MAX_BATCH_BYTES):
+        # Anything that does not fit stays in the mempool for the next batch
+        tx_list = self.queue.pop_batch(max_count=tx_number, max_bytes=max_bytes)
 
         batch = self.make_batch(tx_list)
 
@@ -85,7 +97,7 @@ class TransactionBatcher:
 
 
 class Masternode(base.Node):
-    def __init__(self, webserver_port=8080, *args, **kwargs):
+    def __init__(self, webserver_port=8080, *args, latency_slo=cadence.SLO, pipelined=False, **kwargs):
         super().__init__(store=True, *args, **kwargs)
         # Services
         self.webserver_port = webserver_port
@@ -93,15 +105,26 @@ class Masternode(base.Node):
             contracting_client=self.client,
             driver=self.driver,
             blocks=self.blocks,
+            nonces=self.nonces,
             wallet=self.wallet,
             port=self.webserver_port
         )
         self.upgrade_manager.webserver_port = self.webserver_port
         self.upgrade_manager.node_type = 'masternode'
 
-        self.tx_batcher = TransactionBatcher(wallet=self.wallet, queue=[])
+        self.tx_batcher = TransactionBatcher(wallet=self.wallet, queue=mempool.Mempool())
         self.webserver.queue = self.tx_batcher.queue
 
+        self.batch_controller = cadence.BatchController(slo=latency_slo)
+
+        # In pipelined mode, the next batch is sent while the block for the last one is being made. Holds
+        # (transactions, time sent) for a batch sent that way.
+        self.pipelined = pipelined
+        self.sent_ahead = None
+
+        # New transactions and new blocks both wake the masternode up
+        self.webserver.signal = self.new_block_processor.signal
+
         self.aggregator = contender.Aggregator(
             driver=self.driver,
         )
@@ -146,7 +169,7 @@ class Masternode(base.Node):
             if not self.running:
                 return
 
-            await asyncio.sleep(0)
+            await self.new_block_processor.signal.wait()
         mn_logger.debug('Work / blocks available. Continuing.')
 
     async def broadcast_new_blockchain_started(self):
@@ -163,7 +186,8 @@ class Masternode(base.Node):
                     **self.get_delegate_peers(),
                     **self.get_masternode_peers()
                 },
-                ctx=self.ctx
+                ctx=self.ctx,
+                pool=self.pool
             )
 
     async def new_blockchain_boot(self):
@@ -182,7 +206,7 @@ class Masternode(base.Node):
         while len(self.new_block_processor.q) <= 0:
             if not self.running:
                 return
-            await asyncio.sleep(0)
+            await self.new_block_processor.signal.wait()
 
         block = self.new_block_processor.q.pop(0)
         self.process_new_block(block)
@@ -202,7 +226,7 @@ class Masternode(base.Node):
             while len(self.new_block_processor.q) <= 0:
                 if not self.running:
                     return
-                await asyncio.sleep(0)
+                await self.new_block_processor.signal.wait()
 
             block = self.new_block_processor.q.pop(0)
             self.process_new_block(block)
@@ -211,15 +235,15 @@ class Masternode(base.Node):
         while self.running:
             await self.loop()
 
-    async def send_work(self):
+    async def send_work(self, tx_number=mempool.MAX_BATCH_COUNT):
         # Hangs until upgrade is done
         while self.upgrade_manager.upgrade:
-            await asyncio.sleep(0)
+            await asyncio.sleep(0.05)
 
         # Else, batch some more txs
-        self.log.info(f'Sending {len(self.tx_batcher.queue)} transactions.')
+        tx_batch = self.tx_batcher.pack_current_queue(tx_number=tx_number)
 
-        tx_batch = self.tx_batcher.pack_current_queue()
+        self.log.info(f'Sending {len(tx_batch["transactions"])} transactions.')
 
         # LOOK AT SOCKETS CLASS
         if len(self.get_delegate_peers()) == 0:
@@ -232,30 +256,88 @@ class Masternode(base.Node):
             cert_dir=self.socket_authenticator.cert_dir,
             wallet=self.wallet,
             peer_map=self.get_delegate_peers(),
-            ctx=self.ctx
+            ctx=self.ctx,
+            pool=self.pool
+        )
+
+    async def send_batch(self, tx_number):
+        transactions = min(len(self.tx_batcher.queue), tx_number)
+        sent = time.time()
+
+        await self.send_work(tx_number=tx_number)
+
+        return transactions, sent
+
+    async def send_ahead(self, gathering):
+        # Pipelined mode. Sends the next batch as soon as it closes, as long as the block is still being made and
+        # there is something to send. Otherwise the next round starts the usual way.
+        closing = asyncio.ensure_future(
+            self.batch_controller.wait(self.tx_batcher.queue, self.new_block_processor.signal)
         )
 
+        await asyncio.wait([gathering, closing], return_when=asyncio.FIRST_COMPLETED)
+
+        if not closing.done():
+            closing.cancel()
+            return
+
+        if gathering.done() or len(self.tx_batcher.queue) == 0:
+            return
+
+        self.log.info('Sending the next batch ahead of the block.')
+        self.sent_ahead = await self.send_batch(tx_number=closing.result())
+
     async def get_work_processed(self):
-        await asyncio.sleep(1)
+        # Work for this round may already have been sent while the last block was being made
+        if self.sent_ahead is None:
+            target = await self.batch_controller.wait(self.tx_batcher.queue, self.new_block_processor.signal)
+            self.sent_ahead = await self.send_batch(tx_number=target)
 
-        await self.send_work()
+        transactions, sent = self.sent_ahead
+        self.sent_ahead = None
 
         # this really should just give us a block straight up
         masters = self.driver.get_var(contract='masternodes', variable='S', arguments=['members'], mark=False)
 
         self.log.info('=== ENTERING BUILD NEW BLOCK STATE ===')
 
-        block = await self.aggregator.gather_subblocks(
+        # Contenders for the next block can arrive while this one is being made, so only ones built on top of the
+        # current block are counted
+        gathering = asyncio.ensure_future(self.aggregator.gather_subblocks(
             total_contacts=len(self.get_delegate_peers()),
             expected_subblocks=len(masters),
             current_height=self.current_height,
-            current_hash=self.current_hash
-        )
+            current_hash=self.current_hash,
+            previous=self.current_hash if self.pipelined else None
+        ))
+
+        if self.pipelined:
+            await self.send_ahead(gathering)
+
+        block = await gathering
+
+        done = time.time()
+        if self.aggregator.first_response is not None:
+            self.batch_controller.record(
+                transactions=transactions,
+                execution=self.aggregator.first_response - sent,
+                aggregation=done - self.aggregator.first_response
+            )
+
+        previous_hash = self.current_hash
 
         self.process_new_block(block)
 
         self.new_block_processor.clean(self.current_height)
 
+        # Contenders sent ahead are kept if they were built on the block that was just made. If it was not made, the
+        # delegates execute the work again and send new ones.
+        if self.pipelined:
+            if self.current_hash != previous_hash:
+                self.aggregator.sbc_inbox.prune(self.current_hash)
+            else:
+                self.aggregator.sbc_inbox.q.clear()
+
         return block
 
     async def loop(self):
@@ -270,10 +352,13 @@ class Masternode(base.Node):
             cert_dir=self.socket_authenticator.cert_dir,
             wallet=self.wallet,
             peer_map=self.get_delegate_peers(),
-            ctx=self.ctx
+            ctx=self.ctx,
+            pool=self.pool
         )
 
-        await self.hang()
+        # Nothing to wait for if the next batch is already out
+        if self.sent_ahead is None:
+            await self.hang()
 
         await router.secure_multicast(
             msg=block,
@@ -281,15 +366,18 @@ class Masternode(base.Node):
             cert_dir=self.socket_authenticator.cert_dir,
             wallet=self.wallet,
             peer_map=self.get_masternode_peers(),
-            ctx=self.ctx
+            ctx=self.ctx,
+            pool=self.pool
         )
 
-        self.aggregator.sbc_inbox.q.clear()
+        if not self.pipelined:
+            self.aggregator.sbc_inbox.q.clear()
 
     def stop(self):
         super().stop()
         self.router.socket.close()
         self.webserver.coroutine.result().close()
+        self.webserver.validator.stop()
 
 
 def get_genesis_block():
@@ -0,0 +1,196 @@
+import bisect
+import time
+from collections import OrderedDict, deque
+
+from contracting.db.encoder import encode
+
+from lamden.crypto.canonical import tx_hash_from_tx
+
+'''
+Transactions waiting to be sent out in a batch.
+
+Every transaction is kept in one OrderedDict by hash, in the order it arrived, which makes adding, removing and
+finding duplicates O(1). Each sender also has a lane, a deque holding their transactions sorted by nonce. Batches are
+taken from the front of the pool, but whenever a sender comes up, the lowest nonce in their lane goes first, so a
+sender's transactions always leave in nonce order. Transactions join and leave lanes at the ends, which is O(1).
+
+Delegates reject transactions that are too old, so anything past its TTL is dropped instead of sent. When the pool is
+full, the highest nonce of the sender with the most waiting is dropped to make room. Senders are kept in buckets by
+how many transactions they have waiting, so finding them is O(1), and a full pool of senders with one transaction each
+turns new ones away straight off.
+'''
+
+MAX_SIZE = 10_000
+
+# Delegates accept transactions up to 10 seconds old by default
+TTL = 10
+
+MAX_BATCH_COUNT = 250
+MAX_BATCH_BYTES = 4 * 1024 * 1024
+
+
+class Entry:
+    __slots__ = ('tx', 'hash', 'sender', 'nonce', 'timestamp', 'size')
+
+    def __init__(self, tx, tx_hash, size):
+        self.tx = tx
+        self.hash = tx_hash
+        self.sender = tx['payload']['sender']
+        self.nonce = tx['payload']['nonce']
+        self.timestamp = tx['metadata']['timestamp']
+        self.size = size
+
+
+class Mempool:
+    def __init__(self, max_size=MAX_SIZE, ttl=TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # hash -> Entry, oldest first
+        self.entries = OrderedDict()
+
+        # sender -> deque of (nonce, hash), lowest nonce first
+        self.lanes = {}
+
+        # lane length -> senders with that many transactions waiting, and the longest lane
+        self.lengths = {}
+        self.longest = 0
+
+        self.duplicates = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, tx_hash):
+        return tx_hash in self.entries
+
+    def append(self, tx, tx_hash=None, size=None):
+        if tx_hash is None:
+            tx_hash = tx_hash_from_tx(tx)
+
+        if tx_hash in self.entries:
+            self.duplicates += 1
+            return False
+
+        entry = Entry(tx, tx_hash, size if size is not None else len(encode(tx)))
+
+        if len(self.entries) >= self.max_size and not self.evict(entry.sender):
+            return False
+
+        self.entries[tx_hash] = entry
+
+        lane = self.lanes.setdefault(entry.sender, deque())
+        if len(lane) == 0 or lane[-1][0] <= entry.nonce:
+            lane.append((entry.nonce, tx_hash))
+        else:
+            # Nonces almost always arrive in order, so this is rare
+            lane.insert(bisect.bisect_right(lane, (entry.nonce, tx_hash)), (entry.nonce, tx_hash))
+
+        self.resize(entry.sender, len(lane) - 1, len(lane))
+
+        return True
+
+    def extend(self, txs):
+        for tx in txs:
+            self.append(tx)
+
+    def remove(self, tx_hash):
+        entry = self.entries.pop(tx_hash, None)
+        if entry is None:
+            return None
+
+        lane = self.lanes[entry.sender]
+        if lane[0][1] == tx_hash:
+            lane.popleft()
+        elif lane[-1][1] == tx_hash:
+            lane.pop()
+        else:
+            lane.remove((entry.nonce, tx_hash))
+
+        self.resize(entry.sender, len(lane) + 1, len(lane))
+
+        if len(lane) == 0:
+            del self.lanes[entry.sender]
+
+        return entry
+
+    def resize(self, sender, old, new):
+        # Moves a sender to the bucket for their new lane length. Lanes only grow or shrink by one at a time.
+        if old > 0:
+            bucket = self.lengths[old]
+            del bucket[sender]
+            if len(bucket) == 0:
+                del self.lengths[old]
+
+        if new > 0:
+            self.lengths.setdefault(new, {})[sender] = None
+
+        if new > self.longest:
+            self.longest = new
+        elif old == self.longest and old not in self.lengths:
+            self.longest = new
+
+    def evict(self, sender):
+        # Makes room by dropping the newest nonce of whoever has the most waiting, unless that is the sender trying to
+        # add a transaction
+        if self.longest <= 1:
+            return False
+
+        # Ties go to whoever got there first. Only the first two need looking at to skip the sender.
+        for longest in self.lengths[self.longest]:
+            if longest != sender:
+                break
+        else:
+            return False
+
+        self.remove(self.lanes[longest][-1][1])
+        self.evicted += 1
+
+        return True
+
+    def is_expired(self, entry: Entry, now):
+        return now - entry.timestamp > self.ttl
+
+    def expire(self, now=None):
+        now = now if now is not None else time.time()
+
+        expired = [h for h, entry in self.entries.items() if self.is_expired(entry, now)]
+        for h in expired:
+            self.remove(h)
+
+        self.expired += len(expired)
+
+        return len(expired)
+
+    def pop_batch(self, max_count=MAX_BATCH_COUNT, max_bytes=MAX_BATCH_BYTES, now=None):
+        now = now if now is not None else time.time()
+
+        batch = []
+        size = 0
+
+        while len(self.entries) > 0 and len(batch) < max_count:
+            oldest = next(iter(self.entries.values()))
+            entry = self.entries[self.lanes[oldest.sender][0][1]]
+
+            if self.is_expired(entry, now):
+                self.remove(entry.hash)
+                self.expired += 1
+                continue
+
+            # A transaction bigger than the budget still goes out on its own, so it cannot block the pool
+            if len(batch) > 0 and size + entry.size > max_bytes:
+                break
+
+            self.remove(entry.hash)
+            batch.append(entry.tx)
+            size += entry.size
+
+        return batch
+
+    def clear(self):
+        self.entries.clear()
+        self.lanes.clear()
+        self.lengths.clear()
+        self.longest = 0
@@ -0,0 +1,188 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from lamden import storage
+from lamden.crypto import transaction
+from lamden.crypto.verifier import service as shared_verifier
+from lamden.nodes.delegate.delegate import StateReader
+from lamden.logger.base import get_logger
+
+log = get_logger('SUBMISSIONS')
+
+'''
+Validates submitted transactions off the event loop.
+
+Submissions that arrive while the workers are busy are validated together as one batch. Each batch is checked on a
+worker thread: signatures all at once, then formatting, processor and funds for each transaction. Nonces are then
+checked and pending nonces set on a single thread, one batch at a time in the order they were submitted, so a sender's
+transactions are always given nonces in the order they came in. Each sender's nonces are looked up once per batch, and
+a submission is never split across batches.
+'''
+
+WORKERS = 4
+MAX_BATCH = 256
+
+
+class SubmissionValidator:
+    def __init__(self, client, nonces: storage.NonceStorage, processor: str, workers=WORKERS, max_batch=MAX_BATCH,
+                 verifier=None):
+        self.client = client
+        self.nonces = nonces
+
+        # Workers must not touch the node's driver cache, which the event loop clears and fills while applying blocks.
+        # Balances and stamp costs are read from committed state instead.
+        self.state = StateReader(client.raw_driver)
+        self.processor = processor
+
+        self.workers = workers
+        self.max_batch = max_batch
+
+        self.validators = ThreadPoolExecutor(max_workers=workers)
+        self.nonce_thread = ThreadPoolExecutor(max_workers=1)
+        self.verifier = verifier if verifier is not None else shared_verifier
+
+        # Submissions waiting for a worker, each a list of (transaction, future)
+        self.pending = []
+        self.in_flight = 0
+
+        # Nonces for the last batch dispatched, which the next one waits for
+        self.settling = None
+
+        self.loop = None
+
+    def check(self, tx):
+        # Returns (error, funds error). The funds error only counts if the nonce is good, the same order
+        # transaction_is_valid checks in.
+        try:
+            transaction.check_tx_formatting(tx, self.processor)
+        except Exception as e:
+            return e, None
+
+        try:
+            transaction.check_funds(tx, self.state)
+        except Exception as e:
+            return None, e
+
+        return None, None
+
+    def check_batch(self, transactions: list):
+        # Signatures are verified together, and cached, before each transaction is checked on its own
+        self.verifier.verify_batch(transaction.signed_payloads(transactions))
+
+        return [self.check(tx) for tx in transactions]
+
+    def set_nonces(self, transactions: list, checks: list):
+        # Runs on the nonce thread. Returns an error, or None, for each transaction.
+        nonces = {}
+        results = []
+
+        for tx, (error, funds_error) in zip(transactions, checks):
+            if error is not None:
+                results.append(error)
+                continue
+
+            sender = tx['payload']['sender']
+            if sender not in nonces:
+                nonces[sender] = transaction.get_nonces(sender, self.processor, self.nonces)
+
+            nonce, pending_nonce = nonces[sender]
+
+            try:
+                pending_nonce = transaction.get_new_pending_nonce(
+                    tx_nonce=tx['payload']['nonce'],
+                    nonce=nonce,
+                    pending_nonce=pending_nonce
+                )
+            except Exception as e:
+                results.append(e)
+                continue
+
+            if funds_error is not None:
+                results.append(funds_error)
+                continue
+
+            self.nonces.set_pending_nonce(sender=sender, processor=self.processor, value=pending_nonce)
+            nonces[sender] = (nonce, pending_nonce)
+
+            results.append(None)
+
+        return results
+
+    def reset_nonces(self, transactions: list):
+        # Runs on the nonce thread. Takes back the pending nonces of validated transactions that were not queued,
+        # unless a later transaction from the same sender has been given the next one since.
+        for tx in reversed(transactions):
+            sender = tx['payload']['sender']
+            nonce = tx['payload']['nonce']
+
+            if self.nonces.get_pending_nonce(sender=sender, processor=self.processor) == nonce + 1:
+                self.nonces.set_pending_nonce(sender=sender, processor=self.processor, value=nonce)
+
+    def bind(self):
+        # Futures belong to the loop they were made on, so start over if submissions come from a new one
+        loop = asyncio.get_event_loop()
+        if self.loop is not loop:
+            self.loop = loop
+            self.pending = []
+            self.in_flight = 0
+            self.settling = None
+
+        return loop
+
+    def dispatch(self):
+        # Hands pending submissions to every free worker. Whole submissions are batched together up to max_batch, and
+        # one larger than that is a batch of its own.
+        while len(self.pending) > 0 and self.in_flight < self.workers:
+            batch = self.pending.pop(0)
+            while len(self.pending) > 0 and len(batch) + len(self.pending[0]) <= self.max_batch:
+                batch = batch + self.pending.pop(0)
+
+            self.in_flight += 1
+
+            checked = self.loop.run_in_executor(self.validators, self.check_batch, [tx for tx, _ in batch])
+            self.settling = asyncio.ensure_future(self.settle(batch, checked, self.settling))
+
+    async def settle(self, batch, checked, previous):
+        transactions = [tx for tx, _ in batch]
+
+        try:
+            try:
+                checks = await checked
+            finally:
+                self.in_flight -= 1
+                self.dispatch()
+
+            if previous is not None:
+                await asyncio.wait([previous])
+
+            results = await self.loop.run_in_executor(self.nonce_thread, self.set_nonces, transactions, checks)
+        except Exception as e:
+            log.error(f'Could not validate {len(batch)} submissions: {e}')
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def validate(self, transactions: list):
+        # Returns an exception, or None if the transaction is good, for each transaction
+        loop = self.bind()
+
+        submission = [(tx, loop.create_future()) for tx in transactions]
+        futures = [future for _, future in submission]
+
+        if len(submission) > 0:
+            self.pending.append(submission)
+
+        self.dispatch()
+
+        return [await future for future in futures]
+
+    async def release(self, transactions: list):
+        # For transactions that passed validation but could not be queued
+        loop = self.bind()
+        await loop.run_in_executor(self.nonce_thread, self.reset_nonces, transactions)
+
+    def stop(self):
+        self.validators.shutdown(wait=False)
+        self.nonce_thread.shutdown(wait=False)
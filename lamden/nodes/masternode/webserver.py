@@ -6,7 +6,7 @@ from contracting.client import ContractingClient
 from contracting.db.encoder import encode, decode
 from contracting.db.driver import ContractDriver
 from contracting.compilation import parser
-from lamden import storage
+from lamden import storage, router
 from lamden.crypto.canonical import tx_hash_from_tx
 from lamden.crypto.transaction import TransactionException
 import decimal
@@ -16,9 +16,15 @@ import ssl
 import asyncio
 
 from lamden.crypto import transaction
+from lamden.nodes.masternode import mempool, validator
 
 log = get_logger("MN-WebServer")
 
+# Single transactions keep the old request limit. Only /batch can send bodies up to the larger one.
+MAX_TX_SIZE = 10_000
+MAX_BATCH_TRANSACTIONS = 500
+MAX_BATCH_REQUEST_SIZE = MAX_TX_SIZE * MAX_BATCH_TRANSACTIONS
+
 
 class ByteEncoder(_json.JSONEncoder):
     def default(self, o, *args):
@@ -29,17 +35,17 @@ class ByteEncoder(_json.JSONEncoder):
 
 
 class WebServer:
-    def __init__(self, contracting_client: ContractingClient, driver: ContractDriver, wallet, blocks, queue=[], port=8080, ssl_port=443, ssl_enabled=False,
+    def __init__(self, contracting_client: ContractingClient, driver: ContractDriver, wallet, blocks, nonces=None, queue=None, port=8080, ssl_port=443, ssl_enabled=False,
                  ssl_cert_file='~/.ssh/server.csr',
                  ssl_key_file='~/.ssh/server.key',
                  workers=2, debug=True, access_log=False,
-                 max_queue_len=10_000,
+                 max_queue_len=10_000, validation_workers=validator.WORKERS,
                  ):
 
         # Setup base Sanic class and CORS
         self.app = Sanic(__name__)
         self.app.config.update({
-            'REQUEST_MAX_SIZE': 10000,
+            'REQUEST_MAX_SIZE': MAX_BATCH_REQUEST_SIZE,
             'REQUEST_TIMEOUT': 5,
             'KEEP_ALIVE': False,
         })
@@ -48,15 +54,29 @@ class WebServer:
         # Initialize the backend data interfaces
         self.client = contracting_client
         self.driver = driver
-        self.nonces = storage.NonceStorage()
+        # Share the node's nonce storage so reads are served from the same cache the node writes to
+        if nonces is None:
+            nonces = storage.NonceStorage()
+        self.nonces = nonces
         self.blocks = blocks
 
         self.static_headers = {}
 
         self.wallet = wallet
-        self.queue = queue
+        self.queue = queue if queue is not None else mempool.Mempool(max_size=max_queue_len)
+        self.signal = router.Signal()
         self.max_queue_len = max_queue_len
 
+        # Slots held by submissions that are still being validated
+        self.reserved = 0
+
+        self.validator = validator.SubmissionValidator(
+            client=self.client,
+            nonces=self.nonces,
+            processor=self.wallet.verifying_key,
+            workers=validation_workers
+        )
+
         self.port = port
 
         self.ssl_port = ssl_port
@@ -75,6 +95,7 @@ class WebServer:
 
         # Add Routes
         self.app.add_route(self.submit_transaction, '/', methods=['POST', 'OPTIONS'])
+        self.app.add_route(self.submit_batch, '/batch', methods=['POST', 'OPTIONS'])
         self.app.add_route(self.ping, '/ping', methods=['GET', 'OPTIONS'])
         self.app.add_route(self.get_id, '/id', methods=['GET'])
         self.app.add_route(self.get_nonce, '/nonce/<vk>', methods=['GET'])
@@ -125,64 +146,115 @@ class WebServer:
                 )
             )
 
+    def queue_full(self, n=1):
+        return len(self.queue) + self.reserved + n > self.max_queue_len
+
     # Main Endpoint to Submit TXs
     async def submit_transaction(self, request):
         log.debug(f'New request: {request}')
         # Reject TX if the queue is too large
-        if len(self.queue) >= self.max_queue_len:
+        if self.queue_full():
             return response.json({'error': "Queue full. Resubmit shortly."}, status=503, headers={'Access-Control-Allow-Origin': '*'})
 
+        if len(request.body) > MAX_TX_SIZE:
+            return response.json({'error': 'Request body too large.'}, status=413, headers={'Access-Control-Allow-Origin': '*'})
+
         # Check that the payload is valid JSON
         tx = decode(request.body)
         if tx is None:
 
             return response.json({'error': 'Malformed request body.'}, headers={'Access-Control-Allow-Origin': '*'})
 
-        # Check that the TX is correctly formatted
+        # Check that the TX is correctly formatted and valid. Runs off the event loop, batched with other submissions.
+        self.reserved += 1
         try:
-            transaction.check_tx_formatting(tx, self.wallet.verifying_key)
-
-            transaction.transaction_is_valid(
-                transaction=tx,
-                expected_processor=self.wallet.verifying_key,
-                client=self.client,
-                nonces=self.nonces
-            )
-
-            nonce, pending_nonce = transaction.get_nonces(
-                sender=tx['payload']['sender'],
-                processor=tx['payload']['processor'],
-                driver=self.nonces
-            )
+            error, = await self.validator.validate([tx])
+        finally:
+            self.reserved -= 1
 
-            pending_nonce = transaction.get_new_pending_nonce(
-                tx_nonce=tx['payload']['nonce'],
-                nonce=nonce,
-                pending_nonce=pending_nonce
-            )
+        if error is not None:
+            if not isinstance(error, TransactionException):
+                raise error
 
-            self.nonces.set_pending_nonce(
-                sender=tx['payload']['sender'],
-                processor=tx['payload']['processor'],
-                value=pending_nonce
-            )
-        except TransactionException as e:
-            log.error(f'Tx has error: {type(e)}')
+            log.error(f'Tx has error: {type(error)}')
             return response.json(
-                transaction.EXCEPTION_MAP[type(e)], headers={'Access-Control-Allow-Origin': '*'}
+                transaction.EXCEPTION_MAP[type(error)], headers={'Access-Control-Allow-Origin': '*'}
             )
 
         # Add TX to the processing queue
-        self.queue.append(tx)
-
-        # Return the TX hash to the user so they can track it
         tx_hash = tx_hash_from_tx(tx)
 
+        # The mempool can still turn it away, if it is a duplicate or nothing could be evicted to make room
+        if not self.queue.append(tx, tx_hash=tx_hash, size=len(request.body)):
+            await self.validator.release([tx])
+            return response.json({'error': "Queue full. Resubmit shortly."}, status=503, headers={'Access-Control-Allow-Origin': '*'})
+
+        self.signal.set()
+
+        # Return the TX hash to the user so they can track it
         return response.json({
             'success': 'Transaction successfully submitted to the network.',
             'hash': tx_hash
         }, headers={'Access-Control-Allow-Origin': '*'})
 
+    # Submit many TXs in one request. Every TX gets its own result, in the order they were sent.
+    async def submit_batch(self, request):
+        transactions = decode(request.body)
+        if type(transactions) != list or len(transactions) == 0:
+            return response.json({'error': 'Malformed request body.'}, headers={'Access-Control-Allow-Origin': '*'})
+
+        if len(transactions) > MAX_BATCH_TRANSACTIONS:
+            return response.json(
+                {'error': f'Too many transactions. Send at most {MAX_BATCH_TRANSACTIONS}.'},
+                status=413, headers={'Access-Control-Allow-Origin': '*'}
+            )
+
+        # The whole batch is rejected if it does not fit, so none of it is half accepted
+        if self.queue_full(len(transactions)):
+            return response.json({'error': "Queue full. Resubmit shortly."}, status=503, headers={'Access-Control-Allow-Origin': '*'})
+
+        # Validated together: signatures in one batch and nonces looked up once per sender
+        self.reserved += len(transactions)
+        try:
+            errors = await self.validator.validate(transactions)
+        finally:
+            self.reserved -= len(transactions)
+
+        results = []
+        turned_away = []
+        for tx, error in zip(transactions, errors):
+            # Malformed transactions may not have anything to hash
+            try:
+                tx_hash = tx_hash_from_tx(tx)
+            except Exception:
+                tx_hash = None
+
+            if error is None:
+                if self.queue.append(tx, tx_hash=tx_hash, size=len(encode(tx))):
+                    results.append({'success': 'Transaction successfully submitted to the network.', 'hash': tx_hash})
+                else:
+                    turned_away.append(tx)
+                    results.append({'error': "Queue full. Resubmit shortly.", 'hash': tx_hash})
+                continue
+
+            if not isinstance(error, TransactionException):
+                log.error(f'Tx could not be validated: {error}')
+                error = TransactionException()
+
+            results.append({
+                **transaction.EXCEPTION_MAP.get(type(error), transaction.EXCEPTION_MAP[TransactionException]),
+                'hash': tx_hash
+            })
+
+        if len(turned_away) > 0:
+            await self.validator.release(turned_away)
+
+        self.signal.set()
+
+        log.debug(f'Batch of {len(transactions)} transactions. {sum("success" in r for r in results)} accepted.')
+
+        return response.json({'results': results}, headers={'Access-Control-Allow-Origin': '*'})
+
     # Network Status
     async def ping(self, request):
         return response.json({'status': 'online'}, headers={'Access-Control-Allow-Origin': '*'})
@@ -3,6 +3,7 @@ from lamden.crypto.wallet import Wallet
 import zmq
 import zmq.asyncio
 from contracting.db.encoder import encode, decode
+from lamden import wire
 from zmq.error import ZMQBaseError
 from zmq.auth.certs import load_certificate
 from lamden.logger.base import get_logger
@@ -17,13 +18,127 @@ OK = {
     'response': 'ok'
 }
 
+# Sent back when a service has no room left for a message
+BUSY = {
+    'response': 'busy'
+}
+
+# Messages an inbox handles at once before it stops reading from its socket
+MAX_IN_FLIGHT = 1024
+
+# Defaults for each service registered on a router
+MAX_CONCURRENT = 32
+MAX_QUEUE = 256
+
 
-def build_message(service, message):
-    return {
+def build_message(service, message, request_id=None):
+    m = {
         'service': service,
         'msg': message
     }
 
+    if request_id is not None:
+        m['request_id'] = request_id
+
+    return m
+
+
+class Signal:
+    '''
+    Wakes up coroutines that are waiting for a queue to be filled instead of having them spin on asyncio.sleep(0).
+    The underlying event is created lazily so it always belongs to the loop that is waiting on it. Waiters sleep until
+    the signal is set, so anything that changes a queue, or a flag a waiter checks, must set its signal.
+    '''
+    def __init__(self):
+        self.event = None
+        self.loop = None
+
+    def get_event(self):
+        loop = asyncio.get_event_loop()
+        if self.event is None or self.loop is not loop:
+            self.event = asyncio.Event()
+            self.loop = loop
+
+        return self.event
+
+    def set(self):
+        if self.event is not None:
+            self.event.set()
+
+    async def wait(self, timeout=None):
+        event = self.get_event()
+
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        event.clear()
+
+
+class ServiceLimit:
+    '''
+    Bounds how many messages a service processes at once and how many can wait for a turn. Messages past both limits
+    are rejected by the router instead of piling up as tasks.
+    '''
+    def __init__(self, max_concurrent=MAX_CONCURRENT, max_queue=MAX_QUEUE):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+
+        self.semaphore = None
+        self.loop = None
+
+        self.active = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.processed = 0
+        self.rejected = 0
+
+    def get_semaphore(self):
+        loop = asyncio.get_event_loop()
+        if self.semaphore is None or self.loop is not loop:
+            self.semaphore = asyncio.Semaphore(self.max_concurrent)
+            self.loop = loop
+
+        return self.semaphore
+
+    @property
+    def full(self):
+        return self.active >= self.max_concurrent and self.queued >= self.max_queue
+
+    async def run(self, coroutine):
+        semaphore = self.get_semaphore()
+
+        if semaphore.locked():
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            try:
+                await semaphore.acquire()
+            except asyncio.CancelledError:
+                coroutine.close()
+                raise
+            finally:
+                self.queued -= 1
+        else:
+            await semaphore.acquire()
+
+        self.active += 1
+        try:
+            return await coroutine
+        finally:
+            self.active -= 1
+            self.processed += 1
+            semaphore.release()
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'queued': self.queued,
+            'max_queued': self.max_queued,
+            'processed': self.processed,
+            'rejected': self.rejected
+        }
+
 
 class Processor:
     async def process_message(self, msg):
@@ -33,9 +148,11 @@ class Processor:
 class QueueProcessor(Processor):
     def __init__(self):
         self.q = []
+        self.signal = Signal()
 
     async def process_message(self, msg):
         self.q.append(msg)
+        self.signal.set()
 
 
 '''
@@ -52,7 +169,7 @@ a message to the requester.
 
 
 class AsyncInbox:
-    def __init__(self, socket_id, ctx: zmq.Context, wallet=None, linger=1000, poll_timeout=50):
+    def __init__(self, socket_id, ctx: zmq.Context, wallet=None, linger=1000, poll_timeout=50, max_in_flight=MAX_IN_FLIGHT):
         if socket_id.startswith('tcp'):
             _, _, port = socket_id.split(':')
             self.address = f'tcp://*:{port}'
@@ -68,6 +185,11 @@ class AsyncInbox:
         self.linger = linger
         self.poll_timeout = poll_timeout
 
+        # Once this many messages are being handled the inbox stops reading, so senders back up in ZMQ instead
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.slot_freed = Signal()
+
         self.running = False
 
     async def serve(self):
@@ -76,17 +198,33 @@ class AsyncInbox:
         self.running = True
 
         while self.running:
+            if self.in_flight >= self.max_in_flight:
+                await self.slot_freed.wait()
+                continue
+
             try:
                 event = await self.socket.poll(timeout=self.poll_timeout, flags=zmq.POLLIN)
                 if event:
                     _id, msg = await self.receive_message()
-                    asyncio.ensure_future(self.handle_msg(_id, msg))
+
+                    # Frames that could not be decoded are dropped
+                    if msg is not None:
+                        self.dispatch(_id, msg)
             except zmq.error.ZMQError:
                 self.socket.close()
                 self.setup_socket()
 
         self.socket.close()
 
+    def dispatch(self, _id, msg):
+        self.in_flight += 1
+        task = asyncio.ensure_future(self.handle_msg(_id, msg))
+        task.add_done_callback(self.handled)
+
+    def handled(self, task):
+        self.in_flight -= 1
+        self.slot_freed.set()
+
     async def receive_message(self):
         _id = await self.socket.recv()
         msg = await self.socket.recv()
@@ -141,7 +279,16 @@ class JSONAsyncInbox(AsyncInbox):
         _id = await self.socket.recv()
         msg = await self.socket.recv()
 
-        return _id, decode(msg)
+        try:
+            msg = wire.loads(msg) if wire.is_binary(msg) else decode(msg)
+        except (ValueError, RecursionError):
+            msg = None
+
+        # Anything but a message dict is dropped by serve
+        if not isinstance(msg, dict):
+            return _id, None
+
+        return _id, msg
 
     async def return_msg(self, _id, msg):
         msg = encode(msg).encode()
@@ -153,47 +300,307 @@ class Router(JSONAsyncInbox):
         super().__init__(*args, **kwargs)
 
         self.services = {}
+        self.limits = {}
         self.log = get_logger(self.address)
         self.log.propagate = debug
 
     async def handle_msg(self, _id, msg):
         service = msg.get('service')
+        request_id = msg.get('request_id')
         request = msg.get('msg')
 
+        # Peers that can read binary frames say so on every message they send
+        binary = msg.get('wire') == wire.BINARY
+
         self.log.debug(f'Message recieved for: {service}.')
 
         if service is None:
             self.log.debug('No service found for message.')
-            await super().return_msg(_id, OK)
+            await self.reply(_id, OK, request_id, binary)
             return
 
         if request is None:
             self.log.debug('No request found in message.')
-            await super().return_msg(_id, OK)
+            await self.reply(_id, OK, request_id, binary)
             return
 
         processor = self.services.get(service)
 
         if processor is None:
-            await super().return_msg(_id, OK)
+            await self.reply(_id, OK, request_id, binary)
             return
 
-        response = await processor.process_message(request)
+        limit = self.limits[service]
+
+        if limit.full:
+            limit.rejected += 1
+            self.log.error(f'{service} has {limit.queued} messages waiting. Rejecting message.')
+            await self.reply(_id, BUSY, request_id, binary)
+            return
+
+        response = await limit.run(processor.process_message(request))
 
         if response is None:
-            await super().return_msg(_id, OK)
+            await self.reply(_id, OK, request_id, binary)
             return
 
-        await super().return_msg(_id, response)
+        await self.reply(_id, response, request_id, binary)
+
+    async def reply(self, _id, response, request_id=None, binary=False):
+        # Pooled connections send many requests over one socket, so replies say which request they answer
+        if request_id is not None:
+            response = {
+                'request_id': request_id,
+                'msg': response
+            }
 
-    def add_service(self, name: str, processor: Processor):
+        if binary:
+            await AsyncInbox.return_msg(self, _id, wire.dumps(response))
+        else:
+            await super().return_msg(_id, response)
+
+    def add_service(self, name: str, processor: Processor, max_concurrent=MAX_CONCURRENT, max_queue=MAX_QUEUE):
         self.services[name] = processor
+        self.limits[name] = ServiceLimit(max_concurrent=max_concurrent, max_queue=max_queue)
+
+    def stats(self):
+        return {
+            'in_flight': self.in_flight,
+            'services': {name: limit.stats() for name, limit in self.limits.items()}
+        }
+
+
+class PeerConnection:
+    def __init__(self, vk, ip, server_key, wallet: Wallet, ctx: zmq.asyncio.Context, linger=500):
+        self.vk = vk
+        self.ip = ip
+
+        self.socket = ctx.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, linger)
+        self.socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+
+        self.socket.curve_secretkey = wallet.curve_sk
+        self.socket.curve_publickey = wallet.curve_vk
+        self.socket.curve_serverkey = server_key
+
+        self.request_id = 0
+        self.pending = {}
+        self.reader = None
+        self.closed = False
+
+        # Messages are sent as JSON until the peer answers with a binary frame
+        self.binary = False
+
+        # None until the peer's first reply shows whether it tags replies with their request id. Until then the ids
+        # still waiting for a reply are kept, so a bare reply can be matched when only one message is outstanding.
+        self.tagged = None
+        self.outstanding = set()
+
+    def connect(self):
+        try:
+            self.socket.connect(self.ip)
+        except ZMQBaseError:
+            logger.debug(f'Could not connect to {self.ip}')
+            self.close()
+            return False
+
+        return True
+
+    def next_request_id(self):
+        self.request_id += 1
+        return self.request_id
 
+    def start_reader(self):
+        # One reader hands out the replies for every message sent over this socket
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.ensure_future(self.read())
 
-async def secure_send(msg: dict, service, wallet: Wallet, vk, ip, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR):
+    async def send(self, service, msg, request_id=None):
+        # Every message is tagged so the OK replies to plain sends can be told apart from real responses
+        if request_id is None:
+            request_id = self.next_request_id()
+
+        message = build_message(service=service, message=msg, request_id=request_id)
+        message['wire'] = wire.BINARY
+
+        payload = wire.dumps(message) if self.binary else encode(message).encode()
+
+        if self.tagged is None:
+            self.outstanding.add(request_id)
+
+        await self.socket.send(payload, flags=zmq.NOBLOCK)
+        self.start_reader()
+
+    async def request(self, service, msg, timeout=1000):
+        request_id = self.next_request_id()
+
+        response = asyncio.get_event_loop().create_future()
+        self.pending[request_id] = response
+
+        try:
+            await self.send(service=service, msg=msg, request_id=request_id)
+            return await asyncio.wait_for(response, timeout=timeout / 1000)
+        except (asyncio.TimeoutError, zmq.error.ZMQError):
+            return None
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def read(self):
+        while not self.closed:
+            try:
+                raw = await self.socket.recv()
+            except zmq.error.ZMQError:
+                return
+
+            try:
+                reply = wire.loads(raw) if wire.is_binary(raw) else decode(raw)
+            except (ValueError, RecursionError):
+                reply = None
+
+            # Garbage says nothing about the peer, so it is dropped without touching what is known about its tagging
+            if not isinstance(reply, dict):
+                continue
+
+            if wire.is_binary(raw):
+                self.binary = True
+
+            if set(reply.keys()) == {'request_id', 'msg'}:
+                self.tagged = True
+                self.outstanding.clear()
+
+                request_id, reply = reply['request_id'], reply['msg']
+            else:
+                # Peers that have not upgraded reply with the bare message
+                self.tagged = False
+
+                if len(self.outstanding) != 1:
+                    self.outstanding.clear()
+                    continue
+
+                request_id = self.outstanding.pop()
+
+            # Replies to plain sends and to requests that already timed out are dropped
+            response = self.pending.get(request_id)
+            if response is not None and not response.done():
+                response.set_result(reply)
+
+    def close(self):
+        self.closed = True
+
+        if self.reader is not None:
+            self.reader.cancel()
+
+        for response in self.pending.values():
+            response.cancel()
+        self.pending.clear()
+
+        self.socket.close()
+
+
+class PeerPool:
+    '''
+    Keeps one open connection per peer verifying key so that messages do not pay for a new socket, a certificate load
+    and a CurveZMQ handshake every time. Connections are replaced when the IP for a peer changes.
+    '''
+    def __init__(self, ctx: zmq.asyncio.Context, wallet: Wallet, cert_dir=DEFAULT_DIR, linger=500):
+        self.ctx = ctx
+        self.wallet = wallet
+        self.cert_dir = pathlib.Path(cert_dir)
+        self.linger = linger
+
+        self.connections = {}
+        self.server_keys = {}
+
+    def server_key(self, vk):
+        key = self.server_keys.get(vk)
+
+        if key is None:
+            filename = str(self.cert_dir / f'{vk}.key')
+            if not os.path.exists(filename):
+                return None
+
+            key, _ = load_certificate(filename)
+            self.server_keys[vk] = key
+
+        return key
+
+    def get(self, vk, ip):
+        connection = self.connections.get(vk)
+
+        if connection is not None and connection.ip == ip and not connection.closed:
+            return connection
+
+        self.drop(vk)
+
+        server_key = self.server_key(vk)
+        if server_key is None:
+            return None
+
+        connection = PeerConnection(vk=vk, ip=ip, server_key=server_key, wallet=self.wallet, ctx=self.ctx,
+                                    linger=self.linger)
+
+        if not connection.connect():
+            return None
+
+        self.connections[vk] = connection
+
+        return connection
+
+    async def send(self, msg: dict, service, vk, ip):
+        connection = self.get(vk, ip)
+        if connection is None:
+            return None
+
+        try:
+            await connection.send(service=service, msg=msg)
+        except zmq.error.ZMQError as e:
+            logger.error(f'Could not send to {ip}: {e}')
+            self.drop(vk)
+
+    async def request(self, msg: dict, service, vk, ip, timeout=1000):
+        connection = self.get(vk, ip)
+        if connection is None:
+            return None
+
+        return await connection.request(service=service, msg=msg, timeout=timeout)
+
+    def untagged(self, vk):
+        # True once the peer is known to send replies without request ids
+        connection = self.connections.get(vk)
+        return connection is not None and connection.tagged is False
+
+    def sync(self, peers: dict):
+        # Close connections to peers that have left or moved
+        for vk, connection in list(self.connections.items()):
+            if peers.get(vk) != connection.ip:
+                self.drop(vk)
+
+    def forget_keys(self):
+        # Called after the certificate directory is rewritten. Peers that lost their certificate are disconnected.
+        self.server_keys.clear()
+
+        for vk in list(self.connections.keys()):
+            if self.server_key(vk) is None:
+                self.drop(vk)
+
+    def drop(self, vk):
+        connection = self.connections.pop(vk, None)
+        if connection is not None:
+            connection.close()
+
+    def close(self):
+        for vk in list(self.connections.keys()):
+            self.drop(vk)
+
+
+async def secure_send(msg: dict, service, wallet: Wallet, vk, ip, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR,
+                      pool: PeerPool=None):
     #if wallet.verifying_key == vk:
     #    return
 
+    if pool is not None:
+        return await pool.send(msg=msg, service=service, vk=vk, ip=ip)
+
     socket = ctx.socket(zmq.DEALER)
     socket.setsockopt(zmq.LINGER, linger)
     socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
@@ -224,10 +631,17 @@ async def secure_send(msg: dict, service, wallet: Wallet, vk, ip, ctx: zmq.async
 
 
 async def secure_request(msg: dict, service: str, wallet: Wallet, vk: str, ip: str, ctx: zmq.asyncio.Context,
-                         linger=500, timeout=1000, cert_dir=DEFAULT_DIR):
+                         linger=500, timeout=1000, cert_dir=DEFAULT_DIR, pool: PeerPool=None):
     #if wallet.verifying_key == vk:
     #    return
 
+    # Peers that do not tag their replies cannot have requests matched on a shared socket, so they get a socket per
+    # request as before pooling
+    if pool is not None and not pool.untagged(vk):
+        response = await pool.request(msg=msg, service=service, vk=vk, ip=ip, timeout=timeout)
+        if response is not None or not pool.untagged(vk):
+            return response
+
     socket = ctx.socket(zmq.DEALER)
     socket.setsockopt(zmq.LINGER, linger)
     socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
@@ -269,11 +683,13 @@ async def secure_request(msg: dict, service: str, wallet: Wallet, vk: str, ip: s
     return msg
 
 
-async def secure_multicast(msg: dict, service, wallet: Wallet, peer_map: dict, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR):
+async def secure_multicast(msg: dict, service, wallet: Wallet, peer_map: dict, ctx: zmq.asyncio.Context, linger=500, cert_dir=DEFAULT_DIR,
+                           pool: PeerPool=None):
     coroutines = []
     for vk, ip in peer_map.items():
         coroutines.append(
-            secure_send(msg=msg, service=service, cert_dir=cert_dir, wallet=wallet, vk=vk, ip=ip, ctx=ctx, linger=linger)
+            secure_send(msg=msg, service=service, cert_dir=cert_dir, wallet=wallet, vk=vk, ip=ip, ctx=ctx, linger=linger,
+                        pool=pool)
         )
 
     await asyncio.gather(*coroutines)
@@ -1,7 +1,10 @@
 from contracting.db.driver import ContractDriver
-from pymongo import MongoClient, DESCENDING
+from pymongo import MongoClient, ASCENDING, DESCENDING, ReplaceOne, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
 
 import lamden
+import threading
+from collections import OrderedDict
 from lamden.logger.base import get_logger
 
 BLOCK_HASH_KEY = '_current_block_hash'
@@ -9,11 +12,14 @@ BLOCK_NUM_HEIGHT = '_current_block_height'
 NONCE_KEY = '__n'
 PENDING_NONCE_KEY = '__pn'
 
+# Most (sender, processor) pairs each nonce cache holds before the least recently used are dropped
+NONCE_CACHE_SIZE = 100_000
+
 log = get_logger('STATE')
 
 
 class NonceStorage:
-    def __init__(self, port=27027, db_name='lamden', nonce_collection='nonces', pending_collection='pending_nonces', config_path=lamden.__path__[0]):
+    def __init__(self, port=27027, db_name='lamden', nonce_collection='nonces', pending_collection='pending_nonces', config_path=lamden.__path__[0], cache_size=NONCE_CACHE_SIZE):
         self.config_path = config_path
 
         self.port = port
@@ -23,6 +29,17 @@ class NonceStorage:
         self.nonces = self.db[nonce_collection]
         self.pending_nonces = self.db[pending_collection]
 
+        # Write-back LRU cache in front of the collections. Values are flushed to the database on commit.
+        self.cache_size = cache_size
+        self.nonce_cache = OrderedDict()
+        self.pending_cache = OrderedDict()
+
+        self.dirty_nonces = set()
+        self.dirty_pending_nonces = set()
+
+        # Nonces are read and set from validation threads as well as the event loop
+        self.lock = threading.RLock()
+
     @staticmethod
     def get_one(sender, processor, db):
         v = db.find_one(
@@ -53,16 +70,87 @@ class NonceStorage:
         )
 
     def get_nonce(self, sender, processor):
-        return self.get_one(sender, processor, self.nonces)
+        return self.get_cached(sender, processor, self.nonce_cache, self.dirty_nonces, self.nonces)
 
     def get_pending_nonce(self, sender, processor):
-        return self.get_one(sender, processor, self.pending_nonces)
+        return self.get_cached(sender, processor, self.pending_cache, self.dirty_pending_nonces, self.pending_nonces)
 
     def set_nonce(self, sender, processor, value):
-        self.set_one(sender, processor, value, self.nonces)
+        with self.lock:
+            self.set_cached(sender, processor, value, self.nonce_cache, self.dirty_nonces)
 
     def set_pending_nonce(self, sender, processor, value):
-        self.set_one(sender, processor, value, self.pending_nonces)
+        with self.lock:
+            self.set_cached(sender, processor, value, self.pending_cache, self.dirty_pending_nonces)
+
+    def get_cached(self, sender, processor, cache, dirty, db):
+        # Misses are cached as None so unknown senders only cost one round trip. They are read under the lock, so a
+        # value set by another thread while the database was being read is never replaced with the older one.
+        key = (sender, processor)
+        with self.lock:
+            if key in cache:
+                cache.move_to_end(key)
+                return cache[key]
+
+            value = self.get_one(sender, processor, db)
+
+            cache[key] = value
+            self.evict(cache, dirty)
+
+            return value
+
+    def set_cached(self, sender, processor, value, cache, dirty):
+        key = (sender, processor)
+        cache[key] = value
+        cache.move_to_end(key)
+        dirty.add(key)
+
+        self.evict(cache, dirty)
+
+    def evict(self, cache, dirty):
+        # Drops the least recently used entries. Dirty ones are kept until they have been committed.
+        excess = len(cache) - self.cache_size
+        if excess <= 0:
+            return
+
+        stale = []
+        for key in cache:
+            if len(stale) == excess:
+                break
+            if key not in dirty:
+                stale.append(key)
+
+        for key in stale:
+            del cache[key]
+
+    @staticmethod
+    def write_dirty(cache, dirty, db):
+        if len(dirty) == 0:
+            return
+
+        requests = [
+            UpdateOne(
+                {
+                    'sender': sender,
+                    'processor': processor
+                },
+                {
+                    '$set':
+                        {
+                            'value': cache[(sender, processor)]
+                        }
+                }, upsert=True
+            ) for sender, processor in dirty
+        ]
+
+        db.bulk_write(requests, ordered=False)
+        dirty.clear()
+
+    def commit(self):
+        # Write every nonce changed since the last commit to the database in one bulk operation per collection
+        with self.lock:
+            self.write_dirty(self.nonce_cache, self.dirty_nonces, self.nonces)
+            self.write_dirty(self.pending_cache, self.dirty_pending_nonces, self.pending_nonces)
 
     def get_latest_nonce(self, sender, processor):
         latest_nonce = self.get_pending_nonce(sender=sender, processor=processor)
@@ -76,11 +164,21 @@ class NonceStorage:
         return latest_nonce
 
     def flush(self):
-        self.nonces.drop()
-        self.pending_nonces.drop()
+        with self.lock:
+            self.nonces.drop()
+            self.pending_nonces.drop()
+
+            self.nonce_cache.clear()
+            self.dirty_nonces.clear()
+
+            self.flush_pending()
 
     def flush_pending(self):
-        self.pending_nonces.drop()
+        with self.lock:
+            self.pending_nonces.drop()
+
+            self.pending_cache.clear()
+            self.dirty_pending_nonces.clear()
 
 
 def get_latest_block_hash(driver: ContractDriver):
@@ -90,8 +188,11 @@ def get_latest_block_hash(driver: ContractDriver):
     return latest_hash
 
 
-def set_latest_block_hash(h, driver: ContractDriver):
-    driver.driver.set(BLOCK_HASH_KEY, h)
+def set_latest_block_hash(h, driver: ContractDriver, cached=False):
+    if cached:
+        driver.set(BLOCK_HASH_KEY, h)
+    else:
+        driver.driver.set(BLOCK_HASH_KEY, h)
 
 
 def get_latest_block_height(driver: ContractDriver):
@@ -101,38 +202,48 @@ def get_latest_block_height(driver: ContractDriver):
     return h
 
 
-def set_latest_block_height(h, driver: ContractDriver):
-    driver.driver.set(BLOCK_NUM_HEIGHT, h)
-
+def set_latest_block_height(h, driver: ContractDriver, cached=False):
+    if cached:
+        driver.set(BLOCK_NUM_HEIGHT, h)
+    else:
+        driver.driver.set(BLOCK_NUM_HEIGHT, h)
 
-def update_state_with_transaction(tx, driver: ContractDriver, nonces: NonceStorage):
-    nonces_to_delete = []
 
+# When cached is True, writes go through the driver's cache and are only persisted on the next driver.commit().
+# This lets several blocks be applied before committing without the cache shadowing newer writes.
+def update_state_with_transaction(tx, driver: ContractDriver, nonces: NonceStorage, cached=False):
     if tx['state'] is not None and len(tx['state']) > 0:
         for delta in tx['state']:
-            driver.driver.set(delta['key'], delta['value'])
+            if cached:
+                driver.set(delta['key'], delta['value'])
+            else:
+                driver.driver.set(delta['key'], delta['value'])
             log.debug(f"{delta['key']} -> {delta['value']}")
 
-            nonces.set_nonce(
-                sender=tx['transaction']['payload']['sender'],
-                processor=tx['transaction']['payload']['processor'],
-                value=tx['transaction']['payload']['nonce'] + 1
-            )
+        sender = tx['transaction']['payload']['sender']
+        processor = tx['transaction']['payload']['processor']
 
-            nonces_to_delete.append((tx['transaction']['payload']['sender'], tx['transaction']['payload']['processor']))
+        nonces.set_nonce(
+            sender=sender,
+            processor=processor,
+            value=tx['transaction']['payload']['nonce'] + 1
+        )
 
-    for n in nonces_to_delete:
-        nonces.set_pending_nonce(*n, value=None)
+        nonces.set_pending_nonce(sender=sender, processor=processor, value=None)
 
 
-def update_state_with_block(block, driver: ContractDriver, nonces: NonceStorage):
+def update_state_with_block(block, driver: ContractDriver, nonces: NonceStorage, cached=False):
     for sb in block['subblocks']:
         for tx in sb['transactions']:
-            update_state_with_transaction(tx, driver, nonces)
+            update_state_with_transaction(tx, driver, nonces, cached=cached)
 
     # Update our block hash and block num
-    set_latest_block_hash(block['hash'], driver=driver)
-    set_latest_block_height(block['number'], driver=driver)
+    set_latest_block_hash(block['hash'], driver=driver, cached=cached)
+    set_latest_block_height(block['number'], driver=driver, cached=cached)
+
+    # Flush all nonce updates for the block at once. Cached updates are flushed with the driver.
+    if not cached:
+        nonces.commit()
 
 
 class BlockStorage:
@@ -151,6 +262,24 @@ class BlockStorage:
         self.blocks = self.db[blocks_collection]
         self.txs = self.db[tx_collection]
 
+    def create_indexes(self):
+        # Blocks are looked up by number during catchup and by hash from the webserver.
+        # Without these every lookup is a full collection scan.
+        self.create_index(self.blocks, 'number')
+        self.create_index(self.blocks, 'hash')
+        self.create_index(self.txs, 'hash')
+
+    @staticmethod
+    def create_index(collection, key):
+        # Databases written before blocks were deduplicated can hold the same block more than once, as well as
+        # failed blocks that all share one hash. A unique index cannot be built over those, so fall back to a plain
+        # one rather than refusing to start.
+        try:
+            collection.create_index(key, unique=True)
+        except OperationFailure as e:
+            log.warning(f'Could not create a unique index on {collection.name}.{key}. Creating a non-unique one instead: {e}')
+            collection.create_index(key)
+
     def q(self, v):
         if isinstance(v, int):
             return {'number': v}
@@ -170,14 +299,19 @@ class BlockStorage:
 
     def put(self, data, collection=BLOCK):
         if collection == BlockStorage.BLOCK:
-            _id = self.blocks.insert_one(data)
-            del data['_id']
+            c = self.blocks
         elif collection == BlockStorage.TX:
-            _id = self.txs.insert_one(data)
-            del data['_id']
+            c = self.txs
         else:
             return False
 
+        try:
+            _id = c.insert_one(data)
+        except DuplicateKeyError:
+            _id = None
+
+        data.pop('_id', None)
+
         return _id is not None
 
     def get_last_n(self, n, collection=BLOCK):
@@ -200,6 +334,15 @@ class BlockStorage:
 
         return blocks
 
+    def get_blocks(self, start, end):
+        # Streams blocks in ascending order with a cursor instead of a query per block
+        cursor = self.blocks.find(
+            {'number': {'$gte': start, '$lte': end}}, {'_id': False}
+        ).sort('number', ASCENDING)
+
+        for block in cursor:
+            yield block
+
     def get_tx(self, h):
         tx = self.txs.find_one({'hash': h})
 
@@ -212,14 +355,41 @@ class BlockStorage:
         self.blocks.drop()
         self.txs.drop()
 
+        # Dropping a collection drops its indexes as well
+        self.create_indexes()
+
     def flush(self):
         self.drop_collections()
 
     def store_block(self, block):
-        self.put(block, BlockStorage.BLOCK)
+        # Transactions first so that a stored block always has its transactions available
         self.store_txs(block)
 
+        # Upsert so that storing the same block twice is a no-op instead of a duplicate key error
+        if block.get('number') is not None:
+            q = self.q(block['number'])
+        else:
+            q = self.q(block['hash'])
+
+        self.blocks.replace_one(q, block, upsert=True)
+
+    def store_blocks(self, blocks):
+        # Stores several blocks with one bulk write for all their transactions and one for the blocks
+        if len(blocks) == 0:
+            return
+
+        self.store_txs({'subblocks': [sb for block in blocks for sb in block['subblocks']]})
+
+        requests = [ReplaceOne(self.q(block['number']), block, upsert=True) for block in blocks]
+        self.blocks.bulk_write(requests, ordered=False)
+
     def store_txs(self, block):
+        requests = []
         for subblock in block['subblocks']:
             for tx in subblock['transactions']:
-                self.put(tx, BlockStorage.TX)
+                requests.append(ReplaceOne({'hash': tx['hash']}, tx, upsert=True))
+
+        if len(requests) == 0:
+            return
+
+        self.txs.bulk_write(requests, ordered=False)
@@ -0,0 +1,208 @@
+import re
+
+from contracting.db.encoder import encode, decode
+
+'''
+Compact binary framing for router messages.
+
+Every frame starts with MAGIC. JSON frames can never start with a zero byte, so a receiver can tell the two apart
+without any other context. Values are written as a one byte tag followed by their contents:
+
+    None, True, False       tag only
+    int                     zigzag varint
+    str                     varint length + utf-8
+    hex str                 varint length + raw bytes. Hashes, signatures and keys travel at half the size.
+    bytes                   varint length + raw bytes
+    list / tuple            varint count + values
+    dict                    varint count + (key, value) pairs. Common keys are written as a single byte.
+    anything else           varint length + contracting JSON encoding of the value
+
+Decoding a frame gives the same Python objects as decode(encode(value)), so processors cannot tell which format a
+message arrived in. Hashes are still computed over canonical JSON, never over these frames.
+'''
+
+MAGIC = b'\x00LW\x01'
+BINARY = 'binary'
+
+NONE = 0
+TRUE = 1
+FALSE = 2
+INT = 3
+STR = 4
+HEX = 5
+BYTES = 6
+LIST = 7
+DICT = 8
+JSON = 9
+KEY = 10
+
+# Deepest nesting of lists and dicts a frame may have. Real messages are nowhere near it.
+MAX_DEPTH = 64
+
+# Shortest string that is worth sending as raw bytes
+MIN_HEX_LENGTH = 16
+HEX_STRING = re.compile('[0-9a-f]+')
+
+# Append only. Changing the order of existing keys breaks compatibility with other nodes.
+KEYS = (
+    'service', 'msg', 'request_id', 'wire', 'response', 'name', 'arg',
+    'hash', 'number', 'previous', 'subblocks', 'subblock', 'transactions', 'transaction',
+    'payload', 'metadata', 'signature', 'timestamp', 'sender', 'nonce', 'processor',
+    'contract', 'function', 'kwargs', 'stamps_supplied', 'stamps_used', 'status', 'state',
+    'key', 'value', 'result', 'input_hash', 'merkle_tree', 'leaves', 'signer', 'signatures',
+    'merkle_leaves', 'origin', 'error', 'vk', 'ip', 'peers', 'to', 'amount',
+)
+KEY_INDEX = {k: i for i, k in enumerate(KEYS)}
+
+
+def is_binary(data: bytes):
+    return data[:len(MAGIC)] == MAGIC
+
+
+def write_varint(n: int, out: bytearray):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def read_varint(data, i):
+    n = 0
+    shift = 0
+    while True:
+        b = data[i]
+        i += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, i
+        shift += 7
+
+
+def write_bytes(tag, b: bytes, out: bytearray):
+    out.append(tag)
+    write_varint(len(b), out)
+    out += b
+
+
+def is_hex(s: str):
+    return len(s) >= MIN_HEX_LENGTH and len(s) % 2 == 0 and HEX_STRING.fullmatch(s) is not None
+
+
+def write_value(v, out: bytearray):
+    t = type(v)
+
+    if v is None:
+        out.append(NONE)
+    elif t is bool:
+        out.append(TRUE if v else FALSE)
+    elif t is int:
+        out.append(INT)
+        write_varint(v << 1 if v >= 0 else ((-v) << 1) - 1, out)
+    elif t is str:
+        if is_hex(v):
+            write_bytes(HEX, bytes.fromhex(v), out)
+        else:
+            write_bytes(STR, v.encode(), out)
+    elif t is bytes:
+        write_bytes(BYTES, v, out)
+    elif t is list or t is tuple:
+        out.append(LIST)
+        write_varint(len(v), out)
+        for item in v:
+            write_value(item, out)
+    elif t is dict and all(type(k) is str for k in v):
+        out.append(DICT)
+        write_varint(len(v), out)
+        for k, item in v.items():
+            index = KEY_INDEX.get(k)
+            if index is None:
+                write_bytes(STR, k.encode(), out)
+            else:
+                out.append(KEY)
+                out.append(index)
+            write_value(item, out)
+    else:
+        # Floats, decimals, datetimes and dicts with non string keys go through contracting so they decode
+        # exactly as they would from JSON
+        write_bytes(JSON, encode(v).encode(), out)
+
+
+def read_value(data, i, depth=0):
+    if depth > MAX_DEPTH:
+        raise ValueError('Frame is nested too deeply.')
+
+    tag = data[i]
+    i += 1
+
+    if tag == NONE:
+        return None, i
+    if tag == TRUE:
+        return True, i
+    if tag == FALSE:
+        return False, i
+    if tag == INT:
+        n, i = read_varint(data, i)
+        return (n >> 1) if n & 1 == 0 else -((n + 1) >> 1), i
+    if tag == LIST:
+        count, i = read_varint(data, i)
+        items = []
+        for _ in range(count):
+            item, i = read_value(data, i, depth + 1)
+            items.append(item)
+        return items, i
+    if tag == DICT:
+        count, i = read_varint(data, i)
+        d = {}
+        special = False
+        for _ in range(count):
+            if data[i] == KEY:
+                k = KEYS[data[i + 1]]
+                i += 2
+            else:
+                k, i = read_value(data, i, depth + 1)
+                special = special or k.startswith('__')
+            d[k], i = read_value(data, i, depth + 1)
+
+        # Keys like __fixed__ are turned in to objects when JSON is decoded, so do the same here
+        if special:
+            d = decode(encode(d))
+
+        return d, i
+
+    length, i = read_varint(data, i)
+    raw = bytes(data[i:i + length])
+    if len(raw) != length:
+        raise ValueError('Frame is truncated.')
+    i += length
+
+    if tag == STR:
+        return raw.decode(), i
+    if tag == HEX:
+        return raw.hex(), i
+    if tag == BYTES:
+        return raw, i
+    if tag == JSON:
+        return decode(raw), i
+
+    raise ValueError(f'Unknown tag {tag}.')
+
+
+def dumps(v) -> bytes:
+    out = bytearray(MAGIC)
+    write_value(v, out)
+    return bytes(out)
+
+
+def loads(data: bytes):
+    if not is_binary(data):
+        return None
+
+    try:
+        v, i = read_value(memoryview(data), len(MAGIC))
+    except (ValueError, IndexError, AttributeError, UnicodeDecodeError, RecursionError):
+        return None
+
+    if i != len(data):
+        return None
+
+    return v
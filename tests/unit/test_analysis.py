@@ -0,0 +1,106 @@
+from unittest import TestCase
+from lamden.nodes.delegate import analysis, scheduler
+import pathlib
+
+currency = (pathlib.Path(analysis.__file__).parent.parent.parent / 'contracts' / 'genesis' / 'currency.s.py').read_text()
+
+CALLER = (scheduler.CALLER, None)
+
+
+def arg(name):
+    return scheduler.ARG, name
+
+
+class TestAnalysis(TestCase):
+    def test_currency_transfer(self):
+        reads, writes = analysis.analyze('currency', currency)['transfer']
+
+        self.assertEqual(writes, {('currency.balances', (CALLER,)), ('currency.balances', (arg('to'),))})
+        self.assertEqual(reads, writes)
+
+    def test_currency_multi_key_access(self):
+        reads, writes = analysis.analyze('currency', currency)['transfer_from']
+
+        self.assertIn(('currency.balances', (arg('main_account'), CALLER)), writes)
+        self.assertIn(('currency.balances', (arg('main_account'),)), writes)
+        self.assertIn(('currency.balances', (arg('to'),)), writes)
+
+    def test_only_exported_functions(self):
+        templates = analysis.analyze('currency', currency)
+
+        self.assertNotIn('seed', templates)
+        self.assertEqual(templates['balance_of'], ({('currency.balances', (arg('account'),))}, set()))
+
+    def test_compiled_code(self):
+        code = '''
+__balances = Hash(default_value=0, contract='con', name='balances')
+__owner = Variable(contract='con', name='owner')
+
+@__export('con')
+def send(to: str):
+    assert __owner.get() == ctx.caller
+    __move(ctx.caller, to)
+
+def __move(a, b):
+    __balances[a] -= 1
+    __balances[b, 'x'] += 1
+'''
+        reads, writes = analysis.analyze('con', code)['send']
+
+        self.assertEqual(writes, {('con.balances', (CALLER,)), ('con.balances', (arg('to'), ('value', 'x')))})
+        self.assertIn(('con.owner', ()), reads)
+
+    def test_variable_set_and_get(self):
+        code = '''
+v = Variable()
+
+@export
+def set(x: str):
+    v.set(x)
+
+@export
+def get():
+    return v.get()
+'''
+        templates = analysis.analyze('con', code)
+
+        self.assertEqual(templates['set'], (set(), {('con.v', ())}))
+        self.assertEqual(templates['get'], ({('con.v', ())}, set()))
+
+    def test_computed_keys_left_out(self):
+        code = '''
+h = Hash()
+
+@export
+def f(to: str):
+    k = to + 'x'
+    h[k] = 1
+    to = k
+    h[to] = 2
+    for i in range(3):
+        h[i] = 3
+'''
+        self.assertEqual(analysis.analyze('con', code)['f'], (set(), set()))
+
+    def test_foreign_hash_is_read_only(self):
+        code = '''
+fh = ForeignHash(foreign_contract='currency', foreign_name='balances')
+
+@export
+def f():
+    fh[ctx.caller] = fh[ctx.caller]
+'''
+        self.assertEqual(analysis.analyze('con', code)['f'], ({('currency.balances', (CALLER,))}, set()))
+
+    def test_syntax_error_returns_nothing(self):
+        self.assertEqual(analysis.analyze('con', 'def ('), {})
+
+    def test_templates_predict_conflicts(self):
+        access = scheduler.AccessSets()
+        for function, (reads, writes) in analysis.analyze('currency', currency).items():
+            access.add('currency', function, reads=reads, writes=writes)
+
+        payload = {'sender': 'a', 'contract': 'currency', 'function': 'approve', 'kwargs': {'amount': 1, 'to': 'b'}}
+        reads, writes = access.predict({'payload': payload})
+
+        self.assertIn('currency.balances:a:b', writes)
@@ -379,6 +379,99 @@ class TestNode(TestCase):
         self.assertEqual(block, blocks[1])
         self.assertEqual(len(node.new_block_processor.q), 1)
 
+    def test_batch_mode_applies_blocks_and_stores_on_commit(self):
+        blocks = generate_blocks(5)
+
+        driver = ContractDriver(driver=InMemDriver())
+        node = base.Node(
+            socket_base='tcp://127.0.0.1:18002',
+            ctx=self.ctx,
+            wallet=Wallet(),
+            constitution={
+                'masternodes': [Wallet().verifying_key],
+                'delegates': [Wallet().verifying_key]
+            },
+            driver=driver,
+            store=True,
+            blocks=self.blocks,
+        )
+
+        node.start_batch(commit_interval=2)
+
+        for block in blocks:
+            node.process_new_block(block)
+
+        self.assertEqual(node.current_height, 5)
+
+        # Blocks 1-4 were committed in two batches. Block 5 is still pending.
+        self.assertEqual(node.blocks.get_block(4), blocks[3])
+        self.assertIsNone(node.blocks.get_block(5))
+
+        node.end_batch()
+
+        self.assertFalse(node.batch_mode)
+        self.assertEqual(node.blocks.get_block(5), blocks[4])
+        self.assertEqual(node.driver.driver.get(storage.BLOCK_NUM_HEIGHT), 5)
+
+    def test_governance_sockets_only_refreshed_when_members_change(self):
+        blocks = generate_blocks(3)
+
+        driver = ContractDriver(driver=InMemDriver())
+        node = base.Node(
+            socket_base='tcp://127.0.0.1:18002',
+            ctx=self.ctx,
+            wallet=Wallet(),
+            constitution={
+                'masternodes': [Wallet().verifying_key],
+                'delegates': [Wallet().verifying_key]
+            },
+            driver=driver
+        )
+
+        refreshes = []
+        node.socket_authenticator.refresh_governance_sockets = lambda: refreshes.append(1)
+
+        for block in blocks:
+            node.process_new_block(block)
+
+        self.assertEqual(len(refreshes), 1)
+
+        node.client.set_var(contract='delegates', variable='S', arguments=['members'], value=[Wallet().verifying_key])
+
+        node.refresh_governance_sockets()
+
+        self.assertEqual(len(refreshes), 2)
+
+    def test_blocks_after_start_keep_pooled_connections(self):
+        blocks = generate_blocks(3)
+
+        driver = ContractDriver(driver=InMemDriver())
+        node = base.Node(
+            socket_base='tcp://127.0.0.1:18002',
+            ctx=self.ctx,
+            wallet=Wallet(),
+            constitution={
+                'masternodes': [Wallet().verifying_key],
+                'delegates': [Wallet().verifying_key]
+            },
+            driver=driver
+        )
+
+        refreshes = []
+        node.socket_authenticator.refresh_governance_sockets = lambda: refreshes.append(1)
+
+        forgets = []
+        node.pool.forget_keys = lambda: forgets.append(1)
+
+        # What start does once catchup is done
+        node.refresh_governance_sockets()
+
+        for block in blocks:
+            node.process_new_block(block)
+
+        self.assertEqual(len(refreshes), 1)
+        self.assertEqual(len(forgets), 1)
+
     def test_start_boots_up_normally(self):
         # This MN will also provide 'catch up' services
 
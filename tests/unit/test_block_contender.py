@@ -6,6 +6,7 @@ from lamden.crypto.wallet import Wallet
 from lamden.nodes.masternode import contender
 import asyncio
 import secrets
+import time
 
 from contracting.db.driver import ContractDriver
 
@@ -557,6 +558,65 @@ class TestAggregator(TestCase):
 
         self.assertNotEqual(res['hash'], 'f' * 64)
 
+    def test_gather_subblocks_wakes_up_when_contenders_arrive(self):
+        a = contender.Aggregator(driver=ContractDriver())
+
+        contenders = [[MockSBC('input_1', 'res_1', 0).to_dict(),
+                       MockSBC('input_2', 'res_2', 1).to_dict(),
+                       MockSBC('input_3', 'res_3', 2).to_dict(),
+                       MockSBC('input_4', 'res_4', 3).to_dict()] for _ in range(4)]
+
+        async def send():
+            for c in contenders:
+                await asyncio.sleep(0.01)
+                a.sbc_inbox.q.append(c)
+                a.sbc_inbox.signal.set()
+
+        start = time.time()
+        res, _ = self.loop.run_until_complete(asyncio.gather(a.gather_subblocks(4), send()))
+
+        self.assertLess(time.time() - start, a.seconds_to_timeout)
+        self.assertEqual(res['subblocks'][0]['merkle_leaves'][0], 'res_1')
+
+    def test_gather_subblocks_with_previous_only_counts_contenders_built_on_it(self):
+        a = contender.Aggregator(driver=ContractDriver(), seconds_to_timeout=0.5)
+
+        def make(result, previous):
+            c = [MockSBC('input_1', result, 0).to_dict()]
+            c[0]['previous'] = previous
+            return c
+
+        current = [make('res_1', 'a' * 64) for _ in range(2)]
+        ahead = [make('res_X', 'b' * 64) for _ in range(3)]
+
+        a.sbc_inbox.q = [ahead[0], current[0], ahead[1], current[1], ahead[2]]
+
+        res = self.loop.run_until_complete(a.gather_subblocks(2, expected_subblocks=1, previous='a' * 64))
+
+        self.assertEqual(res['subblocks'][0]['merkle_leaves'][0], 'res_1')
+        self.assertListEqual(a.sbc_inbox.q, ahead)
+
+    def test_gather_subblocks_records_first_response(self):
+        a = contender.Aggregator(driver=ContractDriver())
+
+        a.sbc_inbox.q = [[MockSBC('input_1', 'res_1', 0).to_dict()]]
+
+        start = time.time()
+        self.loop.run_until_complete(a.gather_subblocks(1, expected_subblocks=1))
+
+        self.assertGreaterEqual(a.first_response, start)
+
+    def test_prune_keeps_contenders_built_on_block(self):
+        s = contender.SBCInbox()
+
+        keep = [dict(subblock, previous='a' * 64)]
+        drop = [dict(subblock, previous='b' * 64)]
+
+        s.q = [keep, drop]
+        s.prune('a' * 64)
+
+        self.assertListEqual(s.q, [keep])
+
 
 class TestSBCProcessor(TestCase):
     def test_subblock_with_bad_sb_idx_returns_false(self):
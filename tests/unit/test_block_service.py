@@ -73,6 +73,63 @@ class TestBlockService(TestCase):
 
         self.assertEqual(res, block)
 
+    def test_service_returns_blocks_for_range(self):
+        blocks = [{
+            'hash': f'{i:064x}',
+            'number': i,
+            'previous': '0' * 64,
+            'subblocks': []
+        } for i in range(1, 6)]
+
+        for block in blocks:
+            self.b.blocks.store_block(block)
+
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': [2, 4]
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertEqual(res, blocks[1:4])
+
+    def test_service_bounds_block_range(self):
+        for i in range(1, base.MAX_BLOCKS_PER_REQUEST + 10):
+            self.b.blocks.store_block({
+                'hash': f'{i:064x}',
+                'number': i,
+                'previous': '0' * 64,
+                'subblocks': []
+            })
+
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': [1, base.MAX_BLOCKS_PER_REQUEST + 10]
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertEqual(len(res), base.MAX_BLOCKS_PER_REQUEST)
+
+    def test_service_returns_none_if_block_range_malformed(self):
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': [5, 1]
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertIsNone(res)
+
+        msg = {
+            'name': base.GET_BLOCKS,
+            'arg': 5
+        }
+
+        res = self.loop.run_until_complete(self.b.process_message(msg))
+
+        self.assertIsNone(res)
+
     def test_service_returns_none_if_bad_message(self):
         msg = {
             'name': base.GET_HEIGHT,
@@ -0,0 +1,169 @@
+from unittest import TestCase
+import pathlib
+import shutil
+import tempfile
+
+from lamden.blocklog import BlockLog, INDEX_FILENAME, segment_filename
+
+
+def make_block(number, txs=[]):
+    return {
+        'hash': f'{number:064x}',
+        'number': number,
+        'previous': f'{number - 1:064x}',
+        'subblocks': [
+            {
+                'transactions': txs
+            }
+        ]
+    }
+
+
+class TestBlockLog(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.db = BlockLog(root=self.root, index_interval=4)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def test_get_block_by_number(self):
+        block = make_block(1)
+        self.db.store_block(block)
+
+        self.assertEqual(self.db.get_block(1), block)
+
+    def test_get_block_by_hash(self):
+        block = make_block(1)
+        self.db.store_block(block)
+
+        self.assertEqual(self.db.get_block(block['hash']), block)
+
+    def test_get_none_block(self):
+        self.db.store_block(make_block(1))
+
+        self.assertIsNone(self.db.get_block(2))
+        self.assertIsNone(self.db.get_block('b'))
+        self.assertIsNone(self.db.get_block())
+
+    def test_get_block_between_sparse_index_entries(self):
+        blocks = [make_block(i) for i in range(1, 20)]
+        for block in blocks:
+            self.db.store_block(block)
+
+        for block in blocks:
+            self.assertEqual(self.db.get_block(block['number']), block)
+
+    def test_get_blocks_returns_range_in_order(self):
+        blocks = [make_block(i) for i in range(1, 20)]
+        for block in blocks:
+            self.db.store_block(block)
+
+        self.assertEqual(list(self.db.get_blocks(6, 13)), blocks[5:13])
+        self.assertEqual(list(self.db.get_blocks(18, 30)), blocks[17:])
+        self.assertEqual(list(self.db.get_blocks(25, 30)), [])
+
+    def test_put_block_below_height_returns_false(self):
+        self.assertTrue(self.db.put(make_block(2)))
+        self.assertFalse(self.db.put(make_block(1)))
+
+    def test_put_other_returns_false(self):
+        self.assertFalse(self.db.put(make_block(1), 999))
+
+    def test_store_block_twice_is_noop(self):
+        block = make_block(1)
+
+        self.db.store_block(block)
+        self.db.store_block(block)
+
+        self.assertEqual(self.db.get_last_n(10), [block])
+
+    def test_get_last_n_blocks(self):
+        for i in range(1, 11):
+            self.db.store_block(make_block(i))
+
+        got_blocks = self.db.get_last_n(3, BlockLog.BLOCK)
+
+        nums = [b['number'] for b in got_blocks]
+
+        self.assertEqual(nums, [10, 9, 8])
+
+    def test_get_last_n_more_than_stored(self):
+        for i in range(1, 3):
+            self.db.store_block(make_block(i))
+
+        nums = [b['number'] for b in self.db.get_last_n(5)]
+
+        self.assertEqual(nums, [2, 1])
+
+    def test_get_none_from_wrong_n_collection(self):
+        self.assertIsNone(self.db.get_last_n(3, 5))
+
+    def test_store_block_indexes_txs(self):
+        tx_1 = {'hash': 'something1', 'key': '1'}
+        tx_2 = {'hash': 'something2', 'key': '2'}
+
+        self.db.store_block(make_block(1, [tx_1, tx_2]))
+
+        self.assertEqual(self.db.get_tx('something1'), tx_1)
+        self.assertEqual(self.db.get_tx('something2'), tx_2)
+        self.assertIsNone(self.db.get_tx('something3'))
+
+    def test_put_tx(self):
+        tx = {'hash': 'something', 'key': 'value'}
+
+        self.db.put(tx, BlockLog.TX)
+
+        self.assertEqual(self.db.get_tx('something'), tx)
+
+    def test_blocks_readable_after_reopen(self):
+        tx = {'hash': 'something1', 'key': '1'}
+
+        for i in range(1, 10):
+            self.db.store_block(make_block(i, [tx] if i == 5 else []))
+
+        self.db.close()
+        self.db = BlockLog(root=self.root, index_interval=4)
+
+        self.assertEqual(self.db.get_block(7), make_block(7))
+        self.assertEqual(self.db.get_tx('something1'), tx)
+        self.assertEqual(self.db.height, 9)
+
+    def test_segments_roll_over(self):
+        self.db.close()
+        self.db = BlockLog(root=self.root, segment_size=256, index_interval=4)
+
+        blocks = [make_block(i) for i in range(1, 20)]
+        for block in blocks:
+            self.db.store_block(block)
+
+        self.assertTrue((pathlib.Path(self.root) / segment_filename(1)).exists())
+
+        for block in blocks:
+            self.assertEqual(self.db.get_block(block['number']), block)
+
+    def test_unindexed_bytes_discarded_on_reopen(self):
+        self.db.store_block(make_block(1))
+        self.db.close()
+
+        # Simulate a crash after the record was written but before it was indexed
+        with open(pathlib.Path(self.root) / segment_filename(0), 'ab') as f:
+            f.write(b'garbage')
+
+        with open(pathlib.Path(self.root) / INDEX_FILENAME, 'a') as f:
+            f.write('b 2 partial')
+
+        self.db = BlockLog(root=self.root, index_interval=4)
+        self.db.store_block(make_block(2))
+
+        self.assertEqual(self.db.get_block(1), make_block(1))
+        self.assertEqual(self.db.get_block(2), make_block(2))
+
+    def test_drop_collections(self):
+        self.db.store_block(make_block(1))
+
+        self.db.drop_collections()
+
+        self.assertIsNone(self.db.get_block(1))
+        self.assertEqual(self.db.get_last_n(1), [])
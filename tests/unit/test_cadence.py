@@ -0,0 +1,144 @@
+from unittest import TestCase
+from lamden.nodes.masternode.cadence import BatchController
+import asyncio
+import time
+
+
+class MockSignal:
+    def __init__(self):
+        self.waits = 0
+
+    async def wait(self, timeout=0.05):
+        self.waits += 1
+        await asyncio.sleep(min(timeout, 0.01))
+
+
+class TestBatchController(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_first_interval_leaves_half_the_slo(self):
+        c = BatchController(slo=2)
+
+        self.assertEqual(c.interval(), 1)
+        self.assertEqual(c.target_size(), c.max_batch)
+
+    def test_interval_stretches_past_one_second_when_rounds_are_quick(self):
+        c = BatchController(slo=2)
+        c.record(transactions=10, execution=0.1, aggregation=0.1)
+
+        self.assertAlmostEqual(c.interval(), 1.8)
+
+    def test_interval_capped_at_max_interval(self):
+        c = BatchController(slo=2, max_interval=1)
+        c.record(transactions=10, execution=0.1, aggregation=0.1)
+
+        self.assertEqual(c.interval(), 1)
+
+    def test_interval_is_what_slo_leaves_after_a_round(self):
+        c = BatchController(slo=2, max_interval=1)
+        c.record(transactions=100, execution=1.2, aggregation=0.3)
+
+        self.assertAlmostEqual(c.interval(), 0.5)
+
+    def test_interval_never_below_min(self):
+        c = BatchController(slo=2, min_interval=0.05)
+        c.record(transactions=100, execution=3, aggregation=1)
+
+        self.assertEqual(c.interval(), 0.05)
+
+    def test_target_size_fits_execution_in_slo(self):
+        c = BatchController(slo=2, min_interval=0, max_batch=1000)
+        c.record(transactions=100, execution=1, aggregation=1)
+
+        # 10ms per transaction, 1s left after aggregation
+        self.assertEqual(c.target_size(), 100)
+
+    def test_target_size_capped_at_max_batch(self):
+        c = BatchController(slo=2, max_batch=250)
+        c.record(transactions=100, execution=0.01, aggregation=0.01)
+
+        self.assertEqual(c.target_size(), 250)
+
+    def test_target_size_at_least_one(self):
+        c = BatchController(slo=2)
+        c.record(transactions=1, execution=5, aggregation=5)
+
+        self.assertEqual(c.target_size(), 1)
+
+    def test_record_smooths_measurements(self):
+        c = BatchController(smoothing=0.5)
+        c.record(transactions=10, execution=1, aggregation=1)
+        c.record(transactions=10, execution=2, aggregation=0)
+
+        self.assertEqual(c.execution, 1.5)
+        self.assertEqual(c.aggregation, 0.5)
+
+    def test_empty_round_measures_overhead(self):
+        c = BatchController()
+        c.record(transactions=10, execution=1, aggregation=1)
+        c.record(transactions=0, execution=0.5, aggregation=1)
+
+        self.assertAlmostEqual(c.overhead, 0.5)
+        self.assertAlmostEqual(c.tx_time, 0.05)
+
+    def test_fixed_overhead_not_counted_per_transaction(self):
+        c = BatchController(slo=3, min_interval=0, max_batch=1000, smoothing=0.5)
+        c.record(transactions=10, execution=1.1, aggregation=0)
+        c.record(transactions=100, execution=2, aggregation=0)
+
+        self.assertAlmostEqual(c.overhead, 1)
+        self.assertAlmostEqual(c.tx_time, 0.01)
+
+        # 2s left after the overhead, at 10ms per transaction
+        self.assertEqual(c.target_size(), 200)
+
+    def test_same_size_batches_keep_cost_per_transaction(self):
+        c = BatchController(smoothing=0.5)
+        c.record(transactions=10, execution=1.1, aggregation=0)
+        c.record(transactions=100, execution=2, aggregation=0)
+
+        for _ in range(20):
+            c.record(transactions=100, execution=2, aggregation=0)
+
+        self.assertAlmostEqual(c.tx_time, 0.01)
+        self.assertAlmostEqual(c.overhead, 1, places=3)
+
+    def test_wait_returns_early_when_queue_reaches_target(self):
+        c = BatchController(max_interval=1, max_batch=3)
+        signal = MockSignal()
+
+        start = time.time()
+        self.loop.run_until_complete(c.wait([1, 2, 3], signal))
+
+        self.assertLess(time.time() - start, 0.1)
+        self.assertEqual(signal.waits, 0)
+
+    def test_wait_lasts_interval_when_load_is_light(self):
+        c = BatchController(max_interval=0.1, max_batch=3)
+        signal = MockSignal()
+
+        start = time.time()
+        self.loop.run_until_complete(c.wait([1], signal))
+
+        self.assertGreaterEqual(time.time() - start, 0.09)
+        self.assertGreater(signal.waits, 0)
+
+    def test_wait_closes_when_transactions_arrive(self):
+        c = BatchController(max_interval=5, max_batch=3)
+        signal = MockSignal()
+        queue = []
+
+        async def arrive():
+            for i in range(3):
+                await asyncio.sleep(0.02)
+                queue.append(i)
+
+        start = time.time()
+        self.loop.run_until_complete(asyncio.gather(c.wait(queue, signal), arrive()))
+
+        self.assertLess(time.time() - start, 1)
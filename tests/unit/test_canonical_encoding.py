@@ -1,5 +1,6 @@
 from unittest import TestCase
 from lamden.crypto import canonical
+import hashlib
 
 
 class TestCanonicalCoding(TestCase):
@@ -31,3 +32,10 @@ class TestCanonicalCoding(TestCase):
         s = canonical.format_dictionary(unsorted)
 
         self.assertDictEqual(s, sorted_dict)
+
+    def test_merklize_hashes_same_as_merklize(self):
+        leaves = [b'a', b'bb', b'ccc', b'dddd', b'e']
+
+        hashes = [hashlib.sha3_256(l).digest() for l in leaves]
+
+        self.assertEqual(canonical.merklize_hashes(hashes), canonical.merklize(leaves))
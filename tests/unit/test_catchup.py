@@ -0,0 +1,198 @@
+from lamden.nodes.catchup import CatchupEngine
+from unittest import TestCase
+import asyncio
+
+
+def make_blocks(n):
+    return {i: {'number': i} for i in range(1, n + 1)}
+
+
+class Chain:
+    def __init__(self, n):
+        self.blocks = make_blocks(n)
+        self.applied = []
+
+    def process_block(self, block):
+        if len(self.applied) > 0 and block['number'] != self.applied[-1] + 1:
+            return False
+        self.applied.append(block['number'])
+        return True
+
+
+class TestCatchupEngine(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_make_chunks_covers_range(self):
+        engine = CatchupEngine(peers={'a': 'ip'}, fetch=None, process_block=None, chunk_size=10)
+
+        chunks = engine.make_chunks(1, 25)
+
+        self.assertEqual(chunks, [(1, 10), (11, 20), (21, 25)])
+
+    def test_applies_blocks_in_order_from_many_peers(self):
+        chain = Chain(100)
+        requested = {}
+
+        async def fetch(start, end, vk, ip):
+            requested[vk] = requested.get(vk, 0) + 1
+            # Later chunks come back first
+            await asyncio.sleep(0.01 * (100 - start) / 100)
+            return [chain.blocks[i] for i in range(start, end + 1)]
+
+        engine = CatchupEngine(
+            peers={'a' * 64: 'a', 'b' * 64: 'b', 'c' * 64: 'c'},
+            fetch=fetch,
+            process_block=chain.process_block,
+            chunk_size=7
+        )
+
+        last = self.loop.run_until_complete(engine.run(1, 100))
+
+        self.assertEqual(last, 100)
+        self.assertEqual(chain.applied, list(range(1, 101)))
+        self.assertEqual(len(requested), 3)
+
+    def test_failing_peer_ranges_reassigned(self):
+        chain = Chain(40)
+
+        async def fetch(start, end, vk, ip):
+            if vk == 'a' * 64:
+                return None
+            return [chain.blocks[i] for i in range(start, end + 1)]
+
+        engine = CatchupEngine(
+            peers={'a' * 64: 'a', 'b' * 64: 'b'},
+            fetch=fetch,
+            process_block=chain.process_block,
+            chunk_size=5
+        )
+
+        last = self.loop.run_until_complete(engine.run(1, 40))
+
+        self.assertEqual(last, 40)
+        self.assertEqual(chain.applied, list(range(1, 41)))
+        self.assertNotIn('a' * 64, engine.live_peers)
+
+    def test_partial_responses_requested_again(self):
+        chain = Chain(20)
+
+        async def fetch(start, end, vk, ip):
+            return [chain.blocks[start]]
+
+        engine = CatchupEngine(
+            peers={'a' * 64: 'a'},
+            fetch=fetch,
+            process_block=chain.process_block,
+            chunk_size=5
+        )
+
+        last = self.loop.run_until_complete(engine.run(1, 20))
+
+        self.assertEqual(last, 20)
+        self.assertEqual(chain.applied, list(range(1, 21)))
+
+    def test_slow_peer_head_chunk_hedged(self):
+        chain = Chain(10)
+
+        async def fetch(start, end, vk, ip):
+            if vk == 'a' * 64:
+                await asyncio.sleep(10)
+            return [chain.blocks[i] for i in range(start, end + 1)]
+
+        engine = CatchupEngine(
+            peers={'a' * 64: 'a', 'b' * 64: 'b'},
+            fetch=fetch,
+            process_block=chain.process_block,
+            chunk_size=5,
+            hedge_after=0.05
+        )
+
+        last = self.loop.run_until_complete(asyncio.wait_for(engine.run(1, 10), timeout=5))
+
+        self.assertEqual(last, 10)
+        self.assertEqual(chain.applied, list(range(1, 11)))
+
+    def test_stops_if_all_peers_fail(self):
+        chain = Chain(10)
+
+        async def fetch(start, end, vk, ip):
+            return None
+
+        engine = CatchupEngine(
+            peers={'a' * 64: 'a'},
+            fetch=fetch,
+            process_block=chain.process_block,
+            chunk_size=5
+        )
+
+        last = self.loop.run_until_complete(engine.run(1, 10))
+
+        self.assertEqual(last, 0)
+        self.assertEqual(chain.applied, [])
+
+    def test_stops_if_block_cannot_be_applied(self):
+        async def fetch(start, end, vk, ip):
+            return [{'number': i} for i in range(start, end + 1)]
+
+        engine = CatchupEngine(
+            peers={'a' * 64: 'a'},
+            fetch=fetch,
+            process_block=lambda block: block['number'] != 3,
+            chunk_size=5
+        )
+
+        last = self.loop.run_until_complete(engine.run(1, 10))
+
+        self.assertEqual(last, 2)
+        self.assertNotIn('a' * 64, engine.live_peers)
+
+    def test_blocks_that_cannot_be_applied_requested_from_another_peer(self):
+        chain = Chain(20)
+
+        async def fetch(start, end, vk, ip):
+            blocks = [dict(chain.blocks[i]) for i in range(start, end + 1)]
+            if vk == 'a' * 64:
+                for b in blocks:
+                    b['bad'] = True
+            return blocks
+
+        def process_block(block):
+            if block.get('bad'):
+                return False
+            return chain.process_block(block)
+
+        engine = CatchupEngine(
+            peers={'a' * 64: 'a', 'b' * 64: 'b'},
+            fetch=fetch,
+            process_block=process_block,
+            chunk_size=5
+        )
+
+        last = self.loop.run_until_complete(asyncio.wait_for(engine.run(1, 20), timeout=5))
+
+        self.assertEqual(last, 20)
+        self.assertEqual(chain.applied, list(range(1, 21)))
+
+    def test_error_applying_block_does_not_hang(self):
+        async def fetch(start, end, vk, ip):
+            return [{'number': i} for i in range(start, end + 1)]
+
+        def process_block(block):
+            raise KeyError('hash')
+
+        engine = CatchupEngine(
+            peers={'a' * 64: 'a', 'b' * 64: 'b'},
+            fetch=fetch,
+            process_block=process_block,
+            chunk_size=5
+        )
+
+        last = self.loop.run_until_complete(asyncio.wait_for(engine.run(1, 10), timeout=5))
+
+        self.assertEqual(last, 0)
+        self.assertEqual(len(engine.live_peers), 0)
@@ -6,7 +6,11 @@ from contracting.client import ContractingClient
 from contracting.db.driver import ContractDriver, decode, encode
 from lamden.storage import BlockStorage
 from lamden.crypto.transaction import build_transaction
+from lamden.crypto.canonical import tx_hash_from_tx
 from lamden import storage
+from lamden.nodes.masternode import mempool
+import secrets
+import time
 
 n = ContractDriver()
 
@@ -369,19 +373,7 @@ def get():
 
         w = Wallet()
 
-        self.ws.client.set_var(
-            contract='currency',
-            variable='balances',
-            arguments=[w.verifying_key],
-            value=1_000_000
-        )
-
-        self.ws.client.set_var(
-            contract='stamp_cost',
-            variable='S',
-            arguments=['value'],
-            value=1_000_000
-        )
+        self.fund(w)
 
         tx = build_transaction(
             wallet=w,
@@ -405,19 +397,7 @@ def get():
 
         w = Wallet()
 
-        self.ws.client.set_var(
-            contract='currency',
-            variable='balances',
-            arguments=[w.verifying_key],
-            value=1_000_000
-        )
-
-        self.ws.client.set_var(
-            contract='stamp_cost',
-            variable='S',
-            arguments=['value'],
-            value=1_000_000
-        )
+        self.fund(w)
 
         tx = build_transaction(
             wallet=w,
@@ -437,7 +417,10 @@ def get():
         self.assertEqual(len(self.ws.queue), 1)
 
     def test_submit_transaction_error_if_queue_full(self):
-        self.ws.queue.extend(range(10_000))
+        self.ws.queue.extend({
+            'payload': {'sender': secrets.token_hex(32), 'nonce': 0},
+            'metadata': {'timestamp': int(time.time())}
+        } for _ in range(10_000))
 
         tx = build_transaction(
             wallet=Wallet(),
@@ -458,6 +441,144 @@ def get():
 
         self.ws.queue.clear()
 
+    def fund(self, w):
+        # Submissions are checked against committed state, not the driver cache
+        driver = self.ws.client.raw_driver
+        driver.driver.set(driver.make_key('currency', 'balances', [w.verifying_key]), 1_000_000)
+        driver.driver.set(driver.make_key('stamp_cost', 'S', ['value']), 1_000_000)
+
+    def transfer(self, w, nonce, processor=None):
+        return decode(build_transaction(
+            wallet=w,
+            processor=processor or self.ws.wallet.verifying_key,
+            stamps=6000,
+            nonce=nonce,
+            contract='currency',
+            function='transfer',
+            kwargs={
+                'amount': 123,
+                'to': 'jeff'
+            }
+        ))
+
+    def test_batch_puts_good_transactions_into_queue_in_order(self):
+        w = Wallet()
+        self.fund(w)
+
+        txs = [self.transfer(w, i) for i in range(5)]
+
+        _, response = self.ws.app.test_client.post('/batch', data=encode(txs))
+
+        results = response.json['results']
+
+        self.assertEqual(len(results), 5)
+        self.assertListEqual([r['hash'] for r in results], [tx_hash_from_tx(tx) for tx in txs])
+        self.assertTrue(all('success' in r for r in results))
+
+        self.assertEqual(len(self.ws.queue), 5)
+        self.assertEqual(self.ws.nonces.get_pending_nonce(w.verifying_key, self.ws.wallet.verifying_key), 5)
+
+        self.ws.queue.clear()
+
+    def test_batch_returns_error_for_each_bad_transaction(self):
+        w = Wallet()
+        self.fund(w)
+
+        txs = [self.transfer(w, 0), self.transfer(w, 1, processor='b' * 64), self.transfer(w, 5)]
+
+        _, response = self.ws.app.test_client.post('/batch', data=encode(txs))
+
+        results = response.json['results']
+
+        self.assertIn('success', results[0])
+        self.assertDictEqual(results[1], {
+            'error': 'Transaction processor does not match expected processor.',
+            'hash': tx_hash_from_tx(txs[1])
+        })
+        self.assertEqual(results[2]['hash'], tx_hash_from_tx(txs[2]))
+        self.assertIn('error', results[2])
+
+        self.assertEqual(len(self.ws.queue), 1)
+
+        self.ws.queue.clear()
+
+    def test_batch_reports_transactions_the_mempool_turns_away(self):
+        ws = WebServer(
+            wallet=self.w,
+            contracting_client=self.ws.client,
+            blocks=self.blocks,
+            driver=n,
+            nonces=self.ws.nonces,
+            queue=mempool.Mempool(max_size=2)
+        )
+
+        ws.queue.append({
+            'payload': {'sender': secrets.token_hex(32), 'nonce': 0},
+            'metadata': {'timestamp': int(time.time())}
+        })
+
+        w = Wallet()
+        self.fund(w)
+
+        txs = [self.transfer(w, i) for i in range(2)]
+
+        _, response = ws.app.test_client.post('/batch', data=encode(txs))
+
+        results = response.json['results']
+
+        self.assertIn('success', results[0])
+        self.assertDictEqual(results[1], {'error': 'Queue full. Resubmit shortly.', 'hash': tx_hash_from_tx(txs[1])})
+        self.assertEqual(ws.nonces.get_latest_nonce(w.verifying_key, self.w.verifying_key), 1)
+
+        ws.validator.stop()
+
+    def test_batch_malformed_body_returns_error(self):
+        _, response = self.ws.app.test_client.post('/batch', data=encode({'not': 'a list'}))
+
+        self.assertDictEqual(response.json, {'error': 'Malformed request body.'})
+
+    def test_batch_error_if_it_does_not_fit_in_queue(self):
+        self.ws.queue.extend({
+            'payload': {'sender': secrets.token_hex(32), 'nonce': 0},
+            'metadata': {'timestamp': int(time.time())}
+        } for _ in range(9_999))
+
+        w = Wallet()
+        txs = [self.transfer(w, i) for i in range(2)]
+
+        _, response = self.ws.app.test_client.post('/batch', data=encode(txs))
+
+        self.assertDictEqual(response.json, {'error': 'Queue full. Resubmit shortly.'})
+        self.assertEqual(len(self.ws.queue), 9_999)
+
+        self.ws.queue.clear()
+
+    def test_tx_turned_away_by_mempool_returns_error_and_keeps_nonce(self):
+        ws = WebServer(
+            wallet=self.w,
+            contracting_client=self.ws.client,
+            blocks=self.blocks,
+            driver=n,
+            nonces=self.ws.nonces,
+            queue=mempool.Mempool(max_size=1)
+        )
+
+        ws.queue.append({
+            'payload': {'sender': secrets.token_hex(32), 'nonce': 0},
+            'metadata': {'timestamp': int(time.time())}
+        })
+
+        w = Wallet()
+        self.fund(w)
+
+        _, response = ws.app.test_client.post('/', data=encode(self.transfer(w, 0)))
+
+        self.assertDictEqual(response.json, {'error': 'Queue full. Resubmit shortly.'})
+        self.assertEqual(len(ws.queue), 1)
+        self.assertEqual(ws.nonces.get_latest_nonce(w.verifying_key, self.w.verifying_key), 0)
+
+        ws.validator.stop()
+
     def test_get_tx_by_hash_if_it_exists(self):
         b = '0' * 64
 
@@ -4,11 +4,14 @@ from lamden.crypto import canonical
 from contracting.db.driver import decode, ContractDriver, InMemDriver
 from contracting.client import ContractingClient
 from lamden.nodes.delegate import execution, work
+from lamden.nodes.delegate.delegate import WorkProcessor, StateReader, predict_block, result_writes, rebase
+from lamden.nodes.masternode.contender import PotentialSolution
 from lamden.nodes import masternode, delegate, base
 from lamden import storage, authentication, router
 import zmq.asyncio
 import asyncio
 import hashlib
+import threading
 from copy import deepcopy
 
 import time
@@ -67,6 +70,20 @@ class TestDelegate(TestCase):
         self.ctx.destroy()
         self.loop.close()
 
+    def test_shadow_without_workers_raises(self):
+        with self.assertRaises(ValueError):
+            delegate.Delegate(
+                socket_base='tcp://127.0.0.1',
+                ctx=self.ctx,
+                wallet=Wallet(),
+                constitution={
+                    'masternodes': [Wallet().verifying_key],
+                    'delegates': [Wallet().verifying_key]
+                },
+                driver=self.driver,
+                shadow=True
+            )
+
     def test_execute_tx_returns_successful_output(self):
         test_contract = '''
 v = Variable()
@@ -1014,3 +1031,508 @@ class TestWork(TestCase):
         filtered = work.filter_work([w, w2, w3])
 
         self.assertEqual(filtered, [w3, w2, w])
+
+
+bank_contract = '''
+balances = Hash(default_value=0)
+
+@construct
+def seed():
+    balances['stu'] = 100
+    balances['jeff'] = 100
+
+@export
+def transfer(amount: int, to: str):
+    assert balances[ctx.caller] >= amount, 'Not enough coins to send!'
+    balances[ctx.caller] -= amount
+    balances[to] += amount
+
+@export
+def total():
+    return sum(balances.all())
+'''
+
+
+class TestConflictResolutionExecutor(TestCase):
+    def setUp(self):
+        self.wallet = Wallet()
+        self.senders = [Wallet() for _ in range(4)]
+        self.exe = None
+
+    def tearDown(self):
+        if self.exe is not None:
+            self.exe.stop()
+
+    def make_client(self):
+        client = ContractingClient(driver=ContractDriver(driver=InMemDriver()))
+        client.flush()
+        client.submit(bank_contract, name='bank')
+
+        for w in self.senders:
+            client.raw_driver.set(f'bank.balances:{w.verifying_key}', 10)
+
+        client.raw_driver.commit()
+        client.raw_driver.clear_pending_state()
+
+        return client
+
+    def build_tx(self, wallet, function='transfer', **kwargs):
+        return decode(transaction.build_transaction(
+            wallet=wallet,
+            contract='bank',
+            function=function,
+            kwargs=kwargs,
+            stamps=100_000,
+            processor='0' * 64,
+            nonce=0
+        ))
+
+    def build_work(self):
+        a, b, c, d = self.senders
+
+        batch_1 = [
+            # Independent
+            self.build_tx(a, amount=1, to='x'),
+            self.build_tx(b, amount=1, to='y'),
+            # d can only send 15 after c has paid it
+            self.build_tx(c, amount=5, to=d.verifying_key),
+            self.build_tx(d, amount=15, to='z'),
+            # Spends the rest of what a has, then fails
+            self.build_tx(a, amount=9, to='x'),
+            self.build_tx(a, amount=1, to='x'),
+        ]
+
+        batch_2 = [
+            self.build_tx(b, amount=9, to=a.verifying_key),
+            self.build_tx(a, amount=9, to='x'),
+            # Reads every balance
+            self.build_tx(c, function='total'),
+        ]
+
+        return [
+            {'transactions': batch_1, 'timestamp': 1, 'input_hash': 'A' * 64},
+            {'transactions': batch_2, 'timestamp': 2, 'input_hash': 'B' * 64}
+        ]
+
+    def execute(self, exe, client, work):
+        return exe.execute_work(
+            driver=client.raw_driver,
+            work=work,
+            previous_block_hash='C' * 64,
+            wallet=self.wallet,
+            stamp_cost=20_000
+        )
+
+    def test_same_results_as_serial_executor(self):
+        work = self.build_work()
+
+        serial_client = self.make_client()
+        expected = self.execute(execution.SerialExecutor(executor=serial_client.executor), serial_client, work)
+
+        client = self.make_client()
+        self.exe = execution.ConflictResolutionExecutor(executor=client.executor)
+        results = self.execute(self.exe, client, work)
+
+        self.assertEqual(results, expected)
+
+    def test_subblock_executor_same_results_as_serial_executor(self):
+        work = self.build_work()
+
+        serial_client = self.make_client()
+        expected = self.execute(execution.SerialExecutor(executor=serial_client.executor), serial_client, work)
+
+        client = self.make_client()
+        self.exe = execution.SubblockExecutor(executor=client.executor)
+        results = self.execute(self.exe, client, work)
+
+        self.assertEqual(results, expected)
+
+    def test_subblock_executor_runs_each_batch_as_one_group(self):
+        self.exe = execution.SubblockExecutor(executor=self.make_client().executor)
+
+        groups = self.exe.make_groups(transactions=[None] * 5, batches=[[0, 1], [], [2, 3, 4]])
+
+        self.assertEqual(groups, [[0, 1], [2, 3, 4]])
+
+    def test_execute_tx_batch_on_its_own(self):
+        work = self.build_work()
+
+        serial_client = self.make_client()
+        serial = execution.SerialExecutor(executor=serial_client.executor)
+        expected = serial.execute_tx_batch(serial_client.raw_driver, work[0], 1, 'A' * 64, 20_000)
+
+        client = self.make_client()
+        self.exe = execution.ConflictResolutionExecutor(executor=client.executor)
+        results = self.exe.execute_tx_batch(client.raw_driver, work[0], 1, 'A' * 64, 20_000)
+
+        self.assertEqual(results, expected)
+        self.assertIsNone(self.exe.speculative)
+
+    def test_batches_speculated_as_they_arrive_same_results(self):
+        work = self.build_work()
+        work[0]['sender'] = 'a' * 64
+        work[1]['sender'] = 'b' * 64
+
+        serial_client = self.make_client()
+        expected = self.execute(execution.SerialExecutor(executor=serial_client.executor), serial_client, work)
+
+        client = self.make_client()
+        self.exe = execution.ConflictResolutionExecutor(executor=client.executor)
+
+        # The batch that sorts last arrives first
+        for tx_batch in reversed(work):
+            self.exe.speculate_batch(client.raw_driver, tx_batch, 'C' * 64, 0, 20_000)
+
+        speculated = []
+        run_speculation = self.exe.run_speculation
+
+        def record(batches, stamp_cost, overlay):
+            speculated.extend(batches)
+            return run_speculation(batches, stamp_cost, overlay)
+
+        self.exe.run_speculation = record
+
+        results = self.execute(self.exe, client, work)
+
+        self.assertEqual(results, expected)
+        self.assertEqual(speculated, [])
+        self.assertEqual(self.exe.early, {})
+
+    def test_batches_speculated_for_another_block_are_ignored(self):
+        work = self.build_work()
+        work[0]['sender'] = 'a' * 64
+        work[1]['sender'] = 'b' * 64
+
+        serial_client = self.make_client()
+        expected = self.execute(execution.SerialExecutor(executor=serial_client.executor), serial_client, work)
+
+        client = self.make_client()
+        self.exe = execution.ConflictResolutionExecutor(executor=client.executor)
+
+        for tx_batch in work:
+            self.exe.speculate_batch(client.raw_driver, tx_batch, 'D' * 64, 0, 20_000)
+
+        results = self.execute(self.exe, client, work)
+
+        self.assertEqual(results, expected)
+
+    def test_range_reads_are_rerun(self):
+        client = self.make_client()
+        self.exe = execution.ConflictResolutionExecutor(executor=client.executor)
+
+        self.execute(self.exe, client, self.build_work())
+
+        self.assertGreater(self.exe.reruns, 0)
+
+    def test_dependent_transactions_are_grouped_and_not_rerun(self):
+        work = self.build_work()[:1]
+
+        client = self.make_client()
+        self.exe = execution.ConflictResolutionExecutor(executor=client.executor)
+
+        results = self.execute(self.exe, client, work)
+
+        self.assertEqual(self.exe.reruns, 0)
+        self.assertEqual([tx['status'] for tx in results[0]['transactions']], [0, 0, 0, 0, 0, 1])
+
+    def test_independent_transactions_are_not_rerun(self):
+        work = [{
+            'transactions': [self.build_tx(w, amount=1, to=w.verifying_key[:8]) for w in self.senders],
+            'timestamp': 1,
+            'input_hash': 'A' * 64
+        }]
+
+        client = self.make_client()
+        self.exe = execution.ConflictResolutionExecutor(executor=client.executor)
+
+        self.execute(self.exe, client, work)
+
+        self.assertEqual(self.exe.reruns, 0)
+
+    def test_same_value_checks_type(self):
+        self.assertTrue(execution.same_value(1, 1))
+        self.assertFalse(execution.same_value(1, True))
+        self.assertFalse(execution.same_value(None, 0))
+        self.assertTrue(execution.same_value({'a': [1]}, {'a': [1]}))
+
+    def test_start_prewarms_workers(self):
+        client = self.make_client()
+        self.exe = execution.ConflictResolutionExecutor(executor=client.executor, workers=2)
+
+        self.exe.start()
+
+        self.assertEqual(len(self.exe.pool.processes), 2)
+        self.assertTrue(all(p.is_alive() for p in self.exe.pool.processes))
+
+    def test_workers_get_executor_settings(self):
+        client = self.make_client()
+        client.executor.metering = False
+        client.executor.bypass_privates = True
+
+        self.exe = execution.ConflictResolutionExecutor(executor=client.executor, workers=2)
+
+        self.assertEqual(self.exe.pool.settings, {
+            'metering': False,
+            'currency_contract': client.executor.currency_contract,
+            'balances_hash': client.executor.balances_hash,
+            'bypass_privates': True
+        })
+
+    def test_stop_stops_workers(self):
+        client = self.make_client()
+        self.exe = execution.ConflictResolutionExecutor(executor=client.executor, workers=2)
+
+        self.exe.start()
+        processes = self.exe.pool.processes
+
+        self.exe.stop()
+
+        self.assertFalse(any(p.is_alive() for p in processes))
+        self.assertFalse(self.exe.pool.running)
+
+    def test_dead_worker_restarted_and_results_unchanged(self):
+        work = self.build_work()
+
+        serial_client = self.make_client()
+        expected = self.execute(execution.SerialExecutor(executor=serial_client.executor), serial_client, work)
+
+        client = self.make_client()
+        self.exe = execution.ConflictResolutionExecutor(executor=client.executor, workers=2)
+        self.exe.start()
+
+        self.exe.pool.processes[0].terminate()
+        self.exe.pool.processes[0].join()
+
+        results = self.execute(self.exe, client, work)
+
+        self.assertEqual(results, expected)
+        self.assertGreater(self.exe.pool.restarts, 0)
+        self.assertTrue(all(p.is_alive() for p in self.exe.pool.processes))
+
+
+class BrokenExecutor(execution.SerialExecutor):
+    def execute_tx(self, transaction, stamp_cost, environment: dict = {}):
+        tx_output = super().execute_tx(transaction, stamp_cost, environment)
+        tx_output['stamps_used'] += 1
+        return tx_output
+
+
+class TestShadowExecutor(TestCase):
+    def setUp(self):
+        self.client = ContractingClient(driver=ContractDriver(driver=InMemDriver()))
+        self.client.flush()
+        self.client.submit(bank_contract, name='bank')
+        self.client.raw_driver.commit()
+        self.client.raw_driver.clear_pending_state()
+
+        self.stu = Wallet()
+        self.client.raw_driver.set(f'bank.balances:{self.stu.verifying_key}', 10)
+
+        self.wallet = Wallet()
+
+    def make_work(self):
+        txs = [decode(transaction.build_transaction(
+            wallet=self.stu,
+            contract='bank',
+            function='transfer',
+            kwargs={'amount': 3, 'to': 'jeff'},
+            stamps=100_000,
+            processor='0' * 64,
+            nonce=0
+        )) for _ in range(4)]
+
+        return [{'transactions': txs, 'timestamp': 1, 'input_hash': 'A' * 64}]
+
+    def execute(self, exe):
+        return exe.execute_work(
+            driver=self.client.raw_driver,
+            work=self.make_work(),
+            previous_block_hash='C' * 64,
+            wallet=self.wallet,
+            stamp_cost=20_000
+        )
+
+    def test_matching_candidate_not_counted_as_divergence(self):
+        exe = execution.ShadowExecutor(
+            serial=execution.SerialExecutor(executor=self.client.executor),
+            candidate=execution.SerialExecutor(executor=self.client.executor)
+        )
+
+        self.execute(exe)
+
+        self.assertEqual(exe.checked, 1)
+        self.assertEqual(exe.divergences, 0)
+
+    def test_diverging_candidate_counted_and_serial_results_returned(self):
+        exe = execution.ShadowExecutor(
+            serial=execution.SerialExecutor(executor=self.client.executor),
+            candidate=BrokenExecutor(executor=self.client.executor)
+        )
+
+        results = self.execute(exe)
+
+        self.assertEqual(exe.divergences, 1)
+        self.assertEqual([tx['stamps_used'] for tx in results[0]['transactions']], [1, 1, 1, 1])
+
+    def test_candidate_state_is_discarded(self):
+        exe = execution.ShadowExecutor(
+            serial=execution.SerialExecutor(executor=self.client.executor),
+            candidate=execution.SerialExecutor(executor=self.client.executor)
+        )
+
+        results = self.execute(exe)
+
+        # The fourth transfer fails because the balance was only spent once by the serial executor
+        self.assertEqual([tx['status'] for tx in results[0]['transactions']], [0, 0, 0, 1])
+        self.assertEqual(self.client.raw_driver.get(f'bank.balances:{self.stu.verifying_key}'), 1)
+
+    def test_state_diff_lists_changed_keys(self):
+        expected = [{'key': 'a', 'value': 1}, {'key': 'b', 'value': 2}]
+        actual = [{'key': 'a', 'value': 1}, {'key': 'b', 'value': 3}, {'key': 'c', 'value': 4}]
+
+        self.assertEqual(execution.state_diff(expected, actual), {'b': (2, 3), 'c': (None, 4)})
+
+
+class TestWorkProcessor(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.driver = ContractDriver(driver=InMemDriver())
+        self.wp = WorkProcessor(client=ContractingClient(driver=self.driver), nonces=storage.NonceStorage())
+
+    def tearDown(self):
+        self.wp.stop()
+        self.loop.close()
+
+    def test_release_work_keeps_arrival_order(self):
+        first = self.loop.create_future()
+        second = self.loop.create_future()
+        self.wp.pending_work['a'] = [first, second]
+
+        second.set_result({'n': 2})
+        self.wp.release_work('a')
+
+        self.assertEqual(self.wp.new_work['a'], [])
+
+        first.set_result({'n': 1})
+        self.wp.release_work('a')
+
+        self.assertEqual(self.wp.new_work['a'], [{'n': 1}, {'n': 2}])
+
+    def test_release_work_drops_failed_validation(self):
+        failed = self.loop.create_future()
+        failed.set_exception(ValueError())
+        self.wp.pending_work['a'] = [failed]
+
+        self.wp.release_work('a')
+
+        self.assertEqual(self.wp.new_work['a'], [])
+        self.assertEqual(self.wp.pending_work['a'], [])
+
+    def test_validation_runs_off_the_event_loop(self):
+        threads = []
+
+        def validate_transactions(msg):
+            threads.append(threading.get_ident())
+            return msg
+
+        self.wp.validate_transactions = validate_transactions
+
+        w = Wallet()
+        self.wp.masters = [w.verifying_key]
+        msg = {
+            'transactions': [],
+            'timestamp': int(time.time()),
+            'signature': w.sign('A' * 64),
+            'input_hash': 'A' * 64,
+            'sender': w.verifying_key
+        }
+
+        self.loop.run_until_complete(self.wp.process_message(msg))
+
+        self.assertNotEqual(threads, [threading.get_ident()])
+        self.assertEqual(self.wp.new_work[w.verifying_key], [msg])
+
+    def test_state_reader_reads_committed_state(self):
+        reader = StateReader(self.driver)
+
+        self.driver.set('currency.balances:stu', 100)
+
+        self.assertIsNone(reader.get_var(contract='currency', variable='balances', arguments=['stu']))
+
+        self.driver.commit()
+
+        self.assertEqual(reader.get_var(contract='currency', variable='balances', arguments=['stu']), 100)
+
+
+class TestPipelining(TestCase):
+    def make_results(self):
+        w = Wallet()
+
+        tx = {
+            'hash': 'a' * 64,
+            'transaction': {'payload': {'sender': 'stu', 'nonce': 0}},
+            'status': 0,
+            'state': [{'key': 'currency.balances:stu', 'value': 90}, {'key': 'currency.balances:jeff', 'value': 10}],
+            'stamps_used': 1,
+            'result': 'None'
+        }
+
+        return [
+            {
+                'input_hash': 'b' * 64,
+                'transactions': [tx],
+                'merkle_tree': {'leaves': ['c' * 64], 'signature': w.sign('c' * 64)},
+                'signer': w.verifying_key,
+                'subblock': 0,
+                'previous': '0' * 64
+            },
+            {
+                'input_hash': 'd' * 64,
+                'transactions': [],
+                'merkle_tree': {'leaves': ['d' * 64], 'signature': w.sign('d' * 64)},
+                'signer': w.verifying_key,
+                'subblock': 1,
+                'previous': '0' * 64
+            }
+        ]
+
+    def test_predict_block_matches_block_made_by_masternodes(self):
+        results = self.make_results()
+
+        solutions = []
+        for sbc in results:
+            p = PotentialSolution(struct=sbc)
+            p.signatures.append((sbc['merkle_tree']['signature'], sbc['signer']))
+            solutions.append(p.struct_to_dict())
+
+        block = canonical.block_from_subblocks(solutions, previous_hash='0' * 64, block_num=1)
+
+        self.assertEqual(predict_block(results, previous_hash='0' * 64, block_num=1)['hash'], block['hash'])
+
+    def test_predict_block_depends_on_previous(self):
+        results = self.make_results()
+
+        self.assertNotEqual(
+            predict_block(results, previous_hash='0' * 64, block_num=1)['hash'],
+            predict_block(results, previous_hash='1' * 64, block_num=1)['hash']
+        )
+
+    def test_rebase_leaves_only_writes_the_block_carries(self):
+        driver = ContractDriver(driver=InMemDriver())
+
+        # Left in the cache by a transaction that failed
+        driver.set('currency.balances:failed', 5)
+
+        rebase(driver, self.make_results())
+
+        self.assertNotIn('currency.balances:failed', driver.cache)
+        self.assertEqual(driver.cache['currency.balances:stu'], 90)
+        self.assertEqual(driver.cache['currency.balances:jeff'], 10)
+
+    def test_result_writes_collects_state(self):
+        self.assertDictEqual(result_writes(self.make_results()), {
+            'currency.balances:stu': 90,
+            'currency.balances:jeff': 10
+        })
@@ -7,10 +7,19 @@ from contracting.db.driver import InMemDriver, ContractDriver
 from contracting.client import ContractingClient
 import zmq.asyncio
 import asyncio
+import secrets
+import time
 
 from unittest import TestCase
 
 
+def mock_tx():
+    return {
+        'payload': {'sender': secrets.token_hex(32), 'nonce': 0},
+        'metadata': {'timestamp': int(time.time())}
+    }
+
+
 def generate_blocks(number_of_blocks, subblocks=[]):
     previous_hash = '0' * 64
     previous_number = 0
@@ -89,7 +98,8 @@ class TestMasternode(TestCase):
 
         async def late_tx(timeout=0.2):
             await asyncio.sleep(timeout)
-            node.tx_batcher.queue.append('MOCK TX')
+            node.tx_batcher.queue.append(mock_tx())
+            node.new_block_processor.signal.set()
 
         tasks = asyncio.gather(
             node.hang(),
@@ -116,6 +126,7 @@ class TestMasternode(TestCase):
         async def late_tx(timeout=0.2):
             await asyncio.sleep(timeout)
             node.new_block_processor.q.append('MOCK BLOCK')
+            node.new_block_processor.signal.set()
 
         tasks = asyncio.gather(
             node.hang(),
@@ -196,7 +207,7 @@ class TestMasternode(TestCase):
             dl_wallet.verifying_key: dl_bootnode
         }
 
-        node.tx_batcher.queue.append('MOCK TX')
+        node.tx_batcher.queue.append(mock_tx())
 
         tasks = asyncio.gather(
             mn_router.serve(),
@@ -451,13 +462,14 @@ class TestMasternode(TestCase):
             dl_wallet.verifying_key: dl_bootnode
         }
 
-        node.tx_batcher.queue.append('MOCK TX')
+        node.tx_batcher.queue.append(mock_tx())
 
         node.running = True
 
         async def late_tx(timeout=0.2):
             await asyncio.sleep(timeout)
-            node.tx_batcher.queue.append('MOCK TX')
+            node.tx_batcher.queue.append(mock_tx())
+            node.new_block_processor.signal.set()
 
         async def late_kill(timeout=1):
             node.running = False
@@ -0,0 +1,170 @@
+from unittest import TestCase
+from lamden.nodes.masternode.mempool import Mempool
+import time
+
+
+def make_tx(sender='stu', nonce=0, timestamp=None, data=''):
+    return {
+        'payload': {
+            'sender': sender,
+            'nonce': nonce,
+            'contract': 'currency',
+            'function': 'transfer',
+            'kwargs': {'amount': 1, 'to': 'jeff', 'data': data}
+        },
+        'metadata': {
+            'signature': 'sig',
+            'timestamp': timestamp if timestamp is not None else int(time.time())
+        }
+    }
+
+
+class TestMempool(TestCase):
+    def setUp(self):
+        self.pool = Mempool()
+
+    def test_append_adds_tx(self):
+        self.assertTrue(self.pool.append(make_tx()))
+        self.assertEqual(len(self.pool), 1)
+
+    def test_duplicate_tx_is_dropped(self):
+        tx = make_tx()
+
+        self.pool.append(tx)
+        self.assertFalse(self.pool.append(tx))
+
+        self.assertEqual(len(self.pool), 1)
+        self.assertEqual(self.pool.duplicates, 1)
+
+    def test_pop_batch_returns_arrival_order(self):
+        txs = [make_tx(sender=s) for s in ['a', 'b', 'c']]
+        self.pool.extend(txs)
+
+        self.assertListEqual(self.pool.pop_batch(), txs)
+        self.assertEqual(len(self.pool), 0)
+
+    def test_pop_batch_returns_nonce_order_for_a_sender(self):
+        late = make_tx(nonce=1)
+        early = make_tx(nonce=0)
+        other = make_tx(sender='jeff')
+
+        self.pool.append(late)
+        self.pool.append(other)
+        self.pool.append(early)
+
+        self.assertListEqual(self.pool.pop_batch(), [early, late, other])
+
+    def test_pop_batch_respects_max_count(self):
+        self.pool.extend(make_tx(nonce=i) for i in range(10))
+
+        batch = self.pool.pop_batch(max_count=4)
+
+        self.assertListEqual([tx['payload']['nonce'] for tx in batch], [0, 1, 2, 3])
+        self.assertEqual(len(self.pool), 6)
+
+    def test_pop_batch_respects_max_bytes(self):
+        for i in range(4):
+            self.pool.append(make_tx(nonce=i), size=100)
+
+        self.assertEqual(len(self.pool.pop_batch(max_bytes=250)), 2)
+        self.assertEqual(len(self.pool), 2)
+
+    def test_pop_batch_sends_tx_bigger_than_budget_alone(self):
+        self.pool.append(make_tx(nonce=0), size=1000)
+        self.pool.append(make_tx(nonce=1), size=10)
+
+        self.assertEqual(len(self.pool.pop_batch(max_bytes=100)), 1)
+
+    def test_pop_batch_drops_expired(self):
+        now = time.time()
+
+        self.pool.append(make_tx(sender='a', timestamp=now - 100))
+        fresh = make_tx(sender='b', timestamp=now)
+        self.pool.append(fresh)
+
+        self.assertListEqual(self.pool.pop_batch(now=now), [fresh])
+        self.assertEqual(self.pool.expired, 1)
+
+    def test_expire_removes_old_txs(self):
+        now = time.time()
+
+        self.pool.append(make_tx(sender='a', timestamp=now - 100))
+        self.pool.append(make_tx(sender='b', timestamp=now))
+
+        self.assertEqual(self.pool.expire(now=now), 1)
+        self.assertEqual(len(self.pool), 1)
+        self.assertDictEqual(self.pool.lanes, {'b': self.pool.lanes['b']})
+
+    def test_full_pool_evicts_newest_of_longest_lane(self):
+        pool = Mempool(max_size=3)
+
+        pool.extend([make_tx(sender='a', nonce=0), make_tx(sender='a', nonce=1), make_tx(sender='b')])
+
+        self.assertTrue(pool.append(make_tx(sender='c')))
+
+        self.assertEqual(len(pool), 3)
+        self.assertEqual(pool.evicted, 1)
+        self.assertListEqual(
+            [(tx['payload']['sender'], tx['payload']['nonce']) for tx in pool.pop_batch()],
+            [('a', 0), ('b', 0), ('c', 0)]
+        )
+
+    def test_full_pool_rejects_tx_from_longest_lane(self):
+        pool = Mempool(max_size=2)
+
+        pool.extend([make_tx(nonce=0), make_tx(nonce=1)])
+
+        self.assertFalse(pool.append(make_tx(nonce=2)))
+        self.assertEqual(len(pool), 2)
+
+    def test_full_pool_evicts_from_other_sender_tied_for_longest(self):
+        pool = Mempool(max_size=4)
+
+        pool.extend([make_tx(sender='a', nonce=0), make_tx(sender='a', nonce=1)])
+        pool.extend([make_tx(sender='b', nonce=0), make_tx(sender='b', nonce=1)])
+
+        self.assertTrue(pool.append(make_tx(sender='a', nonce=2)))
+
+        self.assertEqual(pool.evicted, 1)
+        self.assertListEqual([nonce for nonce, _ in pool.lanes['a']], [0, 1, 2])
+        self.assertListEqual([nonce for nonce, _ in pool.lanes['b']], [0])
+
+    def test_full_pool_of_single_tx_senders_rejects(self):
+        pool = Mempool(max_size=3)
+
+        pool.extend(make_tx(sender=s) for s in ['a', 'b', 'c'])
+
+        self.assertFalse(pool.append(make_tx(sender='d')))
+        self.assertEqual(pool.evicted, 0)
+
+    def test_longest_lane_tracked_as_lanes_shrink(self):
+        pool = Mempool(max_size=4)
+
+        pool.extend([make_tx(sender='a', nonce=i) for i in range(3)] + [make_tx(sender='b')])
+        self.assertEqual(pool.longest, 3)
+
+        pool.pop_batch(max_count=2)
+        self.assertEqual(pool.longest, 1)
+
+        pool.extend([make_tx(sender='c'), make_tx(sender='d')])
+
+        self.assertFalse(pool.append(make_tx(sender='e')))
+        self.assertEqual(pool.evicted, 0)
+
+    def test_out_of_order_nonce_removed_from_middle_of_lane(self):
+        now = time.time()
+
+        self.pool.append(make_tx(nonce=0, timestamp=now))
+        self.pool.append(make_tx(nonce=2, timestamp=now))
+        self.pool.append(make_tx(nonce=1, timestamp=now - 100))
+
+        self.assertEqual(self.pool.expire(now=now), 1)
+        self.assertListEqual([nonce for nonce, _ in self.pool.lanes['stu']], [0, 2])
+        self.assertEqual(self.pool.longest, 2)
+
+    def test_clear_empties_pool(self):
+        self.pool.extend(make_tx(nonce=i) for i in range(3))
+        self.pool.clear()
+
+        self.assertEqual(len(self.pool), 0)
+        self.assertListEqual(self.pool.pop_batch(), [])
@@ -1,6 +1,6 @@
 from unittest import TestCase
 
-from lamden import router, authentication
+from lamden import router, authentication, wire
 
 from lamden.crypto.wallet import Wallet
 import zmq.asyncio
@@ -64,6 +64,32 @@ class TestRouter(TestCase):
 
         self.assertEqual(res[1], router.OK)
 
+    def test_undecodable_frames_dropped_and_router_keeps_serving(self):
+        r = router.Router(socket_id='ipc:///tmp/router', ctx=self.ctx, linger=50)
+
+        async def request():
+            socket = self.ctx.socket(zmq.DEALER)
+            socket.connect('ipc:///tmp/router')
+
+            await socket.send(b'"df:')
+            await socket.send(b'[' * 100_000)
+            await socket.send(wire.MAGIC + bytes([wire.LIST, 1]) * 100_000)
+            await socket.send(encode({'blah': 123}).encode())
+
+            resp = await socket.recv()
+
+            return decode(resp)
+
+        tasks = asyncio.gather(
+            r.serve(),
+            request(),
+            stop_server(r, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], router.OK)
+
     def test_request_none_returns_default_message(self):
         r = router.Router(socket_id='ipc:///tmp/router', ctx=self.ctx, linger=50)
 
@@ -588,3 +614,392 @@ class TestJSONAsyncInbox(TestCase):
 
         self.assertEqual(q1.q[0], {'hello': 'there'})
         self.assertEqual(q2.q[0], {'hello': 'there'})
+
+
+class TestPeerPool(TestCase):
+    def setUp(self):
+        self.ctx = zmq.asyncio.Context()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.authenticator = authentication.SocketAuthenticator(client=ContractingClient(), ctx=self.ctx)
+
+        self.w = Wallet()
+        self.w2 = Wallet()
+
+        self.authenticator.add_verifying_key(self.w.verifying_key)
+        self.authenticator.add_verifying_key(self.w2.verifying_key)
+        self.authenticator.configure()
+
+        self.pool = router.PeerPool(ctx=self.ctx, wallet=self.w2, cert_dir=self.authenticator.cert_dir)
+
+    def tearDown(self):
+        self.pool.close()
+        self.authenticator.authenticator.stop()
+        self.ctx.destroy()
+        self.loop.close()
+
+    def make_router(self):
+        class EchoProcessor(router.Processor):
+            async def process_message(self, msg):
+                # Answer out of order to make sure replies are matched to the right request
+                await asyncio.sleep(0.1 / msg['i'])
+                return {'i': msg['i']}
+
+        m = router.Router(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w
+        )
+
+        m.add_service('something', EchoProcessor())
+
+        return m
+
+    def test_pooled_requests_matched_to_replies(self):
+        m = self.make_router()
+
+        async def get():
+            return await asyncio.gather(*[router.secure_request(
+                msg={'i': i},
+                service='something',
+                wallet=self.w2,
+                vk=self.w.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx,
+                pool=self.pool
+            ) for i in range(1, 6)])
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], [{'i': i} for i in range(1, 6)])
+        self.assertEqual(len(self.pool.connections), 1)
+
+    def test_pool_switches_to_binary_frames(self):
+        m = self.make_router()
+
+        async def get():
+            first = await router.secure_request(
+                msg={'i': 1},
+                service='something',
+                wallet=self.w2,
+                vk=self.w.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx,
+                pool=self.pool
+            )
+
+            binary = self.pool.connections[self.w.verifying_key].binary
+
+            second = await router.secure_request(
+                msg={'i': 2},
+                service='something',
+                wallet=self.w2,
+                vk=self.w.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx,
+                pool=self.pool
+            )
+
+            return first, binary, second
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], ({'i': 1}, True, {'i': 2}))
+
+    def test_pool_matches_bare_replies_from_peers_that_do_not_tag_them(self):
+        class OldRouter(router.Router):
+            async def reply(self, _id, response, request_id=None, binary=False):
+                await self.return_msg(_id, response)
+
+        class EchoProcessor(router.Processor):
+            async def process_message(self, msg):
+                return {'i': msg['i']}
+
+        m = OldRouter(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w
+        )
+
+        m.add_service('something', EchoProcessor())
+
+        async def get():
+            responses = []
+            for i in range(1, 4):
+                responses.append(await router.secure_request(
+                    msg={'i': i},
+                    service='something',
+                    wallet=self.w2,
+                    vk=self.w.verifying_key,
+                    ip='tcp://127.0.0.1:10000',
+                    ctx=self.ctx,
+                    pool=self.pool
+                ))
+            return responses
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], [{'i': i} for i in range(1, 4)])
+        self.assertTrue(self.pool.untagged(self.w.verifying_key))
+
+    def test_pool_drops_garbage_replies_without_downgrading_peer(self):
+        class NoisyRouter(router.Router):
+            async def reply(self, _id, response, request_id=None, binary=False):
+                await router.AsyncInbox.return_msg(self, _id, b'\xff not a message')
+                await router.AsyncInbox.return_msg(self, _id, b'null')
+                await super().reply(_id, response, request_id=request_id, binary=binary)
+
+        class EchoProcessor(router.Processor):
+            async def process_message(self, msg):
+                return {'i': msg['i']}
+
+        m = NoisyRouter(
+            socket_id='tcp://127.0.0.1:10000',
+            ctx=self.ctx,
+            linger=2000,
+            poll_timeout=50,
+            secure=True,
+            wallet=self.w
+        )
+
+        m.add_service('something', EchoProcessor())
+
+        async def get():
+            responses = await asyncio.gather(*[router.secure_request(
+                msg={'i': i},
+                service='something',
+                wallet=self.w2,
+                vk=self.w.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx,
+                pool=self.pool
+            ) for i in range(1, 3)])
+            return responses
+
+        tasks = asyncio.gather(
+            m.serve(),
+            get(),
+            stop_server(m, 1),
+        )
+
+        res = self.loop.run_until_complete(tasks)
+
+        self.assertEqual(res[1], [{'i': 1}, {'i': 2}])
+        self.assertFalse(self.pool.untagged(self.w.verifying_key))
+
+    def test_pool_reuses_connection(self):
+        a = self.pool.get(self.w.verifying_key, 'tcp://127.0.0.1:10000')
+        b = self.pool.get(self.w.verifying_key, 'tcp://127.0.0.1:10000')
+
+        self.assertIs(a, b)
+
+    def test_pool_reconnects_when_ip_changes(self):
+        a = self.pool.get(self.w.verifying_key, 'tcp://127.0.0.1:10000')
+        b = self.pool.get(self.w.verifying_key, 'tcp://127.0.0.1:10001')
+
+        self.assertIsNot(a, b)
+        self.assertTrue(a.closed)
+
+    def test_sync_drops_peers_that_left(self):
+        a = self.pool.get(self.w.verifying_key, 'tcp://127.0.0.1:10000')
+
+        self.pool.sync({self.w2.verifying_key: 'tcp://127.0.0.1:10001'})
+
+        self.assertTrue(a.closed)
+        self.assertEqual(self.pool.connections, {})
+
+    def test_get_without_certificate_returns_none(self):
+        self.assertIsNone(self.pool.get(Wallet().verifying_key, 'tcp://127.0.0.1:10000'))
+
+    def test_forget_keys_drops_peers_without_certificates(self):
+        self.pool.get(self.w.verifying_key, 'tcp://127.0.0.1:10000')
+
+        self.authenticator.flush_all_keys()
+        self.pool.forget_keys()
+
+        self.assertEqual(self.pool.connections, {})
+        self.assertEqual(self.pool.server_keys, {})
+
+    def test_pooled_request_times_out(self):
+        async def get():
+            return await router.secure_request(
+                msg={'i': 1},
+                service='something',
+                wallet=self.w2,
+                vk=self.w.verifying_key,
+                ip='tcp://127.0.0.1:10000',
+                ctx=self.ctx,
+                timeout=100,
+                pool=self.pool
+            )
+
+        self.assertIsNone(self.loop.run_until_complete(get()))
+
+
+class TestServiceLimit(TestCase):
+    def setUp(self):
+        self.ctx = zmq.asyncio.Context()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.ctx.destroy()
+        self.loop.close()
+
+    def test_runs_at_most_max_concurrent(self):
+        limit = router.ServiceLimit(max_concurrent=2, max_queue=10)
+        running = []
+        most = []
+
+        async def work():
+            running.append(1)
+            most.append(len(running))
+            await asyncio.sleep(0.01)
+            running.pop()
+
+        self.loop.run_until_complete(asyncio.gather(*[limit.run(work()) for _ in range(6)]))
+
+        self.assertEqual(max(most), 2)
+        self.assertEqual(limit.processed, 6)
+        self.assertEqual(limit.max_queued, 4)
+        self.assertEqual(limit.queued, 0)
+        self.assertEqual(limit.active, 0)
+
+    def test_full_when_active_and_queue_at_limits(self):
+        limit = router.ServiceLimit(max_concurrent=1, max_queue=1)
+
+        async def work():
+            await asyncio.sleep(0.05)
+
+        async def check():
+            tasks = [asyncio.ensure_future(limit.run(work())) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            full = limit.full
+            await asyncio.gather(*tasks)
+            return full
+
+        self.assertTrue(self.loop.run_until_complete(check()))
+        self.assertFalse(limit.full)
+
+    def test_router_rejects_when_service_full(self):
+        r = router.Router(socket_id='ipc:///tmp/router', ctx=self.ctx, linger=50)
+
+        class SlowProcessor(router.Processor):
+            async def process_message(self, msg):
+                await asyncio.sleep(0.05)
+                return {'done': True}
+
+        r.add_service('slow', SlowProcessor(), max_concurrent=1, max_queue=1)
+
+        replies = []
+
+        async def reply(_id, response, request_id=None, binary=False):
+            replies.append(response)
+
+        r.reply = reply
+
+        msg = {'service': 'slow', 'msg': {}}
+
+        self.loop.run_until_complete(asyncio.gather(*[r.handle_msg(b'id', msg) for _ in range(4)]))
+
+        self.assertEqual(replies.count(router.BUSY), 2)
+        self.assertEqual(replies.count({'done': True}), 2)
+
+        stats = r.stats()['services']['slow']
+
+        self.assertEqual(stats['rejected'], 2)
+        self.assertEqual(stats['processed'], 2)
+
+
+class TestSignal(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_wait_returns_after_timeout_if_not_set(self):
+        s = router.Signal()
+
+        start = self.loop.time()
+        self.loop.run_until_complete(s.wait(timeout=0.05))
+
+        self.assertGreaterEqual(self.loop.time() - start, 0.04)
+
+    def test_set_wakes_waiter_before_timeout(self):
+        s = router.Signal()
+
+        async def wake():
+            await asyncio.sleep(0.01)
+            s.set()
+
+        start = self.loop.time()
+        self.loop.run_until_complete(asyncio.gather(s.wait(timeout=5), wake()))
+
+        self.assertLess(self.loop.time() - start, 1)
+
+    def test_wait_without_timeout_sleeps_until_set(self):
+        s = router.Signal()
+
+        async def wake():
+            await asyncio.sleep(0.1)
+            s.set()
+
+        start = self.loop.time()
+        self.loop.run_until_complete(asyncio.gather(s.wait(), wake()))
+
+        self.assertGreaterEqual(self.loop.time() - start, 0.09)
+
+    def test_queue_processor_wakes_waiter(self):
+        q = router.QueueProcessor()
+
+        async def wait_for_msg():
+            while len(q.q) <= 0:
+                await q.signal.wait(timeout=5)
+            return q.q.pop(0)
+
+        async def send():
+            await asyncio.sleep(0.01)
+            await q.process_message({'hello': 'there'})
+
+        start = self.loop.time()
+        msg, _ = self.loop.run_until_complete(asyncio.gather(wait_for_msg(), send()))
+
+        self.assertEqual(msg, {'hello': 'there'})
+        self.assertLess(self.loop.time() - start, 1)
+
+    def test_signal_usable_from_new_loop(self):
+        s = router.Signal()
+        self.loop.run_until_complete(s.wait(timeout=0.01))
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        loop.run_until_complete(s.wait(timeout=0.01))
+        loop.close()
@@ -0,0 +1,114 @@
+from unittest import TestCase
+from lamden.nodes.delegate import scheduler
+
+
+def make_tx(sender, function='transfer', contract='currency', **kwargs):
+    return {
+        'payload': {
+            'sender': sender,
+            'contract': contract,
+            'function': function,
+            'kwargs': kwargs
+        }
+    }
+
+
+class TestAccessSets(TestCase):
+    def test_predicts_sender_balance_and_to(self):
+        access = scheduler.AccessSets()
+
+        reads, writes = access.predict(make_tx('stu', amount=1, to='jeff'))
+
+        self.assertEqual(writes, {'currency.balances:stu', 'currency.balances:jeff'})
+        self.assertEqual(reads, set())
+
+    def test_make_template_replaces_caller_and_arguments(self):
+        template = scheduler.make_template('con.allowed:stu:jeff:x', 'stu', {'spender': 'jeff'})
+
+        self.assertEqual(template, ('con.allowed', (('caller', None), ('arg', 'spender'), ('value', 'x'))))
+
+    def test_resolve_template_fills_in_transaction(self):
+        template = ('con.allowed', (('caller', None), ('arg', 'spender'), ('value', 'x')))
+
+        key = scheduler.resolve_template(template, 'a', {'spender': 'b'})
+
+        self.assertEqual(key, 'con.allowed:a:b:x')
+
+    def test_resolve_template_missing_argument_returns_none(self):
+        template = ('con.allowed', (('arg', 'spender'),))
+
+        self.assertIsNone(scheduler.resolve_template(template, 'a', {}))
+
+    def test_learned_templates_predict_new_transactions(self):
+        access = scheduler.AccessSets()
+
+        access.learn(
+            make_tx('stu', function='approve', amount=1, spender='jeff'),
+            reads=['currency.__code__'],
+            writes=['currency.balances:stu', 'currency.allowances:stu:jeff']
+        )
+
+        reads, writes = access.predict(make_tx('a', function='approve', amount=2, spender='b'))
+
+        self.assertEqual(writes, {'currency.balances:a', 'currency.allowances:a:b'})
+        self.assertEqual(reads, {'currency.__code__'})
+
+    def test_templates_bounded(self):
+        access = scheduler.AccessSets(max_templates=2)
+
+        access.learn(make_tx('stu'), writes=['con.a', 'con.b', 'con.c'])
+
+        self.assertEqual(len(access.writes[('currency', 'transfer')]), 2)
+
+
+class TestMakeGroups(TestCase):
+    def test_distinct_transfers_are_independent(self):
+        txs = [make_tx(f's{i}', amount=1, to=f'r{i}') for i in range(4)]
+
+        groups = scheduler.make_groups(txs, scheduler.AccessSets())
+
+        self.assertEqual(groups, [[0], [1], [2], [3]])
+
+    def test_shared_accounts_are_grouped_in_order(self):
+        txs = [
+            make_tx('a', amount=1, to='b'),
+            make_tx('c', amount=1, to='d'),
+            make_tx('b', amount=1, to='e'),
+            make_tx('a', amount=1, to='f'),
+            make_tx('g', amount=1, to='d'),
+        ]
+
+        groups = scheduler.make_groups(txs, scheduler.AccessSets())
+
+        self.assertEqual(groups, [[0, 2, 3], [1, 4]])
+
+    def test_shared_reads_do_not_group(self):
+        access = scheduler.AccessSets()
+        access.add('currency', 'transfer', reads=[('currency.__code__', ())])
+
+        txs = [make_tx('a', amount=1, to='b'), make_tx('c', amount=1, to='d')]
+
+        self.assertEqual(scheduler.make_groups(txs, access), [[0], [1]])
+
+    def test_read_of_written_key_groups(self):
+        access = scheduler.AccessSets()
+        access.add('con', 'get', reads=[('con.v', ())])
+        access.add('con', 'set', writes=[('con.v', ())])
+
+        txs = [make_tx('a', contract='con', function='set'), make_tx('b', contract='con', function='get')]
+
+        self.assertEqual(scheduler.make_groups(txs, access), [[0, 1]])
+
+
+class TestAssign(TestCase):
+    def test_balances_groups_across_workers(self):
+        groups = [[0, 1, 2, 3], [4], [5], [6, 7], [8]]
+
+        chunks = scheduler.assign(groups, 2)
+
+        self.assertEqual(sorted(sum(len(g) for g in c) for c in chunks), [4, 5])
+        self.assertEqual(sorted(i for c in chunks for g in c for i in g), list(range(9)))
+
+    def test_no_empty_chunks(self):
+        self.assertEqual(scheduler.assign([[0]], 4), [[[0]]])
+        self.assertEqual(scheduler.assign([], 4), [])
@@ -3,6 +3,25 @@ from contracting.db.driver import ContractDriver
 from unittest import TestCase
 
 from lamden.storage import BlockStorage
+import threading
+
+
+class SlowReadNonces(storage.NonceStorage):
+    # Runs another thread's write while a read is waiting on the database
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.during_read = None
+        self.writer = None
+
+    def get_one(self, sender, processor, db):
+        value = storage.NonceStorage.get_one(sender, processor, db)
+
+        if self.during_read is not None:
+            self.writer = threading.Thread(target=self.during_read)
+            self.writer.start()
+            self.writer.join(timeout=0.1)
+
+        return value
 
 
 class TestNonce(TestCase):
@@ -93,6 +112,105 @@ class TestNonce(TestCase):
 
         self.assertEqual(n, 2)
 
+    def test_set_nonce_not_written_to_db_until_commit(self):
+        self.nonces.set_nonce(
+            sender='test',
+            processor='test2',
+            value=2
+        )
+
+        n = storage.NonceStorage.get_one('test', 'test2', self.nonces.nonces)
+        self.assertIsNone(n)
+
+        self.nonces.commit()
+
+        n = storage.NonceStorage.get_one('test', 'test2', self.nonces.nonces)
+        self.assertEqual(n, 2)
+
+    def test_commit_writes_pending_nonces(self):
+        self.nonces.set_pending_nonce(
+            sender='test',
+            processor='test2',
+            value=5
+        )
+
+        self.nonces.commit()
+
+        n = storage.NonceStorage.get_one('test', 'test2', self.nonces.pending_nonces)
+        self.assertEqual(n, 5)
+
+    def test_get_nonce_served_from_cache_after_first_read(self):
+        storage.NonceStorage.set_one('test', 'test2', 2, self.nonces.nonces)
+
+        n = self.nonces.get_nonce(
+            sender='test',
+            processor='test2'
+        )
+
+        self.assertEqual(n, 2)
+
+        storage.NonceStorage.set_one('test', 'test2', 3, self.nonces.nonces)
+
+        n = self.nonces.get_nonce(
+            sender='test',
+            processor='test2'
+        )
+
+        self.assertEqual(n, 2)
+
+    def test_cache_drops_least_recently_used_reads(self):
+        nonces = storage.NonceStorage(cache_size=2)
+
+        nonces.get_nonce(sender='a', processor='p')
+        nonces.get_nonce(sender='b', processor='p')
+        nonces.get_nonce(sender='a', processor='p')
+        nonces.get_nonce(sender='c', processor='p')
+
+        self.assertListEqual(list(nonces.nonce_cache.keys()), [('a', 'p'), ('c', 'p')])
+
+    def test_cache_keeps_uncommitted_nonces(self):
+        nonces = storage.NonceStorage(cache_size=1)
+
+        nonces.set_nonce(sender='a', processor='p', value=1)
+        nonces.get_nonce(sender='b', processor='p')
+        nonces.get_nonce(sender='c', processor='p')
+
+        self.assertIn(('a', 'p'), nonces.nonce_cache)
+
+        nonces.commit()
+
+        self.assertEqual(storage.NonceStorage.get_one('a', 'p', nonces.nonces), 1)
+
+    def test_nonce_set_during_read_is_not_overwritten(self):
+        nonces = SlowReadNonces()
+        nonces.during_read = lambda: nonces.set_nonce(sender='a', processor='p', value=5)
+
+        nonces.get_nonce(sender='a', processor='p')
+        nonces.writer.join()
+
+        self.assertEqual(nonces.get_nonce(sender='a', processor='p'), 5)
+
+        nonces.commit()
+
+        self.assertEqual(storage.NonceStorage.get_one('a', 'p', nonces.nonces), 5)
+        nonces.flush()
+
+    def test_flush_clears_cache(self):
+        self.nonces.set_nonce(
+            sender='test',
+            processor='test2',
+            value=2
+        )
+
+        self.nonces.flush()
+
+        n = self.nonces.get_nonce(
+            sender='test',
+            processor='test2'
+        )
+
+        self.assertIsNone(n)
+
 
 class TestStorage(TestCase):
     def setUp(self):
@@ -299,6 +417,19 @@ class TestUpdatingState(TestCase):
         n = self.nonces.get_pending_nonce(sender='xxx', processor='yyy')
         self.assertEqual(n, None)
 
+    def test_update_with_block_commits_nonces_to_db(self):
+        storage.update_state_with_block(
+            block=block,
+            driver=self.driver,
+            nonces=self.nonces
+        )
+
+        n = storage.NonceStorage.get_one('abc', 'def', self.nonces.nonces)
+        self.assertEqual(n, 125)
+
+        n = storage.NonceStorage.get_one('xxx', 'yyy', self.nonces.nonces)
+        self.assertEqual(n, 43)
+
         n = self.nonces.get_latest_nonce(sender='abc', processor='def')
         self.assertEqual(n, 125)
 
@@ -447,6 +578,7 @@ class TestUpdatingState(TestCase):
 class TestMasterStorage(TestCase):
     def setUp(self):
         self.db = BlockStorage()
+        self.db.create_indexes()
 
     def tearDown(self):
         self.db.drop_collections()
@@ -567,10 +699,10 @@ class TestMasterStorage(TestCase):
         blocks = []
 
         blocks.append({'hash': 'a', 'number': 1, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 2, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 3, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 4, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 5, 'data': 'woop'})
+        blocks.append({'hash': 'b', 'number': 2, 'data': 'woop'})
+        blocks.append({'hash': 'c', 'number': 3, 'data': 'woop'})
+        blocks.append({'hash': 'd', 'number': 4, 'data': 'woop'})
+        blocks.append({'hash': 'e', 'number': 5, 'data': 'woop'})
 
         for block in blocks:
             self.db.put(block)
@@ -585,10 +717,10 @@ class TestMasterStorage(TestCase):
         blocks = []
 
         blocks.append({'hash': 'a', 'number': 1, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 2, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 3, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 4, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 5, 'data': 'woop'})
+        blocks.append({'hash': 'b', 'number': 2, 'data': 'woop'})
+        blocks.append({'hash': 'c', 'number': 3, 'data': 'woop'})
+        blocks.append({'hash': 'd', 'number': 4, 'data': 'woop'})
+        blocks.append({'hash': 'e', 'number': 5, 'data': 'woop'})
 
         for block in blocks:
             self.db.put(block, BlockStorage.BLOCK)
@@ -603,10 +735,10 @@ class TestMasterStorage(TestCase):
         blocks = []
 
         blocks.append({'hash': 'a', 'number': 1, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 2, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 3, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 4, 'data': 'woop'})
-        blocks.append({'hash': 'a', 'number': 5, 'data': 'woop'})
+        blocks.append({'hash': 'b', 'number': 2, 'data': 'woop'})
+        blocks.append({'hash': 'c', 'number': 3, 'data': 'woop'})
+        blocks.append({'hash': 'd', 'number': 4, 'data': 'woop'})
+        blocks.append({'hash': 'e', 'number': 5, 'data': 'woop'})
 
         for block in blocks:
             self.db.put(block, BlockStorage.BLOCK)
@@ -707,3 +839,90 @@ class TestMasterStorage(TestCase):
 
     def test_get_block_v_none_returns_none(self):
         self.assertIsNone(self.db.get_block())
+
+    def test_indexes_created_on_number_and_hash(self):
+        block_indexes = [i['key'] for i in self.db.blocks.index_information().values()]
+        tx_indexes = [i['key'] for i in self.db.txs.index_information().values()]
+
+        self.assertIn([('number', 1)], block_indexes)
+        self.assertIn([('hash', 1)], block_indexes)
+        self.assertIn([('hash', 1)], tx_indexes)
+
+    def test_indexes_recreated_after_drop_collections(self):
+        self.db.drop_collections()
+
+        block_indexes = [i['key'] for i in self.db.blocks.index_information().values()]
+
+        self.assertIn([('number', 1)], block_indexes)
+
+    def test_indexes_fall_back_to_non_unique_on_duplicate_blocks(self):
+        self.db.blocks.drop()
+        self.db.blocks.insert_many([
+            {'hash': 'f' * 64, 'number': 1},
+            {'hash': 'f' * 64, 'number': 1}
+        ])
+
+        self.db.create_indexes()
+
+        indexes = {i['key'][0][0]: i.get('unique', False) for i in self.db.blocks.index_information().values()}
+
+        self.assertIn('number', indexes)
+        self.assertFalse(indexes['number'])
+        self.assertEqual(self.db.blocks.count_documents({}), 2)
+
+    def test_put_duplicate_block_returns_false(self):
+        block = {
+            'hash': 'a',
+            'number': 1,
+            'data': 'woop'
+        }
+
+        self.assertTrue(self.db.put(block))
+        self.assertFalse(self.db.put(block))
+
+    def test_store_block_twice_stores_one_block_and_txs(self):
+        tx_1 = {
+            'hash': 'something1',
+            'key': '1'
+        }
+
+        block = {
+            'hash': 'hello',
+            'number': 1,
+            'subblocks': [
+                {
+                    'transactions': [tx_1]
+                }
+            ]
+        }
+
+        self.db.store_block(block)
+        self.db.store_block(block)
+
+        self.assertEqual(self.db.blocks.count_documents({}), 1)
+        self.assertEqual(self.db.txs.count_documents({}), 1)
+
+        got_block = self.db.get_block(1)
+
+        self.assertDictEqual(block, got_block)
+
+    def test_get_blocks_returns_range_in_order(self):
+        blocks = [{'hash': f'{i}', 'number': i, 'data': 'woop'} for i in range(1, 10)]
+
+        for block in reversed(blocks):
+            self.db.put(block)
+
+        got_blocks = list(self.db.get_blocks(3, 6))
+
+        self.assertEqual(got_blocks, blocks[2:6])
+
+    def test_store_block_with_no_txs_stores_block(self):
+        block = {
+            'hash': 'hello',
+            'number': 1,
+            'subblocks': []
+        }
+
+        self.db.store_block(block)
+
+        self.assertDictEqual(block, self.db.get_block('hello'))
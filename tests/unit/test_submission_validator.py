@@ -0,0 +1,170 @@
+from unittest import TestCase
+from lamden.nodes.masternode.validator import SubmissionValidator
+from lamden.crypto.wallet import Wallet
+from lamden.crypto import transaction
+from lamden import storage
+from contracting.client import ContractingClient
+from contracting.db.encoder import decode
+import asyncio
+
+
+class CountingNonces(storage.NonceStorage):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lookups = 0
+
+    def get_nonce(self, sender, processor):
+        self.lookups += 1
+        return super().get_nonce(sender, processor)
+
+
+class TestSubmissionValidator(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.processor = Wallet()
+        self.client = ContractingClient()
+        self.nonces = CountingNonces()
+        self.nonces.flush()
+
+        self.set_committed('stamp_cost', 'S', ['value'], 1)
+
+        self.validator = SubmissionValidator(
+            client=self.client,
+            nonces=self.nonces,
+            processor=self.processor.verifying_key,
+            workers=2
+        )
+
+    def tearDown(self):
+        self.validator.stop()
+        self.nonces.flush()
+        self.client.flush()
+        self.loop.close()
+
+    def set_committed(self, contract, variable, arguments, value):
+        driver = self.client.raw_driver
+        driver.driver.set(driver.make_key(contract, variable, arguments), value)
+
+    def make_tx(self, wallet, nonce, processor=None):
+        self.set_committed('currency', 'balances', [wallet.verifying_key], 1_000_000)
+
+        return decode(transaction.build_transaction(
+            wallet=wallet,
+            processor=processor or self.processor.verifying_key,
+            stamps=100,
+            nonce=nonce,
+            contract='currency',
+            function='transfer',
+            kwargs={'amount': 10, 'to': 'jeff'}
+        ))
+
+    def test_good_transaction_returns_none_and_sets_pending_nonce(self):
+        w = Wallet()
+
+        results = self.loop.run_until_complete(self.validator.validate([self.make_tx(w, 0)]))
+
+        self.assertListEqual(results, [None])
+        self.assertEqual(self.nonces.get_pending_nonce(w.verifying_key, self.processor.verifying_key), 1)
+
+    def test_wrong_processor_returns_error(self):
+        tx = self.make_tx(Wallet(), 0, processor='b' * 64)
+
+        error, = self.loop.run_until_complete(self.validator.validate([tx]))
+
+        self.assertIsInstance(error, transaction.TransactionProcessorInvalid)
+
+    def test_concurrent_submissions_get_nonces_in_order(self):
+        w = Wallet()
+        txs = [self.make_tx(w, i) for i in range(10)]
+
+        results = self.loop.run_until_complete(
+            asyncio.gather(*[self.validator.validate([tx]) for tx in txs])
+        )
+
+        self.assertListEqual(results, [[None]] * 10)
+        self.assertEqual(self.nonces.get_pending_nonce(w.verifying_key, self.processor.verifying_key), 10)
+
+    def test_bad_nonce_is_reported_before_funds(self):
+        w = Wallet()
+        tx = self.make_tx(w, 5)
+        self.set_committed('currency', 'balances', [w.verifying_key], 0)
+
+        error, = self.loop.run_until_complete(self.validator.validate([tx]))
+
+        self.assertIsInstance(error, transaction.TransactionNonceInvalid)
+
+    def test_too_few_stamps_does_not_set_pending_nonce(self):
+        w = Wallet()
+        tx = self.make_tx(w, 0)
+        self.set_committed('currency', 'balances', [w.verifying_key], 0)
+
+        error, = self.loop.run_until_complete(self.validator.validate([tx]))
+
+        self.assertIsInstance(error, transaction.TransactionSenderTooFewStamps)
+        self.assertIsNone(self.nonces.get_pending_nonce(w.verifying_key, self.processor.verifying_key))
+
+    def test_nonces_looked_up_once_per_sender_in_a_batch(self):
+        w = Wallet()
+        txs = [self.make_tx(w, i) for i in range(5)]
+
+        results = self.loop.run_until_complete(self.validator.validate(txs))
+
+        self.assertListEqual(results, [None] * 5)
+        self.assertEqual(self.nonces.lookups, 1)
+
+    def test_release_takes_back_pending_nonce(self):
+        w = Wallet()
+        tx = self.make_tx(w, 0)
+
+        self.loop.run_until_complete(self.validator.validate([tx]))
+        self.loop.run_until_complete(self.validator.release([tx]))
+
+        self.assertEqual(self.nonces.get_pending_nonce(w.verifying_key, self.processor.verifying_key), 0)
+
+    def test_release_keeps_pending_nonce_if_later_tx_validated(self):
+        w = Wallet()
+        txs = [self.make_tx(w, 0), self.make_tx(w, 1)]
+
+        self.loop.run_until_complete(self.validator.validate(txs))
+        self.loop.run_until_complete(self.validator.release([txs[0]]))
+
+        self.assertEqual(self.nonces.get_pending_nonce(w.verifying_key, self.processor.verifying_key), 2)
+
+    def test_funds_read_from_committed_state(self):
+        w = Wallet()
+        tx = self.make_tx(w, 0)
+
+        # Uncommitted writes in the driver cache are not seen by validation
+        self.client.set_var(contract='currency', variable='balances', arguments=[w.verifying_key], value=0)
+
+        error, = self.loop.run_until_complete(self.validator.validate([tx]))
+
+        self.assertIsNone(error)
+
+    def test_validation_does_not_fill_driver_cache(self):
+        w = Wallet()
+
+        self.loop.run_until_complete(self.validator.validate([self.make_tx(w, 0)]))
+
+        self.assertNotIn(self.client.raw_driver.make_key('currency', 'balances', [w.verifying_key]),
+                         self.client.raw_driver.cache)
+
+    def test_submission_larger_than_max_batch_not_split(self):
+        self.validator.stop()
+        self.validator = SubmissionValidator(
+            client=self.client,
+            nonces=self.nonces,
+            processor=self.processor.verifying_key,
+            workers=2,
+            max_batch=2
+        )
+
+        w = Wallet()
+        txs = [self.make_tx(w, i) for i in range(5)]
+
+        results = self.loop.run_until_complete(self.validator.validate(txs))
+
+        self.assertListEqual(results, [None] * 5)
+        self.assertEqual(self.nonces.lookups, 1)
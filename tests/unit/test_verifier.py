@@ -0,0 +1,110 @@
+from unittest import TestCase
+from lamden.crypto.wallet import Wallet
+from lamden.crypto import verifier
+
+
+def make_items(n, bad=()):
+    items = []
+    for i in range(n):
+        w = Wallet()
+        msg = f'message {i}'
+        signature = w.sign(msg)
+        if i in bad:
+            msg = 'something else'
+        items.append((w.verifying_key, msg, signature))
+    return items
+
+
+class TestVerify(TestCase):
+    def test_valid_signature_cached(self):
+        w = Wallet()
+        signature = w.sign('hello')
+
+        self.assertTrue(verifier.verify(w.verifying_key, 'hello', signature))
+
+        key = verifier.VerifiedCache.key(w.verifying_key, b'hello', signature)
+        self.assertIn(key, verifier.verified)
+
+    def test_invalid_signature_not_cached(self):
+        w = Wallet()
+        signature = w.sign('hello')
+
+        self.assertFalse(verifier.verify(w.verifying_key, 'goodbye', signature))
+
+        key = verifier.VerifiedCache.key(w.verifying_key, b'goodbye', signature)
+        self.assertNotIn(key, verifier.verified)
+
+    def test_verify_keys_reused(self):
+        w = Wallet()
+
+        self.assertIs(verifier.verify_key(w.verifying_key), verifier.verify_key(w.verifying_key))
+
+
+class TestVerifiedCache(TestCase):
+    def test_oldest_entries_evicted(self):
+        cache = verifier.VerifiedCache(size=2)
+
+        cache.add('a')
+        cache.add('b')
+        self.assertIn('a', cache)
+        cache.add('c')
+
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+
+class TestVerifier(TestCase):
+    def setUp(self):
+        self.verifier = verifier.Verifier(workers=2, min_pool_batch=8, chunk_size=4, cache=verifier.VerifiedCache())
+
+    def tearDown(self):
+        self.verifier.stop()
+
+    def test_small_batch_verified_in_process(self):
+        results = self.verifier.verify_batch(make_items(4, bad=[1]))
+
+        self.assertEqual(results, [True, False, True, True])
+        self.assertIsNone(self.verifier.pool)
+
+    def test_large_batch_verified_on_pool(self):
+        results = self.verifier.verify_batch(make_items(20, bad=[3, 17]))
+
+        self.assertEqual(results, [i not in (3, 17) for i in range(20)])
+        self.assertIsNotNone(self.verifier.pool)
+
+    def test_start_starts_pool(self):
+        self.verifier.start()
+
+        self.assertIsNotNone(self.verifier.pool)
+
+    def test_pool_workers_are_not_forked(self):
+        self.assertNotEqual(verifier.pool_context().get_start_method(), 'fork')
+
+    def test_verify_uses_cache(self):
+        w = Wallet()
+        signature = w.sign('hello')
+
+        self.assertTrue(self.verifier.verify(w.verifying_key, 'hello', signature))
+        self.assertIn(verifier.VerifiedCache.key(w.verifying_key, b'hello', signature), self.verifier.cache)
+        self.assertFalse(self.verifier.verify(w.verifying_key, 'goodbye', signature))
+
+    def test_cached_signatures_not_checked_again(self):
+        items = make_items(10)
+        self.verifier.verify_batch(items)
+
+        self.verifier.cache.misses = 0
+        results = self.verifier.verify_batch(items)
+
+        self.assertEqual(results, [True] * 10)
+        self.assertEqual(self.verifier.cache.misses, 0)
+
+    def test_malformed_items_are_invalid(self):
+        w = Wallet()
+
+        results = self.verifier.verify_batch([('zz', 'hello', w.sign('hello')), (w.verifying_key, 'hello', 'abc')])
+
+        self.assertEqual(results, [False, False])
+
+    def test_module_verify_uses_shared_verifier(self):
+        self.assertIs(verifier.service.cache, verifier.verified)
@@ -0,0 +1,101 @@
+from unittest import TestCase
+from contracting.db.encoder import encode, decode
+from contracting.stdlib.bridge.decimal import ContractingDecimal
+from lamden import wire
+import secrets
+
+
+def make_sbc():
+    return {
+        'input_hash': secrets.token_hex(32),
+        'transactions': [
+            {
+                'stamps_used': 123,
+                'state': [{'key': 'currency.balances:' + secrets.token_hex(32), 'value': ContractingDecimal('1.5')}],
+                'status': 0,
+                'result': 'None',
+                'transaction': {
+                    'payload': {
+                        'sender': secrets.token_hex(32),
+                        'processor': secrets.token_hex(32),
+                        'nonce': 0,
+                        'stamps_supplied': 1000,
+                        'contract': 'currency',
+                        'function': 'transfer',
+                        'kwargs': {'amount': ContractingDecimal('10.25'), 'to': 'jeff'}
+                    },
+                    'metadata': {
+                        'signature': secrets.token_hex(64),
+                        'timestamp': 1600000000
+                    }
+                }
+            }
+        ],
+        'merkle_tree': {
+            'leaves': [secrets.token_hex(32)],
+            'signature': secrets.token_hex(64)
+        },
+        'signer': secrets.token_hex(32),
+        'subblock': 0,
+        'previous': '0' * 64
+    }
+
+
+class TestWire(TestCase):
+    def assert_same_as_json(self, v):
+        self.assertEqual(wire.loads(wire.dumps(v)), decode(encode(v)))
+
+    def test_primitives_round_trip(self):
+        for v in [None, True, False, 0, 1, -1, 127, 128, -129, 2 ** 80, -(2 ** 80), '', 'hello', 'ünïcode', b'\x00\x01']:
+            self.assert_same_as_json(v)
+
+    def test_hex_strings_round_trip(self):
+        for v in ['0' * 64, secrets.token_hex(64), 'abc', 'ABCDEF0123456789', 'abcdef0123456789a']:
+            self.assert_same_as_json(v)
+
+    def test_containers_round_trip(self):
+        self.assert_same_as_json({'a': [1, 2, {'b': (3, 4)}], 'hash': 'x', 'c': {}})
+
+    def test_decimals_round_trip(self):
+        v = {'amount': ContractingDecimal('1.000001')}
+
+        self.assert_same_as_json(v)
+        self.assertIsInstance(wire.loads(wire.dumps(v))['amount'], ContractingDecimal)
+
+    def test_encoded_special_dicts_decode_like_json(self):
+        self.assert_same_as_json({'value': {'__fixed__': '1.5'}})
+
+    def test_sbc_round_trip(self):
+        self.assert_same_as_json([make_sbc(), make_sbc()])
+
+    def test_sbc_smaller_than_json(self):
+        sbcs = [make_sbc() for _ in range(4)]
+
+        self.assertLess(len(wire.dumps(sbcs)), len(encode(sbcs).encode()) * 0.7)
+
+    def test_is_binary(self):
+        self.assertTrue(wire.is_binary(wire.dumps({'a': 1})))
+        self.assertFalse(wire.is_binary(encode({'a': 1}).encode()))
+
+    def test_loads_json_returns_none(self):
+        self.assertIsNone(wire.loads(b'{"a":1}'))
+
+    def test_loads_truncated_returns_none(self):
+        data = wire.dumps(make_sbc())
+
+        self.assertIsNone(wire.loads(data[:-5]))
+
+    def test_loads_trailing_bytes_returns_none(self):
+        self.assertIsNone(wire.loads(wire.dumps({'a': 1}) + b'\x00'))
+
+    def test_loads_deeply_nested_returns_none(self):
+        frame = wire.MAGIC + bytes([wire.LIST, 1]) * 100_000 + bytes([wire.NONE])
+
+        self.assertIsNone(wire.loads(frame))
+
+    def test_nesting_up_to_max_depth_round_trips(self):
+        v = None
+        for _ in range(wire.MAX_DEPTH):
+            v = [v]
+
+        self.assertEqual(wire.loads(wire.dumps(v)), v)